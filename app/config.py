@@ -1,6 +1,9 @@
 # config.py
-import os
+from modules.tools.settings import get_settings
 
 class Config:
     DEBUG = True
 
+    # Typed settings, loaded once from the environment and .env
+    # The JWT secret is set by create_app, so importing this needs no environment
+    settings = staticmethod(get_settings)
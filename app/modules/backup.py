@@ -0,0 +1,280 @@
+# backup.py
+
+import itertools
+import json
+
+from flask import Response, jsonify, stream_with_context
+
+from .secrets import bump_secrets_version, get_tenant_dbconfig
+from .tools.archive import ArchiveError, decrypt_archive, encrypt_archive
+from .tools.audit import audit_event
+from .tools.encryption import decrypt_secrets, encrypt_secrets
+from .tools.execute_query import execute_query, stream_query
+from .tools.logger import vadafi_logger
+
+logger = vadafi_logger()
+
+# Every live secret with all its stored versions, grouped per secret
+EXPORT_QUERY = """
+SELECT s.id, s.name, s.cached, s.current_version, v.version, v.secret, v.salt, v.iv, v.created_at
+FROM secrets s
+JOIN secret_versions v ON v.secret_id = s.id
+WHERE s.deleted_at IS NULL
+ORDER BY s.id, v.version
+"""
+
+# Insert a batch of records, secrets whose name is taken are skipped
+# The secrets row holds the current version, like update_secret keeps it
+IMPORT_QUERY = """
+WITH data AS (
+    SELECT * FROM jsonb_to_recordset(%s::jsonb)
+    AS d(name TEXT, cached BOOLEAN, current_version INTEGER, versions JSONB)
+),
+inserted AS (
+    INSERT INTO secrets (name, secret, salt, iv, current_version, cached)
+    SELECT d.name, v.secret, v.salt, v.iv, d.current_version, COALESCE(d.cached, FALSE)
+    FROM data d
+    CROSS JOIN LATERAL jsonb_to_recordset(d.versions) AS v(version INTEGER, secret TEXT, salt TEXT, iv TEXT)
+    WHERE v.version = d.current_version
+    ON CONFLICT (name) WHERE deleted_at IS NULL DO NOTHING
+    RETURNING id, name
+),
+versions AS (
+    INSERT INTO secret_versions (secret_id, version, secret, salt, iv, created_at)
+    SELECT i.id, v.version, v.secret, v.salt, v.iv, COALESCE(v.created_at, now())
+    FROM inserted i
+    JOIN data d ON d.name = i.name
+    CROSS JOIN LATERAL jsonb_to_recordset(d.versions)
+    AS v(version INTEGER, secret TEXT, salt TEXT, iv TEXT, created_at TIMESTAMP)
+    RETURNING 1
+)
+SELECT COUNT(*) FROM inserted
+"""
+
+
+def iter_secret_records(dbconfig):
+    """
+    Yield the user's secrets as archive records, one secret at a time.
+
+    Args:
+        dbconfig (dict): The dbconfig of the user's database.
+
+    Yields:
+        dict: The name, options and encrypted versions of a secret.
+    """
+    rows = stream_query(EXPORT_QUERY, dbconfig=dbconfig)
+
+    for secret_id, versions in itertools.groupby(rows, key=lambda row: row[0]):
+        versions = list(versions)
+        secret_id, name, cached, current_version = versions[0][:4]
+
+        yield {
+            "name": name,
+            "cached": cached,
+            "current_version": current_version,
+            "versions": [
+                {
+                    "version": version,
+                    "secret": secret,
+                    "salt": salt,
+                    "iv": iv,
+                    "created_at": created_at.isoformat() if created_at else None,
+                }
+                for _, _, _, _, version, secret, salt, iv, created_at in versions
+            ],
+        }
+
+
+
+def reencrypt_records(records, old_password, new_password, batch_size=64):
+    """
+    Encrypt every version of the records with another password.
+
+    Only needed when an archive moves between passwords, costs two key
+    derivations per version. The versions of batch_size records are
+    decrypted and encrypted together, in parallel on the crypto executor.
+
+    Args:
+        records (iterable): The archive records.
+        old_password (str): The password the versions are encrypted with.
+        new_password (str): The password to encrypt them with.
+        batch_size (int): Records handled together.
+
+    Yields:
+        dict: The record with its versions encrypted with new_password.
+    """
+    records = iter(records)
+
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return
+
+        versions = [version for record in batch for version in record["versions"]]
+        decrypted = decrypt_secrets(old_password, versions)
+
+        offset = 0
+        for record in batch:
+            count = len(record["versions"])
+            if any(plain_text_secret is None for plain_text_secret, _ in decrypted[offset:offset + count]):
+                raise ArchiveError(f"Could not decrypt secret {record['name']}.")
+            offset += count
+
+        encrypted = iter(encrypt_secrets(new_password, [plain_text_secret for plain_text_secret, _ in decrypted]))
+
+        for record in batch:
+            yield dict(record, versions=[dict(version, **next(encrypted)) for version in record["versions"]])
+
+
+
+def export_secrets(username, password, archive_password=None):
+    """
+    Stream the user's secrets as an encrypted archive.
+
+    The stored ciphertexts are passed through as they are, the archive only
+    adds a layer of encryption with the password. With another
+    archive_password every version is encrypted again with that password.
+
+    Args:
+        username (str): The user's username.
+        password (str): The user's password.
+        archive_password (str): The password of the archive, password if None.
+
+    Returns:
+        result (Response): The archive, streamed.
+    """
+    try:
+        # Check the credentials before the response starts, errors can not be reported once it streams
+        dbconfig = get_tenant_dbconfig(username, password)
+        if execute_query("SELECT 1", return_data=True, dbconfig=dbconfig) is False:
+            raise RuntimeError("Database error while exporting secrets.")
+
+    except Exception as e:
+        logger.error(f"Error occured while exporting secrets for user {username}. {e}")
+        audit_event("export_secrets", username, "failure")
+
+        return jsonify({
+            "error": "Error occured while exporting secrets",
+            "message": "Sorry, we could not export your secrets at this moment."
+            }), 400
+
+    reencrypt = archive_password and archive_password != password
+
+    def generate():
+        records = iter_secret_records(dbconfig)
+        if reencrypt:
+            records = reencrypt_records(records, password, archive_password)
+
+        try:
+            yield from encrypt_archive(records, archive_password or password)
+            audit_event("export_secrets", username, "success")
+
+        except Exception as e:
+            # The archive ends without its final frame, so the client sees it is truncated
+            logger.error(f"Error occured while streaming the export of user {username}. {e}")
+            audit_event("export_secrets", username, "failure")
+            raise
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="vadafi-{username}.vault"'}
+        ), 200
+
+
+
+def import_secrets(username, password, stream, archive_password=None, batch_size=200):
+    """
+    Import an archive from export_secrets, streamed.
+
+    Secrets whose name is already taken are skipped, so an interrupted import
+    can be run again.
+
+    Args:
+        username (str): The user's username.
+        password (str): The user's password.
+        stream: The archive, anything with a read method.
+        archive_password (str): The password of the archive, password if None.
+        batch_size (int): Secrets inserted per query.
+
+    Returns:
+        result (JSON): The number of imported and skipped secrets.
+    """
+    imported = 0
+    skipped = 0
+
+    try:
+        dbconfig = get_tenant_dbconfig(username, password)
+        reencrypt = archive_password and archive_password != password
+
+        def insert(batch):
+            # A name twice in one INSERT ... ON CONFLICT fails the whole statement,
+            # so only the first record of a name is sent and the rest count as skipped
+            unique = {}
+            for record in batch:
+                unique.setdefault(record["name"], record)
+
+            result = execute_query(
+                IMPORT_QUERY,
+                params=(json.dumps(list(unique.values())),),
+                return_data=True,
+                dbconfig=dbconfig
+                )
+            if result is False:
+                raise RuntimeError("Database error while importing secrets.")
+
+            return result[0][0]
+
+        # Only one batch of secrets is held in memory at a time
+        batch = []
+        records = decrypt_archive(stream.read, archive_password or password)
+        if reencrypt:
+            records = reencrypt_records(records, archive_password, password)
+
+        for record in records:
+            batch.append(record)
+
+            if len(batch) >= batch_size:
+                count = insert(batch)
+                imported += count
+                skipped += len(batch) - count
+                batch = []
+
+        if batch:
+            count = insert(batch)
+            imported += count
+            skipped += len(batch) - count
+
+    except ArchiveError as e:
+        logger.error(f"Invalid archive imported by user {username}. {e}")
+        audit_event("import_secrets", username, "invalid_archive")
+
+        return jsonify({
+            "error": "Invalid archive",
+            "message": f"{e} Imported {imported} secrets before the error.",
+            "imported": imported,
+            "skipped": skipped
+            }), 400
+
+    except Exception as e:
+        logger.error(f"Error occured while importing secrets for user {username}. {e}")
+        audit_event("import_secrets", username, "failure")
+
+        return jsonify({
+            "error": "Error occured while importing secrets",
+            "message": "Sorry, we could not import your secrets at this moment.",
+            "imported": imported,
+            "skipped": skipped
+            }), 400
+
+    finally:
+        if imported:
+            bump_secrets_version(username)
+
+    audit_event("import_secrets", username, "success")
+
+    return jsonify({
+        "message": "Imported secrets succesfully.",
+        "imported": imported,
+        "skipped": skipped
+        }), 200
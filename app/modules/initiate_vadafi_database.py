@@ -1,23 +1,100 @@
 # initiate_vadafi_database.py
 
-from tools.logger import vadafi_logger
-from tools.execute_query import execute_query
+from .tools.audit import maintain_audit_partitions
+from .tools.logger import vadafi_logger
+from .tools.execute_query import execute_query
+from .tools.authentication import get_admin_dbconfig
 
 logger = vadafi_logger()
 
 # Create user database
-query = """
-    CREATE TABLE vadafi_users (
+# Safe to run again, every statement only adds what is missing
+VADAFI_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS vadafi_users (
         user_id SERIAL PRIMARY KEY,
         username VARCHAR(255) UNIQUE NOT NULL,
         master_secret_hash TEXT NOT NULL,
         salt TEXT NOT NULL,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     );
+
+    -- Bumped on every change to the user's secrets, used for the ETag of /fetch_secrets
+    ALTER TABLE vadafi_users ADD COLUMN IF NOT EXISTS secrets_version BIGINT NOT NULL DEFAULT 0;
+
+    -- Queue of the background jobs
+    CREATE TABLE IF NOT EXISTS vadafi_jobs (
+        job_id SERIAL PRIMARY KEY,
+        kind VARCHAR(255) NOT NULL,
+        payload JSONB NOT NULL DEFAULT '{}',
+        status VARCHAR(20) NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 5,
+        run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS vadafi_jobs_queue_idx ON vadafi_jobs (run_after) WHERE status IN ('pending', 'running');
+
+    -- Responses of requests with an Idempotency-Key, replayed on retries
+    CREATE TABLE IF NOT EXISTS vadafi_idempotency (
+        endpoint VARCHAR(255) NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        idempotency_key VARCHAR(255) NOT NULL,
+        request_hash VARCHAR(64) NOT NULL,
+        status_code INTEGER,
+        response TEXT,
+        mimetype VARCHAR(255),
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (endpoint, username, idempotency_key)
+    );
+    CREATE INDEX IF NOT EXISTS vadafi_idempotency_created_at_idx ON vadafi_idempotency (created_at);
+
+    -- Append-only audit log, partitioned by month
+    CREATE TABLE IF NOT EXISTS vadafi_audit (
+        occurred_at TIMESTAMP NOT NULL,
+        event VARCHAR(50) NOT NULL,
+        username VARCHAR(255),
+        secret_name VARCHAR(255),
+        client VARCHAR(255),
+        outcome VARCHAR(50) NOT NULL
+    ) PARTITION BY RANGE (occurred_at);
+    CREATE TABLE IF NOT EXISTS vadafi_audit_default PARTITION OF vadafi_audit DEFAULT;
+    CREATE INDEX IF NOT EXISTS vadafi_audit_user_time_idx ON vadafi_audit (username, occurred_at);
+
+    CREATE OR REPLACE FUNCTION vadafi_audit_append_only() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'vadafi_audit is append-only';
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS vadafi_audit_append_only ON vadafi_audit;
+    CREATE TRIGGER vadafi_audit_append_only
+        BEFORE UPDATE OR DELETE ON vadafi_audit
+        FOR EACH ROW EXECUTE FUNCTION vadafi_audit_append_only();
     """
-try:
-    execute_query(query)
-    logger.info("Created table vadafi_users.")
 
-except Exception as e:
-    logger.error(f"Error occured while trying to initiate vadafi database: {e}")
+
+
+def initiate_vadafi_database():
+    """
+    Create or upgrade the vadafi database, run by `python vadafi.py init`.
+
+    Idempotent, so it is safe to run on every deploy.
+
+    Returns:
+        bool: True if the database is ready.
+    """
+    try:
+        if not execute_query(VADAFI_SCHEMA, dbconfig=get_admin_dbconfig(), sticky=False):
+            return False
+        logger.info("Created table vadafi_users.")
+
+        # Partitions of the coming months, so audit events skip the default partition
+        maintain_audit_partitions({})
+
+    except Exception as e:
+        logger.error(f"Error occured while trying to initiate vadafi database: {e}")
+        return False
+
+    return True
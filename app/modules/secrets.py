@@ -1,158 +1,340 @@
 # secrets.py
 
-from flask import jsonify
+from flask import Response, jsonify
 
-from .tools.encryption import encrypt_secret, decrypt_secret
+import base64
+
+from .tools.encryption import encrypt_secret, decrypt_secrets, derive_key, decrypt_with_key
 from .tools.execute_query import execute_query
+from .tools.jobs import enqueue_job, job_handler
 from .tools.logger import vadafi_logger
-from .tools.authentication import get_user_dbconfig
+from .tools.audit import audit_event
+from .tools.authentication import get_admin_dbconfig, get_user_dbconfig, get_user_id
+from .tools.secret_cache import get_secret_cache
+from .tools.settings import get_settings
+from .tools.tenant_schema import ensure_tenant_schema
 
 logger = vadafi_logger()
 
-def check_secret_availability(username, password, secret_name):
+def get_tenant_dbconfig(username, password):
+    """
+    Return the dbconfig of the user's database, making sure its schema is up to date.
     """
-    Check if secret_name is available in the user's secrets table.
+    dbconfig = get_user_dbconfig(username, password)
+    ensure_tenant_schema(dbconfig)
+
+    return dbconfig
+
+
+
+def get_secrets_version(username):
+    """
+    Get the change counter of the user's secrets.
+
+    Read from the primary, a stale counter would hide changes behind a 304.
+    """
+    result = execute_query(
+        "SELECT secrets_version FROM vadafi_users WHERE username = %s",
+        params=(username,),
+        return_data=True,
+        dbconfig=get_admin_dbconfig(),
+        read_only=False
+        )
+    if result:
+        return result[0][0]
+    else:
+        return None
+
+
+
+def bump_secrets_version(username):
+    """
+    Increase the change counter of the user's secrets after a change.
+
+    Not sticky, get_secrets_version always reads the primary anyway.
     """
+    execute_query(
+        "UPDATE vadafi_users SET secrets_version = secrets_version + 1 WHERE username = %s",
+        params=(username,),
+        dbconfig=get_admin_dbconfig(),
+        sticky=False
+        )
+
+
+
+def add_secret(username, password, secret_name, plain_text_secret, cached=False):
+    """
+    Encrypt and add secret to the database.
+
+    Args:
+        username (str): The user's username.
+        password (str): The user's password.
+        secret_name (str): The name of the secret.
+        plain_text_secret (str): The secret in clear text.
+        cached (bool): Keep the secret in the in-memory cache of hot secrets.
+    """
+
     try:
-        # Get the dbconfig
-        dbconfig = get_user_dbconfig(username, password)
+        # Create dbconfig
+        dbconfig = get_tenant_dbconfig(username, password)
+
+        # Encrypt the secret
+        secret_data = encrypt_secret(password, plain_text_secret)
 
         # Create the query
+        # The unique live name decides between parallel requests, a taken name inserts nothing
+        # The first version is stored in the history as well
         query = """
-        SELECT COUNT(*) FROM secrets WHERE name = %s
+        WITH created AS (
+            INSERT INTO secrets (name, secret, salt, iv, cached)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (name) WHERE deleted_at IS NULL DO NOTHING
+            RETURNING id, current_version, secret, salt, iv
+        ), versions AS (
+            INSERT INTO secret_versions (secret_id, version, secret, salt, iv)
+            SELECT id, current_version, secret, salt, iv FROM created
+            RETURNING 1
+        )
+        SELECT COUNT(*) FROM versions
         """
+
+        # Add the secret to the database
         result = execute_query(
             query,
-            params=(secret_name,),
+            params=(secret_name, secret_data["secret"], secret_data["salt"], secret_data["iv"], bool(cached)),
             return_data=True,
             dbconfig=dbconfig
-            )
-        if result[0][0] == 0:
-            return True
-        else:
-            return False
-    
+        )
+        if result is False:
+            raise RuntimeError("Database error while adding the secret.")
+
     except Exception as e:
-        logger.error(f"Error occured while checking secret name availability.")
-        return False
+        logger.error(f"Error occurred while trying to add secret {secret_name} for user {username}. {e}")
+        audit_event("add_secret", username, "failure", secret_name)
+
+        return jsonify({
+            "error": "Error occured while adding secret",
+            "message": "Sorry, we could not add your secret at this moment."
+        }), 400
 
+    if not result or result[0][0] == 0:
+        audit_event("add_secret", username, "unavailable", secret_name)
 
+        # Return secret name not valid
+        return jsonify({
+            "error": "Secret name not available",
+            "message": "Sorry, this secret name is not available."
+        }), 200
+
+    logger.info(f"Added secret {secret_name} for user {username}.")
+    get_secret_cache().invalidate(get_user_id(username), secret_name)
+
+    # Invalidate the cached secret lists, and the cached secret in the other workers
+    bump_secrets_version(username)
+    audit_event("add_secret", username, "success", secret_name)
+
+    return jsonify({
+        "message": "Secret created succesfully."
+    }), 200
 
-def check_secret_existance(username, password, secret_name):
+
+
+def update_secret(username, password, secret_name, plain_text_secret, cached=None):
     """
-    Check if secret exists in the user's secrets table.
+    Encrypt and store a new version of an existing secret.
+
+    Versions older than the retention are removed in the same statement.
+
+    Args:
+        username (str): The user's username.
+        password (str): The user's password.
+        secret_name (str): The name of the secret.
+        plain_text_secret (str): The new secret in clear text.
+        cached (bool): Keep the secret in the in-memory cache, unchanged if None.
     """
     try:
         # Get the dbconfig
-        dbconfig = get_user_dbconfig(username, password)
+        dbconfig = get_tenant_dbconfig(username, password)
+
+        # Encrypt the secret
+        secret_data = encrypt_secret(password, plain_text_secret)
+
+        # Keep this many versions, 0 keeps all of them
+        retention = get_settings().secret_version_retention
 
         # Create the query
+        # Point the secret at the new version and append it to the history
         query = """
-        SELECT COUNT(*) FROM secrets WHERE name = %s
+        WITH updated AS (
+            UPDATE secrets
+            SET secret = %s, salt = %s, iv = %s, current_version = current_version + 1,
+                cached = COALESCE(%s, cached)
+            WHERE name = %s AND deleted_at IS NULL
+            RETURNING id, current_version, secret, salt, iv
+        ), pruned AS (
+            DELETE FROM secret_versions v
+            USING updated u
+            WHERE %s > 0 AND v.secret_id = u.id AND v.version <= u.current_version - %s
+        )
+        INSERT INTO secret_versions (secret_id, version, secret, salt, iv)
+        SELECT id, current_version, secret, salt, iv FROM updated
+        RETURNING version
         """
         result = execute_query(
             query,
-            params=(secret_name,),
+            params=(secret_data["secret"], secret_data["salt"], secret_data["iv"], cached, secret_name, retention, retention),
             return_data=True,
             dbconfig=dbconfig
             )
-        if result[0][0] == 0:
-            return False
-        else:
-            return True
-    
+
+        if not result:
+            audit_event("update_secret", username, "not_found", secret_name)
+
+            # Return secret not found
+            return jsonify({
+                "error": "Secret not found",
+                "message": "Sorry, this secret could not be found."
+            }), 200
+
+        logger.info(f"Updated secret {secret_name} to version {result[0][0]} for user {username}.")
+        get_secret_cache().invalidate(get_user_id(username), secret_name)
+
+        # Invalidate the cached secret lists, and the cached secret in the other workers
+        bump_secrets_version(username)
+        audit_event("update_secret", username, "success", secret_name)
+
+        return jsonify({
+            "message": "Secret updated succesfully.",
+            "version": result[0][0]
+        }), 200
+
     except Exception as e:
-        logger.error(f"Error occured while checking secret existance. {e}")
-        return False
+        logger.error(f"Error occurred while trying to update secret {secret_name} for user {username}. {e}")
+        audit_event("update_secret", username, "failure", secret_name)
 
+        return jsonify({
+            "error": "Error occured while updating secret",
+            "message": "Sorry, we could not update your secret at this moment."
+        }), 400
 
 
-def add_secret(username, password, secret_name, plain_text_secret):
+
+def fetch_secret_versions(username, password, secret_name):
     """
-    Encrypt and add secret to the database.
+    Fetch the stored versions of a secret.
 
     Args:
         username (str): The user's username.
         password (str): The user's password.
         secret_name (str): The name of the secret.
-        plain_text_secret (str): The secret in clear text.
-    """
-
-    if check_secret_availability(username, password, secret_name):
-        pass
-    else:
-        # Return secret name not valid
-        return jsonify({
-            "error": "Secret name not available",
-            "message": "Sorry, this secret name is not available."
-        }), 200       
-
-
-    # Create dbconfig
-    dbconfig = get_user_dbconfig(username, password)
 
+    Return:
+        result (JSON): The versions, their creation time and the current version.
+    """
     try:
-        # Encrypt the secret
-        secret_data = encrypt_secret(password, plain_text_secret)
+        # Get the dbconfig
+        dbconfig = get_tenant_dbconfig(username, password)
 
         # Create the query
         query = """
-        INSERT INTO secrets (name, secret, salt, iv)
-        VALUES (%s, %s, %s, %s)
+        SELECT v.version, v.created_at, s.current_version
+        FROM secrets s
+        JOIN secret_versions v ON v.secret_id = s.id
+        WHERE s.name = %s AND s.deleted_at IS NULL
+        ORDER BY v.version DESC
         """
-
-        # Add the secret to the database
-        execute_query(
+        result = execute_query(
             query,
-            params=(secret_name, secret_data["secret"], secret_data["salt"], secret_data["iv"]),
+            params=(secret_name,),
+            return_data=True,
             dbconfig=dbconfig
-        )
-        logger.info(f"Added secret {secret_name} for user {username}.")
+            )
+
+        if not result:
+            audit_event("list_secret_versions", username, "not_found", secret_name)
+
+            # Return secret not found
+            return jsonify({
+                "error": "Secret not found",
+                "message": "Sorry, this secret could not be found."
+            }), 200
+
+        logger.info(f"Fetched versions of secret {secret_name} for user {username}.")
+        audit_event("list_secret_versions", username, "success", secret_name)
 
         return jsonify({
-            "message": "Secret created succesfully."
-        }), 200
+            "message": "Fetched secret versions succesfully.",
+            "current_version": result[0][2],
+            "data": [{"version": version, "created_at": created_at} for version, created_at, _ in result]
+            }), 200
 
     except Exception as e:
-        logger.error(f"Error occurred while trying to add secret {secret_name} for user {username}. {e}")
+        logger.error(f"Error occured while trying to fetch versions of secret {secret_name} for user {username}. {e}")
+        audit_event("list_secret_versions", username, "failure", secret_name)
 
         return jsonify({
-            "error": "Error occured while adding secret",
-            "message": "Sorry, we could not add your secret at this moment."
-        }), 400
+            "error": "Error occured while fetching secret versions",
+            "message": "Sorry, we could not fetch your secret versions at this moment."
+            }), 400
 
 
 
-def fetch_secrets(username, password):
+def fetch_secrets(username, password, if_none_match=None):
     """
     Fetch secrets in the user's secrets table.
 
     Args:
         username (str): The user's username.
         password (str): The user's password.
+        if_none_match (ETags): The ETags the client already has.
 
     Return:
         result (JSON): The user's secret_id's and secret_names.
     """
     try:
         # Get the dbconfig
-        dbconfig = get_user_dbconfig(username, password)
+        dbconfig = get_tenant_dbconfig(username, password)
+
+        # The ETag only changes when the user's secrets change
+        # Read it before the secrets so a concurrent change is never hidden
+        etag = f"{get_user_id(username)}-{get_secrets_version(username)}"
+
+        # Return not modified if the client already has this list
+        # Only after the password is verified by logging in to the user's database
+        if if_none_match is not None and if_none_match.contains_weak(etag):
+            if execute_query("SELECT 1", return_data=True, dbconfig=dbconfig) is False:
+                raise RuntimeError("Database error while verifying the password.")
+
+            audit_event("list_secrets", username, "not_modified")
+
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
 
         # Fetch secrets
+        # From the primary like the version, a lagging replica would store an old list under the new ETag
         result = execute_query(
-            f"SELECT id, name FROM secrets;", 
+            f"SELECT id, name FROM secrets WHERE deleted_at IS NULL;", 
             return_data=True,
-            dbconfig=dbconfig
+            dbconfig=dbconfig,
+            read_only=False
             )
+        if result is False:
+            raise RuntimeError("Database error while fetching secrets.")
         logger.info(f"Fetched secrets of user {username}.")
+        audit_event("list_secrets", username, "success")
 
-        return jsonify({
+        response = jsonify({
             "message": "Fetched secrets succesfully.",
-            "data": result
-            }), 200
+            "data": [{"id": secret_id, "name": name} for secret_id, name in result]
+            })
+        response.set_etag(etag, weak=True)
+
+        return response, 200
 
     except Exception as e:
         logger.error(f"Error occured while trying to fetch secrets for user {username}. {e}")
+        audit_event("list_secrets", username, "failure")
         
         return jsonify({
             "error": "Error occured while fetching secrets",
@@ -161,7 +343,7 @@ def fetch_secrets(username, password):
 
 
 
-def reveal_secret(username, password, secret_name):
+def reveal_secret(username, password, secret_name, version=None):
     """
     Reveal a secret.
 
@@ -169,43 +351,86 @@ def reveal_secret(username, password, secret_name):
         username (STR): The user's username.
         password (STR): The user's password.
         secret_name (STR): The to be revealed secret.
+        version (INT): The version to reveal, the current version if None.
 
     Returns:
         plain_text_secret (str): The revealed secret in plain text.
     """
     try:
+        # Serve hot secrets from the cache without touching the database
+        secret_cache = get_secret_cache()
+        user_id = get_user_id(username)
+
+        # Taken before the database is read, see SecretCache.put
+        generation = secret_cache.generation()
+
+        # Shared by every worker, a cached secret changed elsewhere is not served
+        secrets_version = None
+        if version is None and secret_cache.max_entries > 0:
+            secrets_version = get_secrets_version(username)
+
+        if version is None:
+            plain_text_secret = secret_cache.get(user_id, secret_name, password, secrets_version)
+
+            if plain_text_secret is not None:
+                audit_event("reveal_secret", username, "success", secret_name)
+
+                return jsonify({
+                    "message": "Revealed secret succesfully.",
+                    "data": plain_text_secret
+                    }), 200
+
         # Get the dbconfig
-        dbconfig = get_user_dbconfig(username, password)
+        dbconfig = get_tenant_dbconfig(username, password)
 
-        if check_secret_existance(username, password, secret_name):
-            pass
+        # Create the query
+        # The current version is a single lookup on the unique name index
+        if version is None:
+            query = """
+            SELECT secret, salt, iv, cached FROM secrets WHERE name = %s AND deleted_at IS NULL
+            """
+            params = (secret_name,)
         else:
-            # Return secret not found
-            return jsonify({
-                "error": "Secret not found",
-                "message": "Sorry, this secret could not be found."
-            }), 200
+            query = """
+            SELECT v.secret, v.salt, v.iv, FALSE
+            FROM secrets s
+            JOIN secret_versions v ON v.secret_id = s.id
+            WHERE s.name = %s AND s.deleted_at IS NULL AND v.version = %s
+            """
+            params = (secret_name, version)
 
-        # Create the query
-        query = """
-        SELECT secret, salt, iv FROM secrets WHERE name = %s
-        """
         result = execute_query(
             query,
-            params=(secret_name,),
+            params=params,
             return_data=True,
             dbconfig=dbconfig
             )
 
+        if not result:
+            audit_event("reveal_secret", username, "not_found", secret_name)
+
+            # Return secret not found
+            return jsonify({
+                "error": "Secret not found",
+                "message": "Sorry, this secret could not be found."
+            }), 200
+
         # Get the data
-        secret_data = {
-            'secret': result[0][0],
-            'salt': result[0][1],
-            'iv': result[0][2]
-            }
+        # Decode the values and turn them into bytes
+        secret = base64.b64decode(result[0][0])
+        salt = base64.b64decode(result[0][1])
+        iv = base64.b64decode(result[0][2])
+        cached = result[0][3]
 
         # Decrypt the secret
-        plain_text_secret = decrypt_secret(password, secret_data)
+        encryption_key = derive_key(password, salt)
+        plain_text_secret = decrypt_with_key(encryption_key, iv, secret)
+
+        # Keep the key material of opted-in secrets for the next reveal
+        if cached:
+            secret_cache.put(user_id, secret_name, password, encryption_key, iv, secret, generation, secrets_version)
+
+        audit_event("reveal_secret", username, "success", secret_name)
 
         return jsonify({
             "message": "Revealed secret succesfully.",
@@ -214,6 +439,7 @@ def reveal_secret(username, password, secret_name):
 
     except Exception as e:
         logger.error(f"Error occured while revealing secret {secret_name} for user {username}. {e}")
+        audit_event("reveal_secret", username, "failure", secret_name)
         
         return jsonify({
             "error": "Error occured while fetching secrets",
@@ -221,3 +447,259 @@ def reveal_secret(username, password, secret_name):
             }), 400
 
 
+
+def reveal_secrets(username, password, secret_names):
+    """
+    Reveal many secrets with a single query.
+
+    Args:
+        username (STR): The user's username.
+        password (STR): The user's password.
+        secret_names (LIST): The to be revealed secrets.
+
+    Returns:
+        result (JSON): The revealed secrets by name and the names that were not found.
+    """
+    try:
+        # Serve hot secrets from the cache without touching the database
+        secret_cache = get_secret_cache()
+        user_id = get_user_id(username)
+
+        # Taken before the database is read, see SecretCache.put
+        generation = secret_cache.generation()
+
+        # Shared by every worker, a cached secret changed elsewhere is not served
+        secrets_version = None
+        if secret_cache.max_entries > 0:
+            secrets_version = get_secrets_version(username)
+
+        revealed = {}
+        for secret_name in secret_names:
+            plain_text_secret = secret_cache.get(user_id, secret_name, password, secrets_version)
+            if plain_text_secret is not None:
+                revealed[secret_name] = plain_text_secret
+
+        remaining = [secret_name for secret_name in secret_names if secret_name not in revealed]
+
+        if remaining:
+            # Get the dbconfig
+            dbconfig = get_tenant_dbconfig(username, password)
+
+            # Fetch the other secrets at once
+            query = """
+            SELECT name, secret, salt, iv, cached FROM secrets WHERE name = ANY(%s) AND deleted_at IS NULL
+            """
+            result = execute_query(
+                query,
+                params=(remaining,),
+                return_data=True,
+                dbconfig=dbconfig
+                )
+            if result is False:
+                raise RuntimeError("Database error while revealing secrets.")
+
+            # Decrypt them together, the key derivations run in parallel
+            decrypted = decrypt_secrets(password, [
+                {"secret": secret, "salt": salt, "iv": iv} for _, secret, salt, iv, _ in result
+                ])
+
+            for (secret_name, secret, salt, iv, cached), (plain_text_secret, encryption_key) in zip(result, decrypted):
+                if plain_text_secret is None:
+                    raise RuntimeError(f"Could not decrypt secret {secret_name}.")
+                revealed[secret_name] = plain_text_secret
+
+                # Keep the key material of opted-in secrets for the next reveal
+                if cached:
+                    secret_cache.put(user_id, secret_name, password, encryption_key,
+                                     base64.b64decode(iv), base64.b64decode(secret), generation, secrets_version)
+
+        missing = [secret_name for secret_name in secret_names if secret_name not in revealed]
+
+        for secret_name in secret_names:
+            audit_event("reveal_secret", username, "not_found" if secret_name in missing else "success", secret_name)
+
+        return jsonify({
+            "message": "Revealed secrets succesfully.",
+            "data": revealed,
+            "missing": missing
+            }), 200
+
+    except Exception as e:
+        logger.error(f"Error occured while revealing secrets for user {username}. {e}")
+        audit_event("reveal_secrets", username, "failure")
+
+        return jsonify({
+            "error": "Error occured while fetching secrets",
+            "message": "Sorry, we could not fetch your secrets at this moment."
+            }), 400
+
+
+
+def delete_secrets(username, password, secret_names=None, prefix=None):
+    """
+    Delete secrets by name or by name prefix in a single statement.
+
+    Secrets are soft-deleted and disappear right away, they are purged from
+    the database in the background after the purge delay.
+
+    Args:
+        username (str): The user's username.
+        password (str): The user's password.
+        secret_names (list): The names of the secrets to delete.
+        prefix (str): Delete every secret whose name starts with prefix.
+
+    Returns:
+        deleted (list): The names of the deleted secrets.
+    """
+
+    # Get the dbconfig
+    dbconfig = get_tenant_dbconfig(username, password)
+
+    # Create the query
+    # Both variants use the partial indexes on the names of live secrets
+    if prefix is not None:
+        query = """
+        UPDATE secrets SET deleted_at = now()
+        WHERE name LIKE %s ESCAPE '\\' AND deleted_at IS NULL
+        RETURNING name
+        """
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        params = (escaped + '%',)
+    else:
+        query = """
+        UPDATE secrets SET deleted_at = now()
+        WHERE name = ANY(%s) AND deleted_at IS NULL
+        RETURNING name
+        """
+        params = (list(secret_names),)
+
+    result = execute_query(
+        query,
+        params=params,
+        return_data=True,
+        dbconfig=dbconfig
+        )
+    if result is False:
+        raise RuntimeError("Database error while deleting secrets.")
+
+    deleted = [name for (name,) in result]
+    if not deleted:
+        return deleted
+
+    logger.info(f"Deleted {len(deleted)} secrets for user {username}.")
+
+    # Drop the deleted secrets from the caches
+    user_id = get_user_id(username)
+    secret_cache = get_secret_cache()
+    for name in deleted:
+        secret_cache.invalidate(user_id, name)
+        audit_event("delete_secret", username, "success", name)
+    bump_secrets_version(username)
+
+    # Purge them for good once the delay has passed
+    enqueue_job(
+        "purge_deleted_secrets",
+        {"user_id": user_id},
+        delay=get_settings().secret_purge_delay,
+        unique=True
+        )
+
+    return deleted
+
+
+
+def delete_secret(username, password, secret_name):
+    """
+    Delete a secret.
+
+    Args:
+        username (str): The user's username.
+        password (str): The user's password.
+        secret_name (str): The name of the secret.
+    """
+    try:
+        deleted = delete_secrets(username, password, secret_names=[secret_name])
+
+        if not deleted:
+            audit_event("delete_secret", username, "not_found", secret_name)
+
+            # Return secret not found
+            return jsonify({
+                "error": "Secret not found",
+                "message": "Sorry, this secret could not be found."
+            }), 200
+
+        return jsonify({
+            "message": "Secret deleted succesfully."
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error occured while deleting secret {secret_name} for user {username}. {e}")
+        audit_event("delete_secret", username, "failure", secret_name)
+
+        return jsonify({
+            "error": "Error occured while deleting secret",
+            "message": "Sorry, we could not delete your secret at this moment."
+        }), 400
+
+
+
+def bulk_delete_secrets(username, password, secret_names=None, prefix=None):
+    """
+    Delete many secrets at once, by name or by name prefix.
+
+    Args:
+        username (str): The user's username.
+        password (str): The user's password.
+        secret_names (list): The names of the secrets to delete.
+        prefix (str): Delete every secret whose name starts with prefix.
+    """
+    try:
+        deleted = delete_secrets(username, password, secret_names, prefix)
+
+        return jsonify({
+            "message": f"Deleted {len(deleted)} secrets succesfully.",
+            "data": deleted
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error occured while deleting secrets for user {username}. {e}")
+        audit_event("delete_secrets", username, "failure")
+
+        return jsonify({
+            "error": "Error occured while deleting secrets",
+            "message": "Sorry, we could not delete your secrets at this moment."
+        }), 400
+
+
+
+@job_handler("purge_deleted_secrets", concurrency=2)
+def purge_deleted_secrets(payload):
+    """
+    Remove soft-deleted secrets and their versions once the purge delay has passed.
+    """
+    user_id = payload["user_id"]
+    dbconfig = get_admin_dbconfig(f"db_{user_id}")
+    purge_delay = get_settings().secret_purge_delay
+
+    # The versions go with the secret
+    result = execute_query(
+        """
+        WITH purged AS (
+            DELETE FROM secrets
+            WHERE deleted_at IS NOT NULL AND deleted_at <= now() - make_interval(secs => %s)
+        )
+        SELECT EXTRACT(EPOCH FROM MIN(deleted_at) + make_interval(secs => %s) - now())
+        FROM secrets
+        WHERE deleted_at IS NOT NULL AND deleted_at > now() - make_interval(secs => %s)
+        """,
+        params=(purge_delay, purge_delay, purge_delay),
+        return_data=True,
+        dbconfig=dbconfig
+        )
+    if result is False:
+        raise RuntimeError(f"Database error while purging secrets of db_{user_id}.")
+
+    # Come back for secrets deleted after this job was queued
+    if result[0][0] is not None:
+        enqueue_job("purge_deleted_secrets", {"user_id": user_id}, delay=max(0, result[0][0]))
@@ -0,0 +1,103 @@
+# status.py
+
+import hmac
+
+from flask import jsonify, request
+
+from .tools.audit import get_audit_log
+from .tools.authentication import get_admin_dbconfig
+from .tools.crypto_executor import get_crypto_executor
+from .tools.execute_query import execute_query
+from .tools.jobs import get_scheduler, queue_depth
+from .tools.logger import vadafi_logger
+from .tools.pool import pool_stats
+from .tools.secret_cache import get_secret_cache
+from .tools.settings import get_settings
+logger = vadafi_logger()
+
+
+def check_readiness():
+    """
+    Check if this instance can take traffic.
+
+    Only the admin database (through its pool) and the crypto executor are
+    checked, the users' databases are never touched.
+
+    Returns:
+        tuple: The checks as JSON and 200, or 503 if the instance is not ready.
+    """
+    checks = {}
+
+    # The admin database, on the primary
+    try:
+        database_ok = bool(execute_query(
+            "SELECT 1",
+            return_data=True,
+            dbconfig=get_admin_dbconfig(),
+            read_only=False
+            ))
+    except Exception as e:
+        logger.error(f"Readiness check could not reach the vadafi database. {e}")
+        database_ok = False
+
+    checks["database"] = "ok" if database_ok else "unreachable"
+
+    # Key derivations are queueing up, new requests would time out
+    checks["crypto"] = "saturated" if get_crypto_executor().saturated() else "ok"
+
+    ready = all(check == "ok" for check in checks.values())
+
+    return jsonify({
+        "status": "ready" if ready else "not ready",
+        "checks": checks
+    }), 200 if ready else 503
+
+
+
+def status_allowed():
+    """
+    Check if the request may read /status.
+
+    With STATUS_TOKEN set the request needs it as a bearer token, without it
+    only requests from this host are allowed.
+    """
+    token = get_settings().status_token
+
+    if token:
+        supplied = request.headers.get('Authorization', '')
+        return hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode())
+
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+
+
+def get_status():
+    """
+    Return the load of this instance: pool utilisation, job queue depth and cache sizes.
+
+    Returns:
+        tuple: The status as JSON and 200, or 401 without the status token.
+    """
+    if not status_allowed():
+        return jsonify({
+            "error": "Unauthorized",
+            "message": "A valid status token is required."
+        }), 401
+
+    # The queue lives in the vadafi database, report the rest if it is unreachable
+    try:
+        jobs = queue_depth()
+    except Exception as e:
+        logger.error(f"Error occured while reading the job queue depth. {e}")
+        jobs = None
+
+    return jsonify({
+        "pools": pool_stats(),
+        "crypto": get_crypto_executor().stats(),
+        "jobs": {
+            "queue": jobs,
+            "running_here": get_scheduler().stats(),
+        },
+        "secret_cache": get_secret_cache().stats(),
+        "audit": get_audit_log().stats(),
+    }), 200
@@ -0,0 +1,163 @@
+# archive.py
+
+import json
+import os
+
+from .encryption import derive_key, new_aesgcm
+from .logger import vadafi_logger
+
+logger = vadafi_logger()
+
+# Layout of an archive:
+#   MAGIC | salt (16 bytes) | nonce prefix (8 bytes) | frame | frame | ...
+# Every frame is:
+#   length of the ciphertext (4 bytes) | final flag (1 byte) | ciphertext
+# The plain text is JSON lines, one record per line, cut into frames of at most
+# CHUNK_SIZE bytes, so a large record spans several frames. A frame's nonce is the nonce
+# prefix followed by the frame number and its final flag is authenticated, so
+# reordered, dropped or truncated frames fail to decrypt.
+MAGIC = b"VADAFI\x00\x01"
+SALT_SIZE = 16
+NONCE_PREFIX_SIZE = 8
+CHUNK_SIZE = 64 * 1024
+
+# Frames larger than this are rejected before reading them
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# AES-GCM adds a 16 byte tag to every frame
+TAG_SIZE = 16
+
+
+class ArchiveError(Exception):
+    """
+    Raised when an archive is corrupt, truncated or encrypted with another password.
+    """
+
+
+
+def encrypt_archive(records, password, chunk_size=CHUNK_SIZE):
+    """
+    Encrypt a stream of records into an archive, chunk by chunk.
+
+    Only one chunk is held in memory at a time. Records larger than a chunk
+    are split over several frames, so no frame exceeds MAX_FRAME_SIZE.
+
+    Args:
+        records (iterable): The records, dicts that can be serialized to JSON.
+        password (str): The password of the archive.
+        chunk_size (int): Plain text bytes per frame.
+
+    Yields:
+        bytes: The archive, the header first and then one frame at a time.
+    """
+    # decrypt_archive refuses larger frames, never write one
+    if not 0 < chunk_size <= MAX_FRAME_SIZE - TAG_SIZE:
+        raise ValueError(f"chunk_size must be between 1 and {MAX_FRAME_SIZE - TAG_SIZE}.")
+
+    salt = os.urandom(SALT_SIZE)
+    nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+
+    # A single key derivation for the whole archive
+    aesgcm = new_aesgcm(derive_key(password, salt))
+
+    yield MAGIC + salt + nonce_prefix
+
+    index = 0
+    chunk = bytearray()
+
+    for record in records:
+        chunk += json.dumps(record, separators=(',', ':')).encode() + b"\n"
+
+        while len(chunk) >= chunk_size:
+            yield _encrypt_frame(aesgcm, nonce_prefix, index, bytes(chunk[:chunk_size]), final=False)
+            index += 1
+            del chunk[:chunk_size]
+
+    # The final frame marks the end, it may be empty
+    yield _encrypt_frame(aesgcm, nonce_prefix, index, bytes(chunk), final=True)
+
+
+
+def decrypt_archive(read, password):
+    """
+    Decrypt an archive, frame by frame.
+
+    Args:
+        read (callable): Reads up to n bytes of the archive, like file.read.
+        password (str): The password of the archive.
+
+    Yields:
+        dict: The records, in order.
+
+    Raises:
+        ArchiveError: If the archive is corrupt, truncated or the password is wrong.
+    """
+    header = _read_exact(read, len(MAGIC) + SALT_SIZE + NONCE_PREFIX_SIZE)
+    if not header.startswith(MAGIC):
+        raise ArchiveError("Not a vadafi archive.")
+
+    salt = header[len(MAGIC):len(MAGIC) + SALT_SIZE]
+    nonce_prefix = header[len(MAGIC) + SALT_SIZE:]
+    aesgcm = new_aesgcm(derive_key(password, salt))
+
+    index = 0
+    # The start of a record that continues in the next frame
+    pending = b""
+
+    while True:
+        frame_header = _read_exact(read, 5)
+        length = int.from_bytes(frame_header[:4], 'big')
+        final = frame_header[4]
+
+        if length > MAX_FRAME_SIZE or final not in (0, 1):
+            raise ArchiveError("Corrupt archive frame.")
+
+        ciphertext = _read_exact(read, length)
+
+        try:
+            chunk = aesgcm.decrypt(_nonce(nonce_prefix, index), ciphertext, bytes([final]))
+        except Exception:
+            raise ArchiveError("Wrong password or corrupt archive.")
+
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+
+        for line in lines:
+            yield json.loads(line)
+
+        if final:
+            break
+        index += 1
+
+    # Every record ends with a newline, anything left was cut off
+    if pending:
+        raise ArchiveError("Truncated archive record.")
+
+    if read(1):
+        raise ArchiveError("Unexpected data after the end of the archive.")
+
+
+
+def _nonce(nonce_prefix, index):
+    return nonce_prefix + index.to_bytes(4, 'big')
+
+
+
+def _encrypt_frame(aesgcm, nonce_prefix, index, chunk, final):
+    ciphertext = aesgcm.encrypt(_nonce(nonce_prefix, index), chunk, bytes([final]))
+
+    return len(ciphertext).to_bytes(4, 'big') + bytes([final]) + ciphertext
+
+
+
+def _read_exact(read, size):
+    # Streams may return less than asked for
+    data = bytearray()
+
+    while len(data) < size:
+        part = read(size - len(data))
+        if not part:
+            raise ArchiveError("Truncated archive.")
+        data += part
+
+    return bytes(data)
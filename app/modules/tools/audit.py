@@ -0,0 +1,328 @@
+# audit.py
+
+import atexit
+import datetime
+import threading
+
+from collections import deque
+from flask import has_request_context, request
+
+from .authentication import get_admin_dbconfig
+from .execute_query import execute_batch_insert, execute_query
+from .jobs import job_handler
+from .logger import vadafi_logger
+from .settings import get_settings
+
+logger = vadafi_logger()
+
+AUDIT_INSERT = """
+INSERT INTO vadafi_audit (occurred_at, event, username, secret_name, client, outcome)
+VALUES %s
+"""
+
+
+def utc_now():
+    """
+    Return the current UTC time without tzinfo, like occurred_at is stored.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+
+def month_start(moment, offset=0):
+    """
+    Return the first moment of the month of moment, offset months later.
+    """
+    month = moment.year * 12 + moment.month - 1 + offset
+    return datetime.datetime(month // 12, month % 12 + 1, 1)
+
+
+
+def create_audit_partition(month):
+    """
+    Create the partition of vadafi_audit for the month starting at month.
+
+    Events of the month that already landed in the default partition are
+    moved into the new partition, Postgres refuses to attach it otherwise.
+
+    Returns:
+        bool: True if the partition exists.
+    """
+    next_month = month_start(month, 1)
+    partition = f"vadafi_audit_{month:%Y_%m}"
+    bounds = f"FROM ('{month:%Y-%m-%d}') TO ('{next_month:%Y-%m-%d}')"
+    dbconfig = get_admin_dbconfig()
+
+    stranded = execute_query(
+        "SELECT EXISTS (SELECT 1 FROM vadafi_audit_default WHERE occurred_at >= %s AND occurred_at < %s)",
+        params=(month, next_month),
+        return_data=True,
+        dbconfig=dbconfig,
+        read_only=False
+        )
+    if stranded is False:
+        return False
+
+    if not stranded[0][0]:
+        return execute_query(
+            f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF vadafi_audit FOR VALUES {bounds}",
+            dbconfig=dbconfig,
+            sticky=False
+            ) is not False
+
+    # Move the rows in one transaction, with the default partition detached
+    # TRUNCATE does not fire the append-only trigger, the rows of other months are put back
+    moved = execute_query(
+        f"""
+        CREATE TABLE {partition} (LIKE vadafi_audit INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+        ALTER TABLE vadafi_audit DETACH PARTITION vadafi_audit_default;
+        INSERT INTO {partition}
+        SELECT * FROM vadafi_audit_default WHERE occurred_at >= '{month:%Y-%m-%d}' AND occurred_at < '{next_month:%Y-%m-%d}';
+        CREATE TEMP TABLE vadafi_audit_keep ON COMMIT DROP AS
+        SELECT * FROM vadafi_audit_default WHERE NOT (occurred_at >= '{month:%Y-%m-%d}' AND occurred_at < '{next_month:%Y-%m-%d}');
+        TRUNCATE vadafi_audit_default;
+        INSERT INTO vadafi_audit_default SELECT * FROM vadafi_audit_keep;
+        ALTER TABLE vadafi_audit ATTACH PARTITION {partition} FOR VALUES {bounds};
+        ALTER TABLE vadafi_audit ATTACH PARTITION vadafi_audit_default DEFAULT;
+        """,
+        dbconfig=dbconfig,
+        sticky=False
+        )
+    if moved is False:
+        return False
+
+    logger.info(f"Moved the events of {month:%Y-%m} from the default audit partition to {partition}.")
+    return True
+
+
+
+class AuditLog:
+    """
+    Buffer audit events in memory and write them to vadafi_audit in batches.
+
+    Events are flushed every flush_interval seconds or as soon as batch_size
+    events are waiting. If the database is unreachable the buffer keeps at most
+    max_buffer events, older events are dropped and counted.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=1, max_buffer=100_000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+
+        self.flushed = 0
+        self.dropped = 0
+
+        self._buffer = deque()
+        self._partitions = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def record(self, event, username, outcome, secret_name=None):
+        """
+        Add an event to the buffer.
+
+        Args:
+            event (str): What happened, e.g. reveal_secret.
+            username (str): The user the event is about.
+            outcome (str): success, failure, not_found, ...
+            secret_name (str): The secret the event is about.
+        """
+        client = request.remote_addr if has_request_context() else None
+        row = (utc_now(), event, username, secret_name, client, outcome)
+
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                self._buffer.popleft()
+                self.dropped += 1
+
+            self._buffer.append(row)
+            full = len(self._buffer) >= self.batch_size
+
+        self._start()
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """
+        Write the buffered events, batch by batch.
+        """
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    rows = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+
+                if not rows:
+                    return
+
+                # Make sure every month in the batch has a partition
+                # Rows without one end up in the default partition, only created partitions are remembered
+                for month in {month_start(row[0]) for row in rows} - self._partitions:
+                    try:
+                        if create_audit_partition(month):
+                            self._partitions.add(month)
+                        else:
+                            logger.error(f"Could not create audit partition {month:%Y_%m}, retrying on the next flush.")
+                    except Exception as e:
+                        logger.error(f"Error occured while creating audit partition {month:%Y_%m}. {e}")
+
+                try:
+                    execute_batch_insert(AUDIT_INSERT, rows, dbconfig=get_admin_dbconfig(), page_size=self.batch_size)
+                    self.flushed += len(rows)
+
+                except Exception as e:
+                    logger.error(f"Error occured while writing {len(rows)} audit events, retrying later. {e}")
+
+                    # Put the events back in front, in order
+                    with self._lock:
+                        self._buffer.extendleft(reversed(rows))
+                        while len(self._buffer) > self.max_buffer:
+                            self._buffer.pop()
+                            self.dropped += 1
+                    return
+
+    def stats(self):
+        """
+        Return the counters of the audit log.
+        """
+        with self._lock:
+            return {
+                "buffered": len(self._buffer),
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+            }
+
+    def _start(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._thread = threading.Thread(target=self._run, name="vadafi-audit", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+
+def get_audit_log():
+    """
+    Return the audit log, creating it from the settings on first use.
+    """
+    global _audit_log
+
+    if _audit_log is None:
+        with _audit_log_lock:
+            if _audit_log is None:
+                settings = get_settings()
+
+                _audit_log = AuditLog(
+                    batch_size=settings.audit_batch_size,
+                    flush_interval=settings.audit_flush_interval,
+                    max_buffer=settings.audit_max_buffer,
+                )
+
+    return _audit_log
+
+
+
+def audit_event(event, username, outcome, secret_name=None):
+    """
+    Record an audit event, see AuditLog.record.
+    """
+    get_audit_log().record(event, username, outcome, secret_name)
+
+
+
+def fetch_audit_events(username, start, end, limit=1000):
+    """
+    Fetch the audit events of a user in a time range, newest first.
+
+    Args:
+        username (str): The user's username.
+        start (datetime): Start of the range, inclusive.
+        end (datetime): End of the range, exclusive.
+        limit (int): Maximum number of events.
+
+    Returns:
+        list: The events as dicts.
+    """
+
+    # Only the partitions in the range are scanned, using the username and time index
+    query = """
+    SELECT occurred_at, event, secret_name, client, outcome
+    FROM vadafi_audit
+    WHERE username = %s AND occurred_at >= %s AND occurred_at < %s
+    ORDER BY occurred_at DESC
+    LIMIT %s
+    """
+    result = execute_query(
+        query,
+        params=(username, start, end, limit),
+        return_data=True,
+        dbconfig=get_admin_dbconfig()
+        )
+
+    return [
+        {
+            "occurred_at": occurred_at,
+            "event": event,
+            "secret_name": secret_name,
+            "client": client,
+            "outcome": outcome,
+        }
+        for occurred_at, event, secret_name, client, outcome in result
+        ]
+
+
+
+@job_handler("maintain_audit_partitions", concurrency=1, every=24 * 60 * 60)
+def maintain_audit_partitions(payload):
+    """
+    Create the partitions of the coming months and drop the ones past the retention.
+
+    Dropping a whole partition is the only way rows leave the append-only table.
+    """
+    now = utc_now()
+
+    for offset in range(3):
+        month = month_start(now, offset)
+        if not create_audit_partition(month):
+            raise RuntimeError(f"Could not create audit partition {month:%Y_%m}.")
+
+    retention_days = get_settings().audit_retention_days
+    if not retention_days:
+        return
+
+    # Drop partitions that end before the cutoff
+    cutoff = now - datetime.timedelta(days=retention_days)
+    result = execute_query(
+        """
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'vadafi_audit' AND c.relname ~ '^vadafi_audit_[0-9]{4}_[0-9]{2}$'
+        """,
+        return_data=True,
+        dbconfig=get_admin_dbconfig(),
+        read_only=False
+        )
+
+    for (partition,) in result:
+        month = datetime.datetime.strptime(partition[len("vadafi_audit_"):], "%Y_%m")
+        if month_start(month, 1) <= cutoff:
+            execute_query(f"DROP TABLE IF EXISTS {partition}", dbconfig=get_admin_dbconfig(), sticky=False)
+            logger.info(f"Dropped audit partition {partition}.")
+
+
+_audit_log = None
+_audit_log_lock = threading.Lock()
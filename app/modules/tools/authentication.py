@@ -1,18 +1,29 @@
 # authentication.py
 
-import os
 import base64
+import threading
 
-from pathlib import Path
-from dotenv import load_dotenv
+from collections import OrderedDict
 from flask import jsonify
 
 from .execute_query import execute_query
 from .encryption import hash_secret
 from .logger import vadafi_logger
+from .settings import get_settings, on_reload
 
 logger = vadafi_logger()
 
+# dbconfigs are built once and reused, they are cleared when the settings reload
+_admin_dbconfigs = {}
+_user_dbconfigs = {}
+
+# User ids never change, so they are safe to remember
+# Least recently used ids are forgotten beyond USER_ID_CACHE_SIZE usernames
+USER_ID_CACHE_SIZE = 10_000
+_user_ids = OrderedDict()
+_user_ids_lock = threading.Lock()
+
+
 def get_admin_dbconfig(dbname="vadafi"): 
     """
     Return dbconfig for the vadafi-admin user.
@@ -21,22 +32,23 @@ def get_admin_dbconfig(dbname="vadafi"):
         dbname (STR): Name of database to login to.
 
     Returns:
-        dbconfig (dict)
+        dbconfig (dict): Shared between callers, do not modify.
     """
 
-    # Load the .env file into the environment variables
-    env_path = Path('.env')
-    load_dotenv(env_path)
+    dbconfig = _admin_dbconfigs.get(dbname)
+    if dbconfig is None:
+        settings = get_settings()
+
+        # Put the credentials into the dbconfig dict
+        dbconfig = {
+        'dbname': dbname,
+        'user': settings.db_user,
+        'password': settings.db_password,
+        'host': settings.db_host,
+        'port': settings.db_port
+            }
+        _admin_dbconfigs[dbname] = dbconfig
 
-    # Put the credentials into the dbconfig dict
-    dbconfig = {
-    'dbname': dbname,
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD'),
-    'host': os.getenv('DB_HOST'),
-    'port': os.getenv('DB_PORT')
-        }
-   
     return dbconfig
 
 
@@ -53,25 +65,44 @@ def get_user_dbconfig(username, password):
         dbconfig (dict)
     """    
  
-    # Load the .env file into the environment variables
-    env_path = Path('.env')
-    load_dotenv(env_path)
-
     # Get the user's db_name & db_user_name
     user_id = get_user_id(username)
-    db_name = f"db_{user_id}"
-    db_user_name = f"user_{user_id}"
-
-    # Put the credentials into the dbconfig dict
-    dbconfig = {
-    'dbname': db_name,
-    'user': db_user_name,
-    'password': password,
-    'host': os.getenv('DB_HOST'),
-    'port': os.getenv('DB_PORT')
-        }
-   
-    return dbconfig
+
+    base_dbconfig = _user_dbconfigs.get(user_id)
+    if base_dbconfig is None:
+        settings = get_settings()
+
+        # Put the credentials into the dbconfig dict
+        base_dbconfig = {
+        'dbname': f"db_{user_id}",
+        'user': f"user_{user_id}",
+        'host': settings.db_host,
+        'port': settings.db_port
+            }
+        _user_dbconfigs[user_id] = base_dbconfig
+
+    # The password is never cached
+    return dict(base_dbconfig, password=password)
+
+
+
+def read_user(query, username, dbconfig):
+    """
+    Read the row of a user from vadafi_users, from a replica if possible.
+
+    Creating a user does not stick the reads of the vadafi database to the
+    primary, that would send every login there. A user missing on a replica
+    may just not have replicated yet, so a miss is read again on the primary.
+
+    Returns:
+        list: The rows, False on a database error.
+    """
+    result = execute_query(query, params=(username,), return_data=True, dbconfig=dbconfig)
+
+    if result == [] and get_settings().db_read_replicas:
+        result = execute_query(query, params=(username,), return_data=True, dbconfig=dbconfig, read_only=False)
+
+    return result
 
 
 
@@ -80,6 +111,11 @@ def get_user_id(username):
     Get the unique identifier of a user.
     """
 
+    with _user_ids_lock:
+        if username in _user_ids:
+            _user_ids.move_to_end(username)
+            return _user_ids[username]
+
     # Get the dbconfig
     dbconfig = get_admin_dbconfig()    
 
@@ -89,35 +125,62 @@ def get_user_id(username):
     """
 
     # Get the user_id
-    result = execute_query(
-       query,
-       params=(username, ),
-       return_data=True,
-       dbconfig=dbconfig
-        )
+    result = read_user(query, username, dbconfig)
     if result:
+        with _user_ids_lock:
+            _user_ids[username] = result[0][0]
+            while len(_user_ids) > USER_ID_CACHE_SIZE:
+                _user_ids.popitem(last=False)
+
         return result[0][0]
     else:
         return None
 
 
 
+def forget_user_id(username):
+    """
+    Drop the cached user_id of a username, after the user was removed.
+    """
+    with _user_ids_lock:
+        user_id = _user_ids.pop(username, None)
+    if user_id is not None:
+        _user_dbconfigs.pop(user_id, None)
+
+
+
+@on_reload
+def clear_dbconfigs(settings):
+    """
+    Forget the cached dbconfigs and user ids so they are read again with the reloaded settings.
+    """
+    global _user_ids
+
+    _admin_dbconfigs.clear()
+    _user_dbconfigs.clear()
+
+    # The settings may point at another database
+    # Plain assignment, this runs from the SIGHUP handler and may interrupt get_user_id holding the lock
+    _user_ids = OrderedDict()
+
+
+
 def user_exists(username):
     """
     Check if the user exits by querying the vadafi_users table
+
+    Returns None if the database could not be queried.
     """
     # Get the dbconfig
     dbconfig = get_admin_dbconfig()
 
     try:
         # Check if username exists
-        result = execute_query(
-                "SELECT 1 FROM vadafi_users WHERE username = %s", 
-                params=(username,),
-                return_data=True,
-                dbconfig=dbconfig
-            )
+        result = read_user("SELECT 1 FROM vadafi_users WHERE username = %s", username, dbconfig)
         
+        if result is False:
+            raise RuntimeError("Database error while checking the user.")
+
         if result:
             logger.info(f"User {username} exists.")
             return True
@@ -126,14 +189,17 @@ def user_exists(username):
             return False
 
     except Exception as e:
+        # Not a wrong username, the caller must not count it as a failed login
         logger.error(f"Error occured checking user: {username}'s existence. {e}")
-        return False
+        return None
 
 
 
 def check_password(password, username):
     """
     Hash password and match it with the one in the database
+
+    Returns None if the database could not be queried.
     """
 
     # Get the dbconfig
@@ -141,12 +207,7 @@ def check_password(password, username):
 
     try:
         # Get the salt and iv of the user
-        result = execute_query(
-            "SELECT salt, master_secret_hash FROM vadafi_users WHERE username = %s",
-            params=(username,),
-            return_data=True,
-            dbconfig=dbconfig
-            )
+        result = read_user("SELECT salt, master_secret_hash FROM vadafi_users WHERE username = %s", username, dbconfig)
         
         # Get the data
         # Decode the salt and turn it into bytes
@@ -163,7 +224,22 @@ def check_password(password, username):
             return False
         
     except Exception as e:
+        # Not a wrong password, the caller must not count it as a failed login
         logger.error(f"Error occured checking user: {username}'s password. {e}")
+        return None
+
+
+
+def unavailable():
+    """
+    Answer a login that could not be checked, it is not a failed login.
+    """
+    response = jsonify({
+        "error": "Service unavailable",
+        "message": "Sorry, we could not check your credentials at this moment."
+    })
+    response.headers['Retry-After'] = "1"
+    return response, 503
 
 
 
@@ -192,7 +268,11 @@ def authenticate_user(data):
     password = data['password']
     
     # Check if user exists in vadafi-users database
-    if not user_exists(username):
+    exists = user_exists(username)
+    if exists is None:
+        return unavailable()
+
+    if not exists:
         
         # Return unauthorized if user does not exist
         return jsonify({
@@ -201,7 +281,11 @@ def authenticate_user(data):
         }), 401
 
     # Check if password is correct
-    if not check_password(password, username):
+    correct = check_password(password, username)
+    if correct is None:
+        return unavailable()
+
+    if not correct:
         
         # Return unauthorized if password is wrong
         return jsonify({
@@ -0,0 +1,52 @@
+# compression.py
+
+import gzip
+
+from flask import request
+
+from .settings import get_settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def compress_response(response):
+    """
+    Compress the response with brotli or gzip if the client accepts it and it is large enough.
+    """
+    settings = get_settings()
+
+    # Leave streamed, empty, error and already encoded responses alone
+    if (response.direct_passthrough
+            or response.is_streamed
+            or not 200 <= response.status_code < 300
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    data = response.get_data()
+    if len(data) < settings.compress_min_size:
+        return response
+
+    accept_encodings = request.accept_encodings
+
+    if brotli is not None and accept_encodings['br']:
+        response.set_data(brotli.compress(data, quality=settings.compress_level))
+        response.headers['Content-Encoding'] = 'br'
+
+    elif accept_encodings['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=settings.compress_level))
+        response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+
+
+def init_compression(app):
+    """
+    Compress the responses of the app.
+    """
+    app.after_request(compress_response)
@@ -0,0 +1,166 @@
+# crypto_executor.py
+
+import itertools
+import os
+import threading
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .logger import vadafi_logger
+from .settings import get_settings, on_reload
+
+logger = vadafi_logger()
+
+
+class CryptoExecutor:
+    """
+    Run the CPU-heavy crypto, the key derivations, on a bounded pool of threads.
+
+    Request threads hand their derivations to the pool and wait for the
+    result, so at most workers derivations run at once no matter how many
+    requests come in. Work beyond that queues up, once more than max_queue
+    derivations are waiting the executor is saturated and /readyz reports the
+    instance as not ready. Batches go through map, which keeps only a few
+    of their derivations queued at a time.
+    """
+
+    def __init__(self, workers=None, max_queue=32):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+
+        self.completed = 0
+        self._pending = 0
+        self._shut_down = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="vadafi-crypto")
+
+    def run(self, function, *args):
+        """
+        Run function(*args) on the pool and return its result.
+        """
+        return self.submit(function, *args).result()
+
+    def submit(self, function, *args):
+        """
+        Queue function(*args) on the pool.
+
+        Returns:
+            future (Future): The pending result.
+        """
+        # Checked under the lock, shutdown can not slip in between
+        with self._lock:
+            if self._shut_down:
+                future = None
+            else:
+                self._pending += 1
+                future = self._executor.submit(function, *args)
+
+        # Retired by a reload, a batch that is still running continues on the current executor
+        if future is None:
+            return get_crypto_executor().submit(function, *args)
+
+        future.add_done_callback(self._done)
+
+        return future
+
+    def map(self, function, arguments):
+        """
+        Run function(*args) on the pool for every args and return the results, in order.
+
+        At most workers calls of one map are queued at a time, so a large
+        batch takes turns with the derivations of other requests instead of
+        filling the queue and saturating the executor.
+
+        Args:
+            function (callable): The function to run.
+            arguments (iterable): A tuple of arguments per call.
+
+        Returns:
+            results (list): The result of every call.
+        """
+        arguments = iter(arguments)
+        results = []
+
+        window = deque(self.submit(function, *args) for args in itertools.islice(arguments, self.workers))
+        for args in arguments:
+            results.append(window.popleft().result())
+            window.append(self.submit(function, *args))
+
+        results.extend(future.result() for future in window)
+        return results
+
+    def saturated(self):
+        """
+        Check if more work is waiting than the pool should queue.
+        """
+        with self._lock:
+            return self._pending - self.workers > self.max_queue
+
+    def stats(self):
+        """
+        Return the size and load of the pool.
+        """
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "running": min(self._pending, self.workers),
+                "queued": max(self._pending - self.workers, 0),
+                "max_queue": self.max_queue,
+                "completed": self.completed,
+                "saturated": self._pending - self.workers > self.max_queue,
+            }
+
+    def shutdown(self):
+        """
+        Stop the threads once the queued work is done.
+
+        Work submitted afterwards goes to the current executor.
+        """
+        with self._lock:
+            self._shut_down = True
+            self._executor.shutdown(wait=False)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+            self.completed += 1
+
+
+
+def get_crypto_executor():
+    """
+    Return the crypto executor, creating it from the settings on first use.
+    """
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                settings = get_settings()
+
+                _executor = CryptoExecutor(
+                    workers=settings.crypto_workers,
+                    max_queue=settings.crypto_max_queue,
+                )
+
+    return _executor
+
+
+
+@on_reload
+def reset_crypto_executor(settings):
+    """
+    Start a new executor with the reloaded settings, the old one finishes its queue.
+    """
+    global _executor
+
+    # Plain assignment, this runs from the SIGHUP handler
+    old_executor, _executor = _executor, None
+
+    if old_executor is not None:
+        old_executor.shutdown()
+
+
+_executor = None
+_executor_lock = threading.Lock()
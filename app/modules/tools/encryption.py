@@ -1,19 +1,45 @@
 # encryption.py
 
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
-
-import argparse
 import base64
-import json
 import os
 
+from .crypto_executor import get_crypto_executor
 from .logger import vadafi_logger
 logger = vadafi_logger()
 
 
+def new_kdf(salt):
+    """
+    Return the key derivation function of the master secret for a salt.
+
+    cryptography is imported on first use, it is not needed to start the app.
+    Derivations run on the crypto executor, see crypto_executor.py.
+    """
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.backends import default_backend
+
+    # This function will make it harder to bruteforce the master secret
+    return PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=100_000,
+        backend=default_backend()
+    )
+
+
+
+def new_aesgcm(encryption_key):
+    """
+    Return the AES-GCM cipher of a derived key.
+    """
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    return AESGCM(encryption_key)
+
+
+
 def encrypt_secret(master_secret, plain_text_secret):
     """
     Encrypt a plain text secret using the master password.
@@ -26,28 +52,34 @@ def encrypt_secret(master_secret, plain_text_secret):
         secret_data (dict): A dictionary with the salt, iv and encrypted secret.
     """
 
+    return get_crypto_executor().run(encrypt_with_new_key, master_secret.encode(), plain_text_secret)
+
+
+
+def encrypt_with_new_key(master_secret, plain_text_secret):
+    """
+    Encrypt a secret under a key derived with a fresh salt, runs on the crypto executor.
+
+    Args:
+        master_secret (bytes): The encoded master secret.
+        plain_text_secret (str): The to be encrypted secret in plain text.
+
+    Returns:
+        secret_data (dict): A dictionary with the salt, iv and encrypted secret.
+    """
+
     # Generate a random salt
     salt = os.urandom(16)
 
-    # Key derivation function
-    # This function will make it harder to bruteforce the master secret
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=100_000,
-        backend=default_backend()
-    )
-
     # "Dirive" the key from the master secret
-    encryption_key = kdf.derive(master_secret.encode())
+    encryption_key = new_kdf(salt).derive(master_secret)
 
     # Generate a random IV
     iv = os.urandom(12)
     
     # Encrypt the secret
     # The plain_text_secret should be encoded to be sure
-    aesgcm = AESGCM(encryption_key)
+    aesgcm = new_aesgcm(encryption_key)
     encrypted_secret = aesgcm.encrypt(iv, plain_text_secret.encode(), None)
 
     # Put all values in a dictionary
@@ -62,46 +94,137 @@ def encrypt_secret(master_secret, plain_text_secret):
 
 
 
-def decrypt_secret(master_secret, secret_data):
+def encrypt_secrets(master_secret, plain_text_secrets):
     """
-    Decrypt a secret using the master secret.
+    Encrypt many secrets at once, in parallel on the crypto executor.
 
     Args:
         master_secret (str): The master secret.
-        secret_data (dict): A dictionary with the salt, iv and encrypted secret.
-    
+        plain_text_secrets (list): The to be encrypted secrets in plain text.
+
+    Returns:
+        secrets_data (list): The salt, iv and encrypted secret of every secret, in order.
+    """
+    master_secret = master_secret.encode()
+
+    # Every secret gets its own salt, so every secret costs a derivation
+    return get_crypto_executor().map(
+        encrypt_with_new_key,
+        ((master_secret, plain_text_secret) for plain_text_secret in plain_text_secrets)
+        )
+
+
+
+def derive_key(master_secret, salt):
+    """
+    Derive the encryption key of a secret from the master secret.
+
+    Args:
+        master_secret (str): The master secret.
+        salt (bytes): The salt of the secret.
+
+    Returns:
+        encryption_key (bytes): The derived key.
+    """
+
+    # Key derivation function
+    kdf = new_kdf(salt)
+
+    # "Derive" the key from the master secret
+    return get_crypto_executor().run(kdf.derive, master_secret.encode())
+
+
+
+def decrypt_with_key(encryption_key, iv, secret):
+    """
+    Decrypt a secret with an already derived key.
+
+    Args:
+        encryption_key (bytes): The derived key.
+        iv (bytes): The iv of the secret.
+        secret (bytes): The encrypted secret.
+
     Returns:
         plain_text_secret (str): the plain_text_secret.
     """
-    try:
-        #secret_data = json.loads(secret_data)
-
-        # Grab the data out of the dictionary
-        salt = base64.b64decode(secret_data['salt'])
-        iv = base64.b64decode(secret_data['iv'])
-        secret = base64.b64decode(secret_data['secret'])
-
-        # Key derivation function 
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100_000,
-            backend=default_backend()
+    aesgcm = new_aesgcm(encryption_key)
+    decrypted_secret = aesgcm.decrypt(iv, secret, None)
+
+    return decrypted_secret.decode()
+
+
+
+def decrypt_with_salt(master_secret, salt, envelopes):
+    """
+    Derive the key of a salt once and decrypt every envelope under it, runs on the crypto executor.
+
+    Args:
+        master_secret (bytes): The encoded master secret.
+        salt (bytes): The salt the envelopes share.
+        envelopes (list): (index, iv, secret) of every envelope, decoded.
+
+    Returns:
+        results (list): (index, plain_text_secret, encryption_key), plain_text_secret is None if it could not be decrypted.
+    """
+    encryption_key = new_kdf(salt).derive(master_secret)
+
+    # One cipher for every envelope under this key
+    aesgcm = new_aesgcm(encryption_key)
+
+    results = []
+    for index, iv, secret in envelopes:
+        try:
+            results.append((index, aesgcm.decrypt(iv, secret, None).decode(), encryption_key))
+        except Exception as e:
+            logger.error(f"Error occured while trying to decrypt secret. {e}")
+            results.append((index, None, encryption_key))
+
+    return results
+
+
+
+def decrypt_secrets(master_secret, secrets_data):
+    """
+    Decrypt many secrets at once.
+
+    The key of every distinct salt is derived once, the derivations run in
+    parallel on the crypto executor.
+
+    Args:
+        master_secret (str): The master secret.
+        secrets_data (list): Dictionaries with the salt, iv and encrypted secret, as stored.
+
+    Returns:
+        results (list): (plain_text_secret, encryption_key) of every secret, in order.
+            plain_text_secret is None and encryption_key may be None if it could not be decrypted.
+    """
+    results = [(None, None)] * len(secrets_data)
+
+    # Group the envelopes by salt, the derivation is what costs
+    by_salt = {}
+    for index, secret_data in enumerate(secrets_data):
+        # A malformed envelope only fails itself
+        try:
+            salt = base64.b64decode(secret_data['salt'])
+            envelope = (index, base64.b64decode(secret_data['iv']), base64.b64decode(secret_data['secret']))
+        except Exception as e:
+            logger.error(f"Error occured while trying to decrypt secret. {e}")
+            continue
+
+        by_salt.setdefault(salt, []).append(envelope)
+
+    master_secret = master_secret.encode()
+
+    decrypted = get_crypto_executor().map(
+        decrypt_with_salt,
+        ((master_secret, salt, envelopes) for salt, envelopes in by_salt.items())
         )
-     
-        # "Derive" the key from the master secret
-        encryption_key = kdf.derive(master_secret.encode())
-       
-        # Decrypt the secret
-        aesgcm = AESGCM(encryption_key)
-        decrypted_secret = aesgcm.decrypt(iv, secret, None)
-        plain_text_secret = decrypted_secret.decode()
 
-        return plain_text_secret
+    for salt_results in decrypted:
+        for index, plain_text_secret, encryption_key in salt_results:
+            results[index] = (plain_text_secret, encryption_key)
 
-    except Exception as e:
-        logger.error(f"Error occured while trying to decrypt secret. {e}")
+    return results
 
 
 
@@ -122,16 +245,10 @@ def hash_secret(secret, salt=None):
         salt = os.urandom(16)
 
     # Key derivation function
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=100_000,
-        backend=default_backend()
-    )
+    kdf = new_kdf(salt)
 
     # Hash the secret
-    secret_hash = kdf.derive(secret.encode())
+    secret_hash = get_crypto_executor().run(kdf.derive, secret.encode())
 
     # Put the values in a dictionary
     hashed_data = {
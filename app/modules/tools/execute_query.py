@@ -1,16 +1,99 @@
 # execute_query.py
 
-import psycopg2
-from psycopg2 import OperationalError, DatabaseError
-
+# psycopg2 is imported on the first query, it is not needed to start the app
 from .logger import vadafi_logger
+from .pool import acquire_connection, release_connection
+from .replicas import get_replica_router, is_read_only_query
 
 logger = vadafi_logger()
 
-def execute_query(query, return_data=False, params=None, autocommit=False, dbconfig=None):
+# Replication lag in seconds, 0 when the replica has replayed everything it received
+REPLICA_LAG_QUERY = """
+SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+def execute_query(query, return_data=False, params=None, autocommit=False, dbconfig=None, read_only=None, sticky=True):
     """
     Executes a query on the vadafi database.
 
+    Read-only queries are sent to a read replica when replicas are configured,
+    everything else goes to the primary.
+
+    Args:
+        query (str): The query to execute.
+        return_data (bool): Should the query return data.
+        params (str): Parameters for the query, we use this to counter SQL injection.
+        autocommit (bool): Set the connection mode to autocommit.
+        credentials (dict): Database credentials.
+        read_only (bool): Force routing, detected from the query if None.
+            False sends a read to the primary.
+        sticky (bool): Let the next reads on the database go to the primary after a write.
+
+    Returns:
+        list: Returns data if return_data is True.
+
+    Raises:
+        Exception: If a database error occurs.
+    """
+
+    from psycopg2 import OperationalError
+
+    router = get_replica_router()
+
+    # Detect if the query may go to a replica
+    detected_read_only = not autocommit and is_read_only_query(query)
+    if read_only is None:
+        read_only = detected_read_only
+
+    if read_only:
+        replica = router.route(dbconfig)
+
+        if replica:
+            replica_dbconfig = dict(dbconfig, host=replica.host, port=replica.port)
+
+            try:
+                # Measure the replication lag every now and then
+                if router.lag_check_due(replica):
+                    lag = run_query(REPLICA_LAG_QUERY, return_data=True, dbconfig=replica_dbconfig)
+                    if lag is False:
+                        raise OperationalError("Could not measure the replication lag.")
+                    router.update_lag(replica, lag[0][0] if lag else 0)
+
+                if replica.lag <= router.max_lag:
+                    results = run_query(query, return_data, params, autocommit, replica_dbconfig)
+
+                    # A replica can cancel a query on a conflict with recovery, the primary can not
+                    if results is not False:
+                        return results
+                    logger.error(f"Query failed on replica {replica}, retrying on primary.")
+
+            except OperationalError as e:
+                # Retry on the primary, only blame the replica if the primary works
+                logger.error(f"Replica {replica} failed, retrying on primary: {e}")
+                results = run_query(query, return_data, params, autocommit, dbconfig)
+                router.mark_unhealthy(replica)
+                return results
+
+        return run_query(query, return_data, params, autocommit, dbconfig)
+
+    results = run_query(query, return_data, params, autocommit, dbconfig)
+
+    # Let the next reads on this database stick to the primary
+    # Reads forced to the primary and writes that returned no rows are not writes
+    if sticky and not detected_read_only and results:
+        router.record_write(dbconfig.get('dbname'))
+
+    return results
+
+
+
+def run_query(query, return_data=False, params=None, autocommit=False, dbconfig=None):
+    """
+    Executes a query on exactly the database in dbconfig.
+
     Args:
         query (str): The query to execute.
         return_data (bool): Should the query return data.
@@ -24,16 +107,20 @@ def execute_query(query, return_data=False, params=None, autocommit=False, dbcon
     Raises:
         Exception: If a database error occurs.
     """
+    import psycopg2
+    from psycopg2 import OperationalError, DatabaseError
 
     # Initialize connection
     connection = None
+    pool = None
     cursor = None
+    broken = False
     results = []
 
     try:
-        # Connect to the Database
-        connection = psycopg2.connect(**dbconfig)
-        
+        # Connect to the Database, admin connections come from a pool
+        connection, pool = acquire_connection(dbconfig)
+
         # Enable autocommit if True
         if autocommit:
             connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
@@ -57,6 +144,7 @@ def execute_query(query, return_data=False, params=None, autocommit=False, dbcon
     # Exit the program if the database has issues
     except OperationalError as e:
         logger.error(f"Operational error occured while executing query: {e}")
+        broken = True
         raise
 
     except DatabaseError as e:
@@ -67,12 +155,103 @@ def execute_query(query, return_data=False, params=None, autocommit=False, dbcon
         # Close the connection safely
         if 'cursor' in locals() and cursor:
             cursor.close()
-        
+
+        # Pooled connections go back to the pool, broken ones are discarded
         if 'connection' in locals() and connection:
-            connection.close() 
+            release_connection(connection, pool, discard=broken)
 
     # Return data or empty list
     if return_data:
-        return results 
+        return results
     else:
         return True
+
+
+
+def execute_batch_insert(query, rows, dbconfig=None, page_size=1000):
+    """
+    Insert many rows with multi-row INSERT statements in one transaction.
+
+    Args:
+        query (str): An INSERT query with a single VALUES %s placeholder.
+        rows (list): The rows to insert, as tuples.
+        dbconfig (dict): Database credentials.
+        page_size (int): Rows per INSERT statement.
+
+    Raises:
+        Exception: If a database error occurs.
+    """
+    from psycopg2 import DatabaseError, OperationalError
+    from psycopg2.extras import execute_values
+
+    # Initialize connection
+    connection = None
+    pool = None
+    cursor = None
+    broken = False
+
+    try:
+        # Connect to the Database
+        connection, pool = acquire_connection(dbconfig)
+        cursor = connection.cursor()
+
+        # Insert the rows, page_size rows per statement
+        execute_values(cursor, query, rows, page_size=page_size)
+        connection.commit()
+
+    except DatabaseError as e:
+        logger.error(f"Database error occured while inserting rows: {e}")
+        broken = isinstance(e, OperationalError)
+        raise
+
+    finally:
+        # Close the connection safely
+        if cursor:
+            cursor.close()
+
+        if connection:
+            release_connection(connection, pool, discard=broken)
+
+
+
+def stream_query(query, params=None, dbconfig=None, itersize=500):
+    """
+    Yield the rows of a query without loading them all in memory.
+
+    The rows are read with a server-side cursor, itersize rows per round trip.
+    The connection stays open until the generator is exhausted or closed.
+
+    Args:
+        query (str): The query to execute.
+        params (str): Parameters for the query, we use this to counter SQL injection.
+        dbconfig (dict): Database credentials.
+        itersize (int): Rows fetched per round trip.
+
+    Yields:
+        tuple: The rows.
+
+    Raises:
+        Exception: If a database error occurs.
+    """
+    from psycopg2 import OperationalError
+
+    connection, pool = acquire_connection(dbconfig)
+    broken = False
+
+    try:
+        # A named cursor is a server-side cursor
+        with connection.cursor(name="vadafi_stream") as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, params)
+
+            yield from cursor
+
+        connection.commit()
+
+    except OperationalError as e:
+        logger.error(f"Operational error occured while streaming query: {e}")
+        broken = True
+        raise
+
+    finally:
+        release_connection(connection, pool, discard=broken)
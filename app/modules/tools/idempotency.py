@@ -0,0 +1,229 @@
+# idempotency.py
+
+import hashlib
+import hmac
+
+from functools import wraps
+from flask import Response, jsonify, make_response, request
+from flask_jwt_extended import get_jwt_identity
+
+from .authentication import get_admin_dbconfig
+from .execute_query import execute_query
+from .jobs import job_handler
+from .logger import vadafi_logger
+from .settings import get_settings
+
+logger = vadafi_logger()
+
+# Seconds after which a request that never finished may be run again under its key
+IDEMPOTENCY_LEASE = 300
+
+# Claim the key, or take over a claim whose request died
+CLAIM_QUERY = """
+INSERT INTO vadafi_idempotency (endpoint, username, idempotency_key, request_hash)
+VALUES (%s, %s, %s, %s)
+ON CONFLICT (endpoint, username, idempotency_key) DO UPDATE
+SET request_hash = EXCLUDED.request_hash, created_at = now()
+WHERE vadafi_idempotency.status_code IS NULL
+AND vadafi_idempotency.created_at < now() - make_interval(secs => %s)
+RETURNING 1
+"""
+
+
+def request_hash():
+    """
+    Return the HMAC of the request, keyed with the API secret.
+
+    The body holds the password, so only a keyed hash of it is stored.
+    """
+    message = request.path.encode() + b"\n" + request.get_data()
+    return hmac.new(get_settings().api_secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+
+def request_owner():
+    """
+    Return who an Idempotency-Key belongs to.
+
+    Routes behind jwt_required are scoped to the identity of the token, the
+    username in the body is not checked yet when the key is claimed. Routes
+    without a token, like /create_user, use the username in the body.
+    """
+    try:
+        identity = get_jwt_identity()
+    except RuntimeError:
+        # No jwt_required on this route
+        identity = None
+
+    if identity:
+        return str(identity)
+
+    data = request.get_json(silent=True)
+    username = data.get('username') if isinstance(data, dict) else None
+    return username if isinstance(username, str) else ''
+
+
+
+def idempotent(route):
+    """
+    Make a route safe to retry with an Idempotency-Key header.
+
+    The first request with a key runs, its successful response is stored and
+    replayed for every retry with the same key and body, without running the
+    route again. A retry while the first request still runs gets 409. Failed
+    requests are not stored, so their retries run again. When the key can not
+    be claimed the request is refused with 503, running it could run it twice.
+
+    Keys are scoped to the user, see request_owner. Use below jwt_required.
+    Only use on routes whose responses hold no secrets.
+    """
+    @wraps(route)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return route(*args, **kwargs)
+
+        if len(key) > 255:
+            return jsonify({
+                "error": "Bad request",
+                "message": "The Idempotency-Key header can be at most 255 characters."
+            }), 400
+
+        username = request_owner()
+        endpoint = request.path
+        fingerprint = request_hash()
+        dbconfig = get_admin_dbconfig()
+
+        try:
+            # Bookkeeping, the writes of the keys do not stick the reads of the vadafi database to the primary
+            claimed = execute_query(
+                CLAIM_QUERY,
+                params=(endpoint, username, key, fingerprint, IDEMPOTENCY_LEASE),
+                return_data=True,
+                dbconfig=dbconfig,
+                sticky=False
+                )
+            if claimed is False:
+                raise RuntimeError("Database error while claiming the idempotency key.")
+
+        except Exception as e:
+            # A retry of a request that did run must not run again, refuse instead
+            logger.error(f"Error occured while claiming idempotency key for {endpoint}. {e}")
+            response = jsonify({
+                "error": "Service unavailable",
+                "message": "The Idempotency-Key could not be recorded, please retry."
+            })
+            response.headers['Retry-After'] = "1"
+            return response, 503
+
+        if not claimed:
+            return replay(endpoint, username, key, fingerprint)
+
+        try:
+            response = make_response(route(*args, **kwargs))
+
+        except Exception:
+            forget(endpoint, username, key)
+            raise
+
+        if 200 <= response.status_code < 300 and not response.is_streamed:
+            try:
+                stored = execute_query(
+                    """
+                    UPDATE vadafi_idempotency SET status_code = %s, response = %s, mimetype = %s
+                    WHERE endpoint = %s AND username = %s AND idempotency_key = %s
+                    """,
+                    params=(response.status_code, response.get_data(as_text=True), response.mimetype, endpoint, username, key),
+                    dbconfig=dbconfig,
+                    sticky=False
+                    )
+                if stored is False:
+                    raise RuntimeError("Database error while storing the response.")
+
+            except Exception as e:
+                # A claim without a response would answer 409 for the whole lease and then run again anyway
+                # Release it, so a retry runs again right away instead of hanging on a stale claim
+                logger.error(f"Error occured while storing the response for idempotency key of {endpoint}. {e}")
+                forget(endpoint, username, key)
+        else:
+            forget(endpoint, username, key)
+
+        return response
+
+    return wrapper
+
+
+
+def replay(endpoint, username, key, fingerprint):
+    """
+    Answer a retry with the stored response of the first request.
+    """
+    result = execute_query(
+        """
+        SELECT request_hash, status_code, response, mimetype FROM vadafi_idempotency
+        WHERE endpoint = %s AND username = %s AND idempotency_key = %s
+        """,
+        params=(endpoint, username, key),
+        return_data=True,
+        dbconfig=get_admin_dbconfig(),
+        read_only=False
+        )
+
+    if not result:
+        # Forgotten in the meantime, the client may retry right away
+        response = jsonify({
+            "error": "Conflict",
+            "message": "A request with this Idempotency-Key failed, please retry."
+        })
+        response.headers['Retry-After'] = "0"
+        return response, 409
+
+    stored_hash, status_code, body, mimetype = result[0]
+
+    if not hmac.compare_digest(stored_hash, fingerprint):
+        return jsonify({
+            "error": "Unprocessable entity",
+            "message": "This Idempotency-Key was used for another request."
+        }), 422
+
+    if status_code is None:
+        response = jsonify({
+            "error": "Conflict",
+            "message": "A request with this Idempotency-Key is still being processed."
+        })
+        response.headers['Retry-After'] = "1"
+        return response, 409
+
+    response = Response(body, status=status_code, mimetype=mimetype)
+    response.headers['Idempotent-Replayed'] = "true"
+    return response
+
+
+
+def forget(endpoint, username, key):
+    """
+    Drop the claim of a request that did not succeed, so a retry runs again.
+    """
+    try:
+        execute_query(
+            "DELETE FROM vadafi_idempotency WHERE endpoint = %s AND username = %s AND idempotency_key = %s",
+            params=(endpoint, username, key),
+            dbconfig=get_admin_dbconfig(),
+            sticky=False
+            )
+    except Exception as e:
+        logger.error(f"Error occured while releasing idempotency key for {endpoint}. {e}")
+
+
+
+@job_handler("prune_idempotency_keys", concurrency=1, every=60 * 60)
+def prune_idempotency_keys(payload):
+    """
+    Remove stored responses older than the idempotency TTL.
+    """
+    execute_query(
+        "DELETE FROM vadafi_idempotency WHERE created_at < now() - make_interval(secs => %s)",
+        params=(get_settings().idempotency_ttl,),
+        dbconfig=get_admin_dbconfig(),
+        sticky=False
+        )
@@ -0,0 +1,392 @@
+# jobs.py
+
+import json
+import time
+import threading
+
+from .authentication import get_admin_dbconfig
+from .execute_query import execute_query
+from .logger import vadafi_logger
+from .settings import get_settings
+
+logger = vadafi_logger()
+
+# Registered job handlers by kind
+_handlers = {}
+
+
+def job_handler(kind, concurrency=None, max_attempts=5, every=None):
+    """
+    Register a function as the handler of a kind of job.
+
+    The handler is called with the job's payload (dict). A job whose handler
+    raises is retried with exponential backoff until max_attempts is reached.
+
+    Args:
+        kind (str): The kind of job.
+        concurrency (int): Maximum number of these jobs running at once per process.
+        max_attempts (int): Attempts before the job is marked failed.
+        every (float): Run the job every this many seconds.
+    """
+    def register(handler):
+        _handlers[kind] = {
+            "handler": handler,
+            "concurrency": concurrency,
+            "max_attempts": max_attempts,
+            "every": every,
+        }
+        return handler
+
+    return register
+
+
+
+def enqueue_job(kind, payload=None, delay=0, max_attempts=None, unique=False):
+    """
+    Add a job to the queue.
+
+    Args:
+        kind (str): The kind of job.
+        payload (dict): The arguments of the job, never put passwords in here.
+        delay (float): Seconds to wait before the job may run.
+        max_attempts (int): Attempts before the job is marked failed.
+        unique (bool): Skip if the same job is already pending.
+
+    Returns:
+        job_id (int): The id of the job, None if skipped.
+    """
+    if max_attempts is None:
+        max_attempts = _handlers.get(kind, {}).get("max_attempts", 5)
+
+    payload = json.dumps(payload or {})
+
+    query = """
+    INSERT INTO vadafi_jobs (kind, payload, max_attempts, run_after)
+    SELECT %s, %s::jsonb, %s, now() + make_interval(secs => %s)
+    WHERE NOT %s OR NOT EXISTS (
+        SELECT 1 FROM vadafi_jobs WHERE kind = %s AND payload = %s::jsonb AND status = 'pending'
+    )
+    RETURNING job_id
+    """
+    result = execute_query(
+        query,
+        params=(kind, payload, max_attempts, delay, unique, kind, payload),
+        return_data=True,
+        dbconfig=get_admin_dbconfig(),
+        sticky=False
+        )
+    if not result:
+        return None
+
+    job_id = result[0][0]
+    logger.info(f"Enqueued job {job_id} ({kind}).")
+
+    return job_id
+
+
+
+def get_job(job_id, user_id=None):
+    """
+    Return the status of a job, or None if it does not exist.
+
+    Args:
+        job_id (int): The id of the job.
+        user_id (int): Only return the job if it belongs to this user's vault.
+            Maintenance jobs belong to no user.
+    """
+    query = """
+    SELECT job_id, kind, status, attempts, max_attempts, last_error, created_at, updated_at
+    FROM vadafi_jobs
+    WHERE job_id = %s AND (%s IS NULL OR (payload->>'user_id')::integer = %s)
+    """
+    result = execute_query(
+        query,
+        params=(job_id, user_id, user_id),
+        return_data=True,
+        dbconfig=get_admin_dbconfig()
+        )
+    if not result:
+        return None
+
+    job_id, kind, status, attempts, max_attempts, last_error, created_at, updated_at = result[0]
+    return {
+        "job_id": job_id,
+        "kind": kind,
+        "status": status,
+        "attempts": attempts,
+        "max_attempts": max_attempts,
+        "last_error": last_error,
+        "created_at": created_at,
+        "updated_at": updated_at,
+    }
+
+
+
+def count_jobs():
+    """
+    Return the number of jobs per kind and status.
+    """
+    result = execute_query(
+        "SELECT kind, status, COUNT(*) FROM vadafi_jobs GROUP BY kind, status ORDER BY kind, status",
+        return_data=True,
+        dbconfig=get_admin_dbconfig()
+        )
+    return [{"kind": kind, "status": status, "count": count} for kind, status, count in result]
+
+
+
+def queue_depth():
+    """
+    Return the number of pending and running jobs.
+
+    Only reads the queue index, cheap enough for the status endpoint.
+    """
+    result = execute_query(
+        "SELECT status, COUNT(*) FROM vadafi_jobs WHERE status IN ('pending', 'running') GROUP BY status",
+        return_data=True,
+        dbconfig=get_admin_dbconfig()
+        )
+    depth = {"pending": 0, "running": 0}
+    depth.update({status: count for status, count in result})
+
+    return depth
+
+
+
+class JobScheduler:
+    """
+    Run queued jobs on background threads.
+
+    Jobs are claimed with FOR UPDATE SKIP LOCKED, so any number of processes
+    can share the queue. A claimed job is leased for job_timeout seconds, a job
+    whose worker died is picked up again once the lease runs out.
+    """
+
+    def __init__(self, workers=2, poll_interval=1, job_timeout=300, retry_base=5):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self.retry_base = retry_base
+
+        self._running = {}
+        self._periodic = []
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def schedule_periodic(self, kind, interval, payload=None):
+        """
+        Enqueue a job every interval seconds, unless one is already queued.
+        """
+        self._periodic.append({"kind": kind, "interval": interval, "payload": payload, "next_run": 0})
+
+    def start(self):
+        """
+        Start the worker threads and the periodic job thread.
+        """
+        if self._threads:
+            return
+
+        self._stop.clear()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"vadafi-job-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        if self._periodic:
+            thread = threading.Thread(target=self._schedule, name="vadafi-job-scheduler", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        logger.info(f"Started job scheduler with {self.workers} workers.")
+
+    def stop(self, timeout=None):
+        """
+        Stop the threads after their current job.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def stats(self):
+        """
+        Return the number of running jobs per kind in this process.
+        """
+        with self._lock:
+            return dict(self._running)
+
+    def _available_kinds(self):
+        # Kinds that are below their concurrency limit
+        with self._lock:
+            return [
+                kind for kind, options in _handlers.items()
+                if options["concurrency"] is None or self._running.get(kind, 0) < options["concurrency"]
+                ]
+
+    def _claim(self):
+        kinds = self._available_kinds()
+        if not kinds:
+            return None
+
+        query = """
+        UPDATE vadafi_jobs
+        SET status = 'running',
+            attempts = attempts + 1,
+            run_after = now() + make_interval(secs => %s),
+            updated_at = now()
+        WHERE job_id = (
+            SELECT job_id FROM vadafi_jobs
+            WHERE status IN ('pending', 'running') AND run_after <= now() AND kind = ANY(%s)
+            ORDER BY run_after
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING job_id, kind, payload, attempts, max_attempts
+        """
+        result = execute_query(
+            query,
+            params=(self.job_timeout, kinds),
+            return_data=True,
+            dbconfig=get_admin_dbconfig(),
+            sticky=False
+            )
+        if not result:
+            return None
+
+        return result[0]
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"Error occured while claiming a job. {e}")
+                job = None
+
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+
+            self._run(*job)
+
+    def _run(self, job_id, kind, payload, attempts, max_attempts):
+        with self._lock:
+            self._running[kind] = self._running.get(kind, 0) + 1
+
+        try:
+            _handlers[kind]["handler"](payload)
+
+            execute_query(
+                "UPDATE vadafi_jobs SET status = 'done', last_error = NULL, updated_at = now() WHERE job_id = %s",
+                params=(job_id,),
+                dbconfig=get_admin_dbconfig(),
+                sticky=False
+                )
+            logger.info(f"Finished job {job_id} ({kind}).")
+
+        except Exception as e:
+            # Retry with exponential backoff or give up
+            if attempts < max_attempts:
+                status = 'pending'
+                delay = self.retry_base * 2 ** (attempts - 1)
+                logger.error(f"Job {job_id} ({kind}) failed, retrying in {delay} seconds. {e}")
+            else:
+                status = 'failed'
+                delay = 0
+                logger.error(f"Job {job_id} ({kind}) failed after {attempts} attempts. {e}")
+
+            execute_query(
+                """
+                UPDATE vadafi_jobs
+                SET status = %s, last_error = %s, run_after = now() + make_interval(secs => %s), updated_at = now()
+                WHERE job_id = %s
+                """,
+                params=(status, str(e), delay, job_id),
+                dbconfig=get_admin_dbconfig(),
+                sticky=False
+                )
+
+        finally:
+            with self._lock:
+                self._running[kind] -= 1
+
+    def _schedule(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+
+            for periodic in self._periodic:
+                if periodic["next_run"] > now:
+                    continue
+
+                periodic["next_run"] = now + periodic["interval"]
+
+                # Only enqueue if the previous run is done
+                query = """
+                INSERT INTO vadafi_jobs (kind, payload, max_attempts)
+                SELECT %s, %s::jsonb, %s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM vadafi_jobs WHERE kind = %s AND status IN ('pending', 'running')
+                )
+                """
+                try:
+                    execute_query(
+                        query,
+                        params=(
+                            periodic["kind"],
+                            json.dumps(periodic["payload"] or {}),
+                            _handlers.get(periodic["kind"], {}).get("max_attempts", 5),
+                            periodic["kind"]
+                            ),
+                        dbconfig=get_admin_dbconfig(),
+                        sticky=False
+                        )
+                except Exception as e:
+                    logger.error(f"Error occured while scheduling {periodic['kind']}. {e}")
+
+            self._stop.wait(self.poll_interval)
+
+
+
+@job_handler("prune_jobs", concurrency=1, every=24 * 60 * 60)
+def prune_jobs(payload):
+    """
+    Remove finished jobs older than the retention.
+    """
+    execute_query(
+        """
+        DELETE FROM vadafi_jobs
+        WHERE status IN ('done', 'failed') AND updated_at < now() - make_interval(days => %s)
+        """,
+        params=(get_settings().job_retention_days,),
+        dbconfig=get_admin_dbconfig()
+        )
+
+
+
+def get_scheduler():
+    """
+    Return the job scheduler, creating it from the settings on first use.
+    """
+    global _scheduler
+
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                settings = get_settings()
+
+                _scheduler = JobScheduler(
+                    workers=settings.job_workers,
+                    poll_interval=settings.job_poll_interval,
+                    job_timeout=settings.job_timeout,
+                )
+
+                for kind, options in _handlers.items():
+                    if options["every"]:
+                        _scheduler.schedule_periodic(kind, options["every"])
+
+    return _scheduler
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
@@ -0,0 +1,76 @@
+# json_provider.py
+
+import importlib
+
+from flask.json.provider import DefaultJSONProvider
+
+from .logger import vadafi_logger
+from .settings import get_settings
+
+logger = vadafi_logger()
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider that serializes with orjson straight to bytes.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+
+        # Pretty print like the default provider does in debug mode
+        option = self._options()
+        if self.compact is None and self._app.debug or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=option | orjson.OPT_APPEND_NEWLINE),
+            mimetype=self.mimetype
+            )
+
+    def _options(self):
+        # Dates go through default like in the default provider, as HTTP dates
+        # The wire format must not depend on whether orjson is installed
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+
+
+
+def init_json_provider(app):
+    """
+    Set the JSON provider of the app.
+
+    JSON_PROVIDER is "auto" (orjson when installed), "orjson", "default" or
+    the "module:Class" path of a custom provider.
+    """
+    choice = get_settings().json_provider
+
+    if choice == "default":
+        return
+
+    if choice in ("auto", "orjson"):
+        if orjson is None:
+            if choice == "orjson":
+                raise ValueError("JSON_PROVIDER is orjson but orjson is not installed.")
+            return
+
+        provider_class = OrjsonProvider
+    else:
+        module_name, _, class_name = choice.partition(":")
+        provider_class = getattr(importlib.import_module(module_name), class_name)
+
+    app.json = provider_class(app)
+    logger.info(f"Using JSON provider {provider_class.__name__}.")
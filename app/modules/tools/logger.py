@@ -2,18 +2,27 @@
 
 import logging
 
+# Set once the log file is configured
+_configured = False
+
+
 def vadafi_logger():
-    logging.basicConfig(
-        filename="vadafi.log",
-        encoding="utf-8",
-        filemode="a",
-        level=logging.DEBUG,
-        format="{asctime} - {levelname} - {message}",
-        style="{",
-        datefmt="%Y-%m-%d %H:%M",
-    )
+    global _configured
+
+    # Every module asks for the logger, only configure the log file once
+    if not _configured:
+        logging.basicConfig(
+            filename="vadafi.log",
+            encoding="utf-8",
+            filemode="a",
+            level=logging.DEBUG,
+            format="{asctime} - {levelname} - {message}",
+            style="{",
+            datefmt="%Y-%m-%d %H:%M",
+        )
+        _configured = True
 
     # Logger object
     logger = logging.getLogger(__name__)
-    
+
     return logger
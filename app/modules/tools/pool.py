@@ -0,0 +1,716 @@
+# pool.py
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from .logger import vadafi_logger
+from .rate_limit import record_authentication_failure
+from .settings import get_settings, on_reload
+
+logger = vadafi_logger()
+
+# The database of the admin user, see get_admin_dbconfig
+ADMIN_DBNAME = "vadafi"
+
+# Tenant pools are keyed by a keyed hash of the password, never the password itself
+# A request with a wrong password never gets a connection opened with the right one
+_password_key = os.urandom(32)
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection became available within the pool timeout.
+    """
+
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of connections to one database.
+
+    Connections are opened on demand up to max_size. When all are in use,
+    callers wait up to timeout seconds for one to be returned. Connections
+    that sat idle longer than ping_after seconds are checked before reuse, so a
+    restarted database does not fail the first queries.
+
+    The pools of the users' databases share a ConnectionBudget, which caps
+    their connections together. Such a pool joins the budget only once its
+    first connection succeeded, a wrong password never takes a slot.
+    """
+
+    def __init__(self, dbconfig, max_size=10, timeout=5, ping_after=30, budget=None, key=None):
+        self.dbconfig = dict(dbconfig)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.budget = budget
+        self.key = key
+        self.name = f"{dbconfig.get('dbname')}@{dbconfig.get('host')}:{dbconfig.get('port')}"
+        self.last_used = time.monotonic()
+
+        # Pools under a budget are verified by their first connection
+        self.verified = budget is None
+
+        self.acquired = 0
+        self.created = 0
+        self.timeouts = 0
+
+        # Oldest first, getconn takes from the end and eviction from the front
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._connecting = 0
+        self._closed = False
+
+        # Pools under a budget share its lock, so the budget can move connections between them
+        self._condition = budget.condition if budget else threading.Condition()
+
+    def getconn(self, dbconfig=None):
+        """
+        Take a connection from the pool, opening a new one if there is room.
+
+        Args:
+            dbconfig (dict): Credentials for a new connection, those of the pool if None.
+
+        Raises:
+            PoolTimeout: If the pool stayed exhausted for timeout seconds.
+        """
+        deadline = time.monotonic() + self.timeout
+        connection = None
+        to_close = []
+        queued = False
+
+        # The first connection of a tenant pool is opened on a probe slot before it takes a slot,
+        # a wrong password fails there without evicting the connections of other users
+        first = None
+        if not self.verified:
+            first = self._connect_first(dbconfig or self.dbconfig, deadline)
+
+        try:
+            with self._condition:
+                if self.budget:
+                    self.budget.touch(self)
+                    to_close += self.budget.sweep()
+
+                try:
+                    while True:
+                        # Reuse the most recently returned connection first, it is the least likely to be stale
+                        # Unless the budget is used up and another tenant is up, then it is theirs to evict
+                        if first is None and self._idle and not (self.budget and self.budget.should_yield(self)):
+                            connection, idle_since = self._idle.pop()
+                            break
+
+                        if self._size < self.max_size:
+                            if self.budget is None:
+                                self._size += 1
+                                break
+
+                            # A new connection needs a slot of the budget, possibly one evicted from another pool
+                            granted, evicted = self.budget.reserve(self)
+                            if evicted is not None:
+                                to_close.append(evicted)
+                            if granted:
+                                self._size += 1
+                                break
+
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            if self.budget:
+                                self.budget.timeouts += 1
+                            if first is not None:
+                                to_close.append(first)
+                            raise PoolTimeout(f"No connection to {self.name} available within {self.timeout} seconds.")
+
+                        # Wait in line with the other tenants
+                        if self.budget and not queued:
+                            self.budget.enqueue(self)
+                            queued = True
+
+                        self._waiting += 1
+                        self._condition.wait(remaining)
+                        self._waiting -= 1
+
+                finally:
+                    if queued:
+                        self.budget.dequeue(self)
+                    # The first connection has a slot of the budget now, or is closed
+                    if first is not None:
+                        self.budget.release_probe()
+
+                self._in_use += 1
+                self.acquired += 1
+
+        except PoolTimeout:
+            # Close the connections taken out of the pools for this request
+            for unused in to_close:
+                unused.close()
+            raise
+
+        for evicted in to_close:
+            evicted.close()
+
+        # The slot is taken, the first connection fills it
+        if first is not None:
+            return first
+
+        try:
+            if connection is not None and time.monotonic() - idle_since > self.ping_after and not self._ping(connection):
+                connection.close()
+                connection = None
+
+            if connection is None:
+                connection = self._connect(dbconfig or self.dbconfig)
+
+        except Exception:
+            # Give the slot back
+            with self._condition:
+                self._size -= 1
+                self._in_use -= 1
+                self._released(1)
+            raise
+
+        return connection
+
+    def putconn(self, connection, discard=False):
+        """
+        Return a connection to the pool.
+
+        Args:
+            connection: A connection from getconn.
+            discard (bool): Close the connection instead, e.g. after a connection error.
+        """
+        import psycopg2.extensions
+
+        if not discard and not connection.closed:
+            try:
+                # Never hand an open transaction to the next caller
+                if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                connection.autocommit = False
+
+            except Exception as e:
+                logger.error(f"Error occured while resetting a connection to {self.name}, discarding it. {e}")
+                discard = True
+
+        with self._condition:
+            self._in_use -= 1
+            self.last_used = time.monotonic()
+
+            if discard or connection.closed or self._closed:
+                self._size -= 1
+                keep = False
+                self._released(1)
+            else:
+                self._idle.append((connection, time.monotonic()))
+                keep = True
+                self._released(0)
+
+        if not keep and not connection.closed:
+            connection.close()
+
+    def close(self):
+        """
+        Close the idle connections, connections in use are closed when they are returned.
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._released(len(idle))
+
+        for connection, idle_since in idle:
+            connection.close()
+
+    def stats(self):
+        """
+        Return the size and counters of the pool.
+        """
+        with self._condition:
+            return {
+                # Only the database, the host stays out of /status
+                "database": self.dbconfig.get('dbname'),
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "utilisation": round(self._in_use / self.max_size, 3) if self.max_size else 0,
+                "acquired": self.acquired,
+                "created": self.created,
+                "timeouts": self.timeouts,
+            }
+
+    def _released(self, closed):
+        # Called with the lock held after a connection was returned or closed
+        if self.budget:
+            self.budget.release(closed)
+        else:
+            self._condition.notify()
+
+    def _pop_oldest_idle(self):
+        # Called by the budget with the lock held, the caller closes the connection
+        connection, idle_since = self._idle.pop(0)
+        self._size -= 1
+        return connection
+
+    def _connect_first(self, dbconfig, deadline):
+        # Open a connection of a pool that is not verified yet on a probe slot of the budget
+        # The pool joins the budget once it succeeds, the caller releases the probe slot
+        with self._condition:
+            while not self.budget.reserve_probe():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    self.budget.timeouts += 1
+                    raise PoolTimeout(f"No connection to {self.name} available within {self.timeout} seconds.")
+                self._condition.wait(remaining)
+
+            self._connecting += 1
+
+        connection = None
+        try:
+            connection = self._connect(dbconfig)
+
+        finally:
+            with self._condition:
+                self._connecting -= 1
+
+                if connection is not None:
+                    self.budget.admit(self)
+                else:
+                    self.budget.release_probe()
+                    # Forget the pool unless another request may still prove its password right
+                    if not self._connecting and not self.verified:
+                        self.budget.forget(self)
+
+        return connection
+
+    def _connect(self, dbconfig):
+        import psycopg2
+
+        connection = psycopg2.connect(**dbconfig)
+        with self._condition:
+            self.created += 1
+
+        return connection
+
+    def _ping(self, connection):
+        # Check an idle connection with a round trip to the database
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+
+        except Exception:
+            return False
+
+
+
+class ConnectionBudget:
+    """
+    Cap the open connections of all the users' database pools together.
+
+    Every user has a database and role of their own, so every user needs
+    their own pool. The budget keeps the total below max_connections:
+
+    - A pool that needs a new connection while the budget is used up closes
+      an idle connection of the least recently used pool.
+    - If no connection is idle, requests wait in line per tenant, tenants
+      take turns so a busy user can not starve the others.
+    - Connections idle longer than idle_timeout are closed, pools without
+      connections are forgotten.
+    - A new pool waits aside until its first connection succeeded, so
+      requests with a wrong password neither take slots nor evict others.
+      First connections are opened on max_probes probe slots on top of the
+      budget, a probe slot is held until the connection got a slot.
+
+    The budget is per process, every worker of a WSGI server has its own.
+
+    All methods except stats are called with the condition held.
+    """
+
+    def __init__(self, max_connections=50, idle_timeout=60, max_probes=None):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.max_probes = max_probes or max(1, max_connections // 10)
+        self.condition = threading.Condition()
+
+        self.open = 0
+        self.probes = 0
+        self.grants = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.timeouts = 0
+
+        # Pools by key, least recently used first
+        self.pools = OrderedDict()
+
+        # New pools by key, until their first connection succeeded
+        self.pending = {}
+
+        # Tenants waiting for a slot, in turn order, with their number of waiting requests
+        self._queue = OrderedDict()
+        self._last_sweep = time.monotonic()
+
+    def reserve_probe(self):
+        """
+        Try to take a probe slot for the first connection of a pending pool.
+        """
+        if self.probes >= self.max_probes:
+            return False
+
+        self.probes += 1
+        return True
+
+    def release_probe(self):
+        """
+        Give back a probe slot and wake the waiting requests.
+        """
+        self.probes -= 1
+        self.condition.notify_all()
+
+    def admit(self, pool):
+        """
+        Let a pending pool join the budget after its first connection succeeded.
+        """
+        pool.verified = True
+        if self.pending.get(pool.key) is pool:
+            del self.pending[pool.key]
+
+    def forget(self, pool):
+        """
+        Drop a pending pool whose first connection failed.
+        """
+        if self.pending.get(pool.key) is pool:
+            del self.pending[pool.key]
+
+    def touch(self, pool):
+        """
+        Mark a pool as the most recently used.
+        """
+        pool.last_used = time.monotonic()
+        self.pools[pool.key] = pool
+        self.pools.move_to_end(pool.key)
+
+    def enqueue(self, pool):
+        """
+        Put a request of a pool in line for a slot.
+        """
+        entry = self._queue.setdefault(pool.key, [pool, 0])
+        entry[1] += 1
+
+    def dequeue(self, pool):
+        """
+        Take a request of a pool out of line, the tenant goes to the back if it has more waiting.
+        """
+        entry = self._queue.get(pool.key)
+        if entry is None:
+            return
+
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._queue[pool.key]
+        else:
+            self._queue.move_to_end(pool.key)
+
+        # The next tenant may be up now
+        self.condition.notify_all()
+
+    def reserve(self, pool):
+        """
+        Try to take a slot for a new connection of pool.
+
+        Returns:
+            tuple: If the slot was granted, and an evicted connection the caller must close.
+        """
+        if not self._has_turn(pool):
+            return False, None
+
+        if self.open < self.max_connections:
+            self.open += 1
+            self.grants += 1
+            return True, None
+
+        # Take over the slot of an idle connection of the least recently used pool
+        for victim in self.pools.values():
+            if victim is not pool and victim._idle:
+                self.evictions += 1
+                self.grants += 1
+                return True, victim._pop_oldest_idle()
+
+        return False, None
+
+    def should_yield(self, pool):
+        """
+        Check if pool should leave its idle connections to a waiting tenant.
+        """
+        return self.open >= self.max_connections and not self._has_turn(pool)
+
+    def release(self, closed):
+        """
+        Give back the slots of closed connections and wake the waiting requests.
+        """
+        self.open -= closed
+        self.condition.notify_all()
+
+    def sweep(self):
+        """
+        Close idle connections past the idle timeout and forget empty pools, at most once a second.
+
+        Returns:
+            list: The connections the caller must close.
+        """
+        now = time.monotonic()
+        if now - self._last_sweep < 1:
+            return []
+        self._last_sweep = now
+
+        cutoff = now - self.idle_timeout
+        expired = []
+
+        for key, pool in list(self.pools.items()):
+            while pool._idle and pool._idle[0][1] < cutoff:
+                expired.append(pool._pop_oldest_idle())
+
+            if pool._size == 0 and pool._waiting == 0 and pool.last_used < cutoff:
+                del self.pools[key]
+
+        if expired:
+            self.expirations += len(expired)
+            self.release(len(expired))
+
+        return expired
+
+    def stats(self):
+        """
+        Return the state of the budget.
+        """
+        with self.condition:
+            pools = list(self.pools.values())
+            in_use = sum(pool._in_use for pool in pools)
+
+            return {
+                "max_connections": self.max_connections,
+                "open": self.open,
+                "probes": self.probes,
+                "in_use": in_use,
+                "idle": sum(len(pool._idle) for pool in pools),
+                "utilisation": round(self.open / self.max_connections, 3) if self.max_connections else 0,
+                "tenants": len(pools),
+                "tenants_connected": sum(1 for pool in pools if pool._size),
+                "tenants_waiting": len(self._queue),
+                "requests_waiting": sum(waiters for pool, waiters in self._queue.values()),
+                "grants": self.grants,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "timeouts": self.timeouts,
+            }
+
+    def _has_turn(self, pool):
+        # The first waiting tenant that can still open a connection is up
+        for waiting_pool, waiters in self._queue.values():
+            if waiting_pool._size < waiting_pool.max_size:
+                return waiting_pool is pool
+
+        return True
+
+
+
+def get_pool(dbconfig):
+    """
+    Return the pool of the database in dbconfig, or None if it is not pooled.
+
+    Connections of the admin user to the vadafi database (and its replicas)
+    have a pool per database. Connections of the users to their own database
+    have a small pool per user under the shared tenant budget. Admin
+    connections to the users' databases are opened per query.
+
+    Args:
+        dbconfig (dict): Database credentials.
+
+    Returns:
+        pool (ConnectionPool)
+    """
+    settings = get_settings()
+
+    if not dbconfig:
+        return None
+
+    if dbconfig.get('user') == settings.db_user:
+        if not settings.db_pool_size or dbconfig.get('dbname') != ADMIN_DBNAME:
+            return None
+        return get_admin_pool(dbconfig, settings)
+
+    if not settings.db_tenant_connection_budget or not settings.db_tenant_pool_size:
+        return None
+    return get_tenant_pool(dbconfig, settings)
+
+
+
+def get_admin_pool(dbconfig, settings):
+    """
+    Return the pool of the admin user for a database, see get_pool.
+    """
+    key = (dbconfig.get('host'), dbconfig.get('port'), dbconfig.get('dbname'), dbconfig.get('user'))
+
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(
+                    dbconfig,
+                    max_size=settings.db_pool_size,
+                    timeout=settings.db_pool_timeout,
+                    ping_after=settings.db_pool_ping_after,
+                    key=key,
+                )
+
+    return pool
+
+
+
+def get_tenant_pool(dbconfig, settings):
+    """
+    Return the pool of a user for their database, see get_pool.
+
+    The pool does not keep the password, new connections are opened with the
+    dbconfig of the request.
+    """
+    budget = get_tenant_budget()
+    password_hash = hmac.new(_password_key, dbconfig.get('password', '').encode(), hashlib.sha256).digest()
+    key = (dbconfig.get('host'), dbconfig.get('port'), dbconfig.get('dbname'), dbconfig.get('user'), password_hash)
+
+    with budget.condition:
+        pool = budget.pools.get(key)
+        if pool is not None:
+            # Safe from the sweep until it is used
+            budget.touch(pool)
+            return pool
+
+        # A new pool stays pending until its first connection proves the password right
+        pool = budget.pending.get(key)
+        if pool is None:
+            pool = budget.pending[key] = ConnectionPool(
+                {name: value for name, value in dbconfig.items() if name != 'password'},
+                max_size=settings.db_tenant_pool_size,
+                timeout=settings.db_pool_timeout,
+                ping_after=settings.db_pool_ping_after,
+                budget=budget,
+                key=key,
+            )
+
+    return pool
+
+
+
+def get_tenant_budget():
+    """
+    Return the connection budget of the users' databases, creating it from the settings on first use.
+    """
+    global _budget
+
+    if _budget is None:
+        with _pools_lock:
+            if _budget is None:
+                settings = get_settings()
+
+                _budget = ConnectionBudget(
+                    max_connections=settings.db_tenant_connection_budget,
+                    idle_timeout=settings.db_tenant_idle_timeout,
+                )
+
+    return _budget
+
+
+
+def acquire_connection(dbconfig):
+    """
+    Open a connection to the database in dbconfig, from its pool if it has one.
+
+    Returns:
+        tuple: The connection and its pool, pass both to release_connection.
+    """
+    try:
+        pool = get_pool(dbconfig)
+
+        if pool is None:
+            import psycopg2
+            return psycopg2.connect(**dbconfig), None
+
+        return pool.getconn(dbconfig), pool
+
+    except Exception as e:
+        # The users' database roles have their password, a rejected login is a wrong password
+        # A wrong admin password is a configuration error, not the user's
+        if is_authentication_failure(e) and dbconfig.get('user') != get_settings().db_user:
+            record_authentication_failure()
+        raise
+
+
+
+def is_authentication_failure(error):
+    """
+    Check if a connection error is Postgres rejecting the password.
+    """
+    # libpq reports a failed login at connect time without an SQLSTATE, only with its message
+    return getattr(error, 'pgcode', None) == '28P01' or 'password authentication failed' in str(error)
+
+
+
+def release_connection(connection, pool, discard=False):
+    """
+    Return a connection to its pool, or close it if it has none.
+
+    Args:
+        connection: A connection from acquire_connection.
+        pool (ConnectionPool): Its pool from acquire_connection.
+        discard (bool): Close the connection even if it is pooled.
+    """
+    if pool is None:
+        connection.close()
+    else:
+        pool.putconn(connection, discard=discard)
+
+
+
+def pool_stats():
+    """
+    Return the stats of the admin pools and the tenant budget.
+    """
+    return {
+        "admin": [pool.stats() for pool in list(_pools.values())],
+        "tenants": get_tenant_budget().stats(),
+    }
+
+
+
+@on_reload
+def reset_pools(settings):
+    """
+    Start new pools with the reloaded settings and credentials.
+    """
+    global _pools, _budget
+
+    # Plain assignment, this runs from the SIGHUP handler
+    old_pools, _pools = list(_pools.values()), {}
+    old_budget, _budget = _budget, None
+
+    if old_budget is not None:
+        old_pools += list(old_budget.pools.values()) + list(old_budget.pending.values())
+
+    if old_pools:
+        threading.Thread(target=lambda: [pool.close() for pool in old_pools], daemon=True).start()
+
+
+_pools = {}
+_budget = None
+_pools_lock = threading.Lock()
@@ -0,0 +1,354 @@
+# rate_limit.py
+
+import time
+import threading
+
+from functools import wraps
+from flask import g, has_request_context, jsonify, request
+
+from .logger import vadafi_logger
+from .settings import get_settings, on_reload
+
+logger = vadafi_logger()
+
+
+class LocalBackend:
+    """
+    In-process token buckets and lockouts.
+
+    Every process keeps its own state, use a shared backend to limit across processes.
+    """
+
+    # Sweep idle buckets every this many takes so memory stays bounded
+    SWEEP_INTERVAL = 10_000
+
+    def __init__(self):
+        self._buckets = {}
+        self._failures = {}
+        self._locked_until = {}
+        self._takes = 0
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, capacity):
+        """
+        Take a token from the bucket of key.
+
+        Args:
+            key (str): The bucket key.
+            rate (float): Tokens added per second.
+            capacity (float): Maximum number of tokens in the bucket.
+
+        Returns:
+            float: 0 if a token was taken, otherwise seconds until one is available.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated_at, _, _ = self._buckets.get(key, (capacity, now, rate, capacity))
+
+            # Refill the bucket
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+
+            # Every bucket keeps its own rate and capacity for the sweep
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now, rate, capacity)
+                retry_after = 0
+            else:
+                self._buckets[key] = (tokens, now, rate, capacity)
+                retry_after = (1 - tokens) / rate
+
+            self._takes += 1
+            if self._takes % self.SWEEP_INTERVAL == 0:
+                self._sweep(now)
+
+        return retry_after
+
+    def _sweep(self, now):
+        # Drop buckets that are full again, they behave the same as a new one
+        for key, (tokens, updated_at, rate, capacity) in list(self._buckets.items()):
+            if now - updated_at >= (capacity - tokens) / rate:
+                del self._buckets[key]
+
+        for key, locked_until in list(self._locked_until.items()):
+            if locked_until <= now:
+                del self._locked_until[key]
+
+        for key, (failures, expires_at) in list(self._failures.items()):
+            if expires_at <= now:
+                del self._failures[key]
+
+    def locked_for(self, key):
+        """
+        Return the seconds key is still locked out for.
+        """
+        with self._lock:
+            return max(0, self._locked_until.get(key, 0) - time.monotonic())
+
+    def record_failure(self, key, threshold, base, maximum):
+        """
+        Count a failure for key and lock it out once it passes the threshold.
+
+        The lockout doubles with every failure after the threshold.
+
+        Returns:
+            float: Seconds key is locked out for.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            failures, _ = self._failures.get(key, (0, 0))
+            failures += 1
+
+            # Failures are forgotten after a quiet period, like in Redis
+            self._failures[key] = (failures, now + maximum * 2)
+
+            if failures < threshold:
+                return 0
+
+            lockout = min(maximum, base * 2 ** (failures - threshold))
+            self._locked_until[key] = now + lockout
+
+        return lockout
+
+    def reset(self, key):
+        """
+        Forget the failures and lockout of key.
+        """
+        with self._lock:
+            self._failures.pop(key, None)
+            self._locked_until.pop(key, None)
+
+
+
+class RedisBackend:
+    """
+    Token buckets and lockouts shared between processes through Redis.
+    """
+
+    TAKE_SCRIPT = """
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or ARGV[2])
+    local updated_at = tonumber(redis.call('HGET', KEYS[1], 'updated_at') or ARGV[3])
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+
+    tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+
+    local retry_after = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        retry_after = (1 - tokens) / rate
+    end
+
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(retry_after)
+    """
+
+    def __init__(self, url):
+        # Only needed when the shared backend is configured
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._take = self._redis.register_script(self.TAKE_SCRIPT)
+
+    def take(self, key, rate, capacity):
+        return float(self._take(keys=[f"vadafi:bucket:{key}"], args=[rate, capacity, time.time()]))
+
+    def locked_for(self, key):
+        return max(0, self._redis.pttl(f"vadafi:lockout:{key}")) / 1000
+
+    def record_failure(self, key, threshold, base, maximum):
+        failures_key = f"vadafi:failures:{key}"
+        failures = self._redis.incr(failures_key)
+        self._redis.expire(failures_key, int(maximum) * 2)
+
+        if failures < threshold:
+            return 0
+
+        lockout = min(maximum, base * 2 ** (failures - threshold))
+        self._redis.set(f"vadafi:lockout:{key}", 1, px=int(lockout * 1000))
+        return lockout
+
+    def reset(self, key):
+        self._redis.delete(f"vadafi:failures:{key}", f"vadafi:lockout:{key}")
+
+
+
+class RateLimiter:
+    """
+    Rate limit requests per IP and per username and lock out usernames after
+    repeated authentication failures.
+
+    Every scope has its own buckets: "auth" guards login and user creation
+    with strict limits, "secrets" the secret endpoints with limits high
+    enough for service accounts and CI jobs.
+    """
+
+    def __init__(self, backend, ip_per_minute=30, ip_burst=10, user_per_minute=10, user_burst=5,
+                 lockout_threshold=5, lockout_base=1, lockout_max=900,
+                 secrets_ip_per_minute=12_000, secrets_ip_burst=1000,
+                 secrets_user_per_minute=6000, secrets_user_burst=500):
+        self.backend = backend
+
+        # (ip rate, ip burst, user rate, user burst) per scope, rates per second
+        self.limits = {
+            "auth": (ip_per_minute / 60, ip_burst, user_per_minute / 60, user_burst),
+            "secrets": (secrets_ip_per_minute / 60, secrets_ip_burst, secrets_user_per_minute / 60, secrets_user_burst),
+        }
+        self.lockout_threshold = lockout_threshold
+        self.lockout_base = lockout_base
+        self.lockout_max = lockout_max
+
+    def check(self, ip, username=None, scope="auth"):
+        """
+        Check if a request may continue.
+
+        Args:
+            ip (str): The client address.
+            username (str): The username of the request, if any.
+            scope (str): "auth" or "secrets".
+
+        Returns:
+            float: 0 if allowed, otherwise seconds until the client may retry.
+        """
+        # A locked out username is locked out of every scope
+        if username:
+            locked_for = self.backend.locked_for(f"user:{username}")
+            if locked_for:
+                return locked_for
+
+        ip_rate, ip_burst, user_rate, user_burst = self.limits[scope]
+
+        retry_after = self.backend.take(f"{scope}:ip:{ip}", ip_rate, ip_burst)
+        if retry_after:
+            return retry_after
+
+        if username:
+            return self.backend.take(f"{scope}:user:{username}", user_rate, user_burst)
+
+        return 0
+
+    def record_failure(self, username):
+        """
+        Count a failed authentication for username.
+        """
+        lockout = self.backend.record_failure(
+            f"user:{username}",
+            self.lockout_threshold,
+            self.lockout_base,
+            self.lockout_max
+            )
+        if lockout:
+            logger.error(f"Locked out user {username} for {lockout:.0f} seconds after repeated failures.")
+
+    def record_success(self, username):
+        """
+        Reset the failures of username after a succesful authentication.
+        """
+        self.backend.reset(f"user:{username}")
+
+
+
+def get_rate_limiter():
+    """
+    Return the rate limiter, creating it from the settings on first use.
+    """
+    global _limiter
+
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                settings = get_settings()
+
+                if settings.rate_limit_redis_url:
+                    backend = RedisBackend(settings.rate_limit_redis_url)
+                else:
+                    backend = LocalBackend()
+
+                _limiter = RateLimiter(
+                    backend,
+                    ip_per_minute=settings.rate_limit_ip_per_minute,
+                    ip_burst=settings.rate_limit_ip_burst,
+                    user_per_minute=settings.rate_limit_user_per_minute,
+                    user_burst=settings.rate_limit_user_burst,
+                    lockout_threshold=settings.lockout_threshold,
+                    lockout_base=settings.lockout_base_seconds,
+                    lockout_max=settings.lockout_max_seconds,
+                    secrets_ip_per_minute=settings.rate_limit_secrets_ip_per_minute,
+                    secrets_ip_burst=settings.rate_limit_secrets_ip_burst,
+                    secrets_user_per_minute=settings.rate_limit_secrets_user_per_minute,
+                    secrets_user_burst=settings.rate_limit_secrets_user_burst,
+                )
+
+    return _limiter
+
+
+
+@on_reload
+def reset_rate_limiter(settings):
+    """
+    Build the rate limiter again from the reloaded settings.
+    """
+    global _limiter
+
+    # Plain assignment, this runs from the SIGHUP handler
+    _limiter = None
+
+
+
+def record_authentication_failure():
+    """
+    Mark the current request as failed on a wrong password.
+
+    rate_limited counts it towards the lockout of the username of the
+    request, so guessing passwords on the secret endpoints is locked out
+    like guessing them on the login.
+    """
+    if has_request_context():
+        g.vadafi_authentication_failed = True
+
+
+
+def rate_limited(route=None, scope="auth"):
+    """
+    Reject requests over the rate limit with 429 before any KDF or database work.
+
+    Use as @rate_limited for the strict limits of login and user creation,
+    or as @rate_limited(scope="secrets") for the secret endpoints. Requests
+    marked with record_authentication_failure count towards the lockout.
+    """
+    if route is None:
+        return lambda route: rate_limited(route, scope)
+
+    @wraps(route)
+    def wrapper(*args, **kwargs):
+        # Get the username if the client sent one
+        data = request.get_json(silent=True)
+        username = data.get('username') if isinstance(data, dict) else None
+
+        retry_after = get_rate_limiter().check(request.remote_addr, username, scope)
+        if retry_after:
+            logger.info(f"Rate limited request from {request.remote_addr} for user {username}.")
+
+            response = jsonify({
+                "error": "Too many requests",
+                "message": "Sorry, too many requests. Please try again later."
+            })
+            response.headers['Retry-After'] = str(int(retry_after) + 1)
+            return response, 429
+
+        response = route(*args, **kwargs)
+
+        # A wrong password anywhere counts, not only at the login
+        if username and g.get('vadafi_authentication_failed'):
+            get_rate_limiter().record_failure(username)
+
+        return response
+
+    return wrapper
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
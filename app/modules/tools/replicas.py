@@ -0,0 +1,217 @@
+# replicas.py
+
+import re
+import time
+import threading
+
+from .logger import vadafi_logger
+from .settings import get_settings, on_reload
+
+logger = vadafi_logger()
+
+# Statements that never write, everything else goes to the primary
+READ_ONLY_STATEMENT = re.compile(r"^\s*(SELECT|SHOW|EXPLAIN|VALUES|TABLE)\b", re.IGNORECASE)
+WRITE_KEYWORD = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|CREATE|ALTER|DROP|GRANT|REVOKE|TRUNCATE|COPY|LOCK|FOR\s+UPDATE|FOR\s+SHARE|NEXTVAL|SETVAL)\b", re.IGNORECASE)
+
+
+def is_read_only_query(query):
+    """
+    Check if a query can safely be executed on a read replica.
+
+    Args:
+        query (str): The query to check.
+
+    Returns:
+        bool: True if the query only reads data.
+    """
+    if READ_ONLY_STATEMENT.match(query):
+        return WRITE_KEYWORD.search(query) is None
+
+    # A CTE is only read-only when none of its parts write
+    if re.match(r"^\s*WITH\b", query, re.IGNORECASE):
+        return WRITE_KEYWORD.search(query) is None
+
+    return False
+
+
+
+class Replica:
+    """
+    A single read replica and its health.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.healthy = True
+        self.unhealthy_until = 0
+        self.lag = 0
+        self.lag_checked_at = 0
+
+    def __repr__(self):
+        return f"{self.host}:{self.port}"
+
+
+
+class ReplicaRouter:
+    """
+    Route read-only queries to the read replicas in a round-robin fashion.
+
+    Replicas that fail are taken out of rotation for a cooldown period, replicas
+    that lag behind the primary more than max_lag seconds are skipped and
+    databases that were written to recently stick to the primary so a client
+    always reads its own writes.
+    """
+
+    def __init__(self, replicas, max_lag=5, lag_check_interval=10, cooldown=30, sticky_seconds=5):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.cooldown = cooldown
+        self.sticky_seconds = sticky_seconds
+
+        self._index = 0
+        self._last_writes = {}
+        self._lock = threading.Lock()
+
+    def record_write(self, dbname):
+        """
+        Remember that dbname was written to so reads stick to the primary.
+
+        Only this process remembers, a read handled by another worker
+        process can still go to a replica.
+        """
+        with self._lock:
+            self._last_writes[dbname] = time.monotonic()
+
+    def is_sticky(self, dbname):
+        """
+        Check if reads on dbname should go to the primary.
+        """
+        with self._lock:
+            last_write = self._last_writes.get(dbname)
+            if last_write is None:
+                return False
+
+            if time.monotonic() - last_write < self.sticky_seconds:
+                return True
+
+            # Stickiness expired
+            del self._last_writes[dbname]
+            return False
+
+    def mark_unhealthy(self, replica):
+        """
+        Take a replica out of rotation for the cooldown period.
+        """
+        with self._lock:
+            replica.healthy = False
+            replica.unhealthy_until = time.monotonic() + self.cooldown
+        logger.error(f"Replica {replica} marked unhealthy for {self.cooldown} seconds.")
+
+    def _is_available(self, replica, now):
+        # Put the replica back in rotation after the cooldown
+        if not replica.healthy and now >= replica.unhealthy_until:
+            replica.healthy = True
+            logger.info(f"Replica {replica} back in rotation.")
+
+        return replica.healthy and replica.lag <= self.max_lag
+
+    def next_replica(self):
+        """
+        Return the next available replica, or None if there is none.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for _ in range(len(self.replicas)):
+                replica = self.replicas[self._index % len(self.replicas)]
+                self._index += 1
+
+                if self._is_available(replica, now):
+                    return replica
+
+        return None
+
+    def lag_check_due(self, replica):
+        """
+        Check if the replication lag of a replica should be measured again.
+        """
+        return time.monotonic() - replica.lag_checked_at >= self.lag_check_interval
+
+    def update_lag(self, replica, lag):
+        """
+        Store the measured replication lag of a replica.
+        """
+        with self._lock:
+            replica.lag = lag or 0
+            replica.lag_checked_at = time.monotonic()
+
+        if replica.lag > self.max_lag:
+            logger.error(f"Replica {replica} lags {replica.lag:.1f} seconds behind, skipping it.")
+
+    def route(self, dbconfig):
+        """
+        Return the replica a read on dbconfig should go to.
+
+        Args:
+            dbconfig (dict): The dbconfig of the primary.
+
+        Returns:
+            Replica: The replica to use or None for the primary.
+        """
+        if not self.replicas or self.is_sticky(dbconfig.get('dbname')):
+            return None
+
+        return self.next_replica()
+
+
+
+def parse_replicas(entries, default_port):
+    """
+    Parse a list of host[:port] into replicas.
+    """
+    replicas = []
+    for entry in entries:
+        host, _, port = entry.partition(":")
+        replicas.append(Replica(host, int(port) if port else default_port))
+
+    return replicas
+
+
+
+def get_replica_router():
+    """
+    Return the replica router, creating it from the settings on first use.
+    """
+    global _router
+
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                settings = get_settings()
+
+                _router = ReplicaRouter(
+                    parse_replicas(settings.db_read_replicas, settings.db_port),
+                    max_lag=settings.db_replica_max_lag,
+                    lag_check_interval=settings.db_replica_lag_check_interval,
+                    cooldown=settings.db_replica_cooldown,
+                    sticky_seconds=settings.db_read_your_writes_seconds,
+                )
+
+    return _router
+
+
+
+@on_reload
+def reset_replica_router(settings):
+    """
+    Build the replica router again from the reloaded settings.
+    """
+    global _router
+
+    # Plain assignment, this runs from the SIGHUP handler
+    _router = None
+
+
+_router = None
+_router_lock = threading.Lock()
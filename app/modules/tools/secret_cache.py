@@ -0,0 +1,252 @@
+# secret_cache.py
+
+import hashlib
+import hmac
+import os
+import time
+import threading
+
+from collections import OrderedDict
+
+from .encryption import decrypt_with_key
+from .logger import vadafi_logger
+from .settings import get_settings, on_reload
+
+logger = vadafi_logger()
+
+
+class CachedSecret:
+    """
+    The ciphertext and derived key of a revealed secret.
+
+    The plain text is never cached, it is decrypted again on every hit.
+    """
+
+    def __init__(self, password_check, encryption_key, iv, secret, expires_at, secrets_version=None):
+        self.password_check = password_check
+        self.encryption_key = bytearray(encryption_key)
+        self.iv = iv
+        self.secret = secret
+        self.expires_at = expires_at
+        self.secrets_version = secrets_version
+        self.size = len(password_check) + len(encryption_key) + len(iv) + len(secret)
+
+    def zeroize(self):
+        """
+        Overwrite the key material in place.
+        """
+        self.encryption_key[:] = bytes(len(self.encryption_key))
+        self.password_check = b""
+
+
+
+class SecretCache:
+    """
+    Bounded LRU cache of hot secrets with a TTL and a memory cap.
+
+    A hit still needs the user's password, it is checked against a keyed hash
+    taken when the entry was stored.
+
+    The cache is per process. Entries carry the user's secrets version, the
+    change counter in the vadafi database every worker bumps, and a hit
+    needs it to be unchanged, so a change made by another process is seen
+    on the next reveal instead of after the TTL.
+
+    Within the process every invalidation bumps a generation. A reveal takes the generation
+    before it reads the database and hands it to put, so a value read before
+    an update can not be stored after the update invalidated it.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=8 * 1024 * 1024, ttl=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        # Generation of the last invalidation per key, the oldest are folded into _floor
+        self._generation = 0
+        self._invalidated = OrderedDict()
+        self._floor = 0
+        self._max_invalidated = max(1024, max_entries * 4)
+        self._hmac_key = os.urandom(32)
+        self._lock = threading.Lock()
+
+    def _password_check(self, password):
+        return hmac.new(self._hmac_key, password.encode(), hashlib.sha256).digest()
+
+    def _remove(self, key):
+        # Caller holds the lock
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        entry.zeroize()
+
+    def get(self, user_id, secret_name, password, secrets_version=None):
+        """
+        Reveal a cached secret.
+
+        Args:
+            secrets_version (int): The current secrets version of the user.
+
+        Returns:
+            plain_text_secret (str): The secret, or None on a miss.
+        """
+        key = (user_id, secret_name)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Expired, or the user's secrets changed, possibly in another process
+            # Without a version, e.g. after a database error, a change can not be ruled out
+            if entry.expires_at <= time.monotonic() or secrets_version is None or entry.secrets_version != secrets_version:
+                self._remove(key)
+                self.evictions += 1
+                self.misses += 1
+                return None
+
+            # A wrong password never gets the cached key
+            if not hmac.compare_digest(entry.password_check, self._password_check(password)):
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            # Decrypt under the lock so eviction can not zeroize the key halfway
+            return decrypt_with_key(bytes(entry.encryption_key), entry.iv, entry.secret)
+
+    def generation(self):
+        """
+        Return the current generation, take it before reading a secret that will be put.
+        """
+        with self._lock:
+            return self._generation
+
+    def put(self, user_id, secret_name, password, encryption_key, iv, secret, generation, secrets_version=None):
+        """
+        Store the ciphertext and derived key of a secret.
+
+        Ignored if the secret was invalidated after generation was taken.
+        secrets_version must be read before the secret, like generation.
+        """
+        if self.max_entries <= 0 or secrets_version is None:
+            return
+
+        entry = CachedSecret(
+            self._password_check(password),
+            encryption_key,
+            iv,
+            secret,
+            time.monotonic() + self.ttl,
+            secrets_version
+            )
+        if entry.size > self.max_bytes:
+            entry.zeroize()
+            return
+
+        key = (user_id, secret_name)
+
+        with self._lock:
+            # Read before an invalidation, storing it would bring the old value back
+            if generation < self._floor or self._invalidated.get(key, 0) > generation:
+                entry.zeroize()
+                return
+
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = entry
+            self._bytes += entry.size
+
+            # Evict the least recently used entries
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, user_id, secret_name):
+        """
+        Drop a secret after it was added, updated or deleted.
+        """
+        key = (user_id, secret_name)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._generation += 1
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+
+            # Forgetting old invalidations only makes put stricter
+            while len(self._invalidated) > self._max_invalidated:
+                _, self._floor = self._invalidated.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop every secret.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def stats(self):
+        """
+        Return the counters and size of the cache.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+
+def get_secret_cache():
+    """
+    Return the secret cache, creating it from the settings on first use.
+    """
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                settings = get_settings()
+
+                _cache = SecretCache(
+                    max_entries=settings.secret_cache_max_entries,
+                    max_bytes=settings.secret_cache_max_bytes,
+                    ttl=settings.secret_cache_ttl,
+                )
+
+    return _cache
+
+
+
+@on_reload
+def reset_secret_cache(settings):
+    """
+    Start a new cache with the reloaded settings, the old one is zeroized.
+    """
+    global _cache
+
+    # Plain assignment, this runs from the SIGHUP handler
+    old_cache, _cache = _cache, None
+
+    if old_cache is not None:
+        threading.Thread(target=old_cache.clear, daemon=True).start()
+
+
+_cache = None
+_cache_lock = threading.Lock()
@@ -0,0 +1,229 @@
+# settings.py
+
+import os
+import signal
+import threading
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from dotenv import dotenv_values
+
+from .logger import vadafi_logger
+
+logger = vadafi_logger()
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Typed vadafi settings, loaded once from the environment and an optional .env file.
+    """
+
+    db_user: str
+    db_password: str
+    db_host: str
+    db_port: int
+    api_secret: str
+    db_read_replicas: tuple = field(default_factory=tuple)
+    db_replica_max_lag: float = 5
+    db_replica_lag_check_interval: float = 10
+    db_replica_cooldown: float = 30
+    db_read_your_writes_seconds: float = 5
+    db_pool_size: int = 10
+    db_pool_timeout: float = 5
+    db_pool_ping_after: float = 30
+    db_tenant_connection_budget: int = 50
+    db_tenant_pool_size: int = 2
+    db_tenant_idle_timeout: float = 60
+    crypto_workers: int = 0
+    crypto_max_queue: int = 32
+    status_token: str = ''
+    trusted_proxies: int = 0
+    rate_limit_redis_url: str = ''
+    rate_limit_ip_per_minute: float = 30
+    rate_limit_ip_burst: float = 10
+    rate_limit_user_per_minute: float = 10
+    rate_limit_user_burst: float = 5
+    rate_limit_secrets_ip_per_minute: float = 12_000
+    rate_limit_secrets_ip_burst: float = 1000
+    rate_limit_secrets_user_per_minute: float = 6000
+    rate_limit_secrets_user_burst: float = 500
+    lockout_threshold: int = 5
+    lockout_base_seconds: float = 1
+    lockout_max_seconds: float = 900
+    json_provider: str = 'auto'
+    compress_min_size: int = 1024
+    compress_level: int = 5
+    secret_version_retention: int = 10
+    secret_cache_max_entries: int = 1024
+    secret_cache_max_bytes: int = 8 * 1024 * 1024
+    secret_cache_ttl: float = 60
+    secret_purge_delay: float = 7 * 24 * 60 * 60
+    job_workers: int = 2
+    job_poll_interval: float = 1
+    job_timeout: float = 300
+    job_retention_days: int = 7
+    async_provisioning: bool = False
+    idempotency_ttl: float = 24 * 60 * 60
+    audit_batch_size: int = 500
+    audit_flush_interval: float = 1
+    audit_max_buffer: int = 100_000
+    audit_retention_days: int = 365
+
+
+
+def load_settings(env_file=None):
+    """
+    Load and validate the settings.
+
+    Values in the environment take precedence over values in the .env file,
+    just like load_dotenv does.
+
+    Args:
+        env_file (str): Path to the .env file, VADAFI_ENV_FILE or .env if None.
+
+    Returns:
+        settings (Settings)
+
+    Raises:
+        ValueError: If a setting is missing or invalid.
+    """
+
+    # Read the optional .env file without touching os.environ
+    env_path = Path(env_file or os.getenv('VADAFI_ENV_FILE', '.env'))
+    values = dotenv_values(env_path) if env_path.is_file() else {}
+    values.update(os.environ)
+
+    # Check if all required settings are provided
+    required = ['DB_USER', 'DB_PASSWORD', 'DB_HOST', 'DB_PORT', 'API_SECRET']
+    missing = [name for name in required if not values.get(name)]
+    if missing:
+        raise ValueError(f"Missing required settings: {', '.join(missing)}")
+
+    try:
+        return Settings(
+            db_user=values['DB_USER'],
+            db_password=values['DB_PASSWORD'],
+            db_host=values['DB_HOST'],
+            db_port=int(values['DB_PORT']),
+            api_secret=values['API_SECRET'],
+            db_read_replicas=tuple(
+                replica.strip() for replica in values.get('DB_READ_REPLICAS', '').split(',') if replica.strip()
+                ),
+            db_replica_max_lag=float(values.get('DB_REPLICA_MAX_LAG', 5)),
+            db_replica_lag_check_interval=float(values.get('DB_REPLICA_LAG_CHECK_INTERVAL', 10)),
+            db_replica_cooldown=float(values.get('DB_REPLICA_COOLDOWN', 30)),
+            db_read_your_writes_seconds=float(values.get('DB_READ_YOUR_WRITES_SECONDS', 5)),
+            db_pool_size=int(values.get('DB_POOL_SIZE', 10)),
+            db_pool_timeout=float(values.get('DB_POOL_TIMEOUT', 5)),
+            db_pool_ping_after=float(values.get('DB_POOL_PING_AFTER', 30)),
+            db_tenant_connection_budget=int(values.get('DB_TENANT_CONNECTION_BUDGET', 50)),
+            db_tenant_pool_size=int(values.get('DB_TENANT_POOL_SIZE', 2)),
+            db_tenant_idle_timeout=float(values.get('DB_TENANT_IDLE_TIMEOUT', 60)),
+            crypto_workers=int(values.get('CRYPTO_WORKERS', 0)),
+            crypto_max_queue=int(values.get('CRYPTO_MAX_QUEUE', 32)),
+            status_token=values.get('STATUS_TOKEN', ''),
+            trusted_proxies=int(values.get('TRUSTED_PROXIES', 0)),
+            rate_limit_redis_url=values.get('RATE_LIMIT_REDIS_URL', ''),
+            rate_limit_ip_per_minute=float(values.get('RATE_LIMIT_IP_PER_MINUTE', 30)),
+            rate_limit_ip_burst=float(values.get('RATE_LIMIT_IP_BURST', 10)),
+            rate_limit_user_per_minute=float(values.get('RATE_LIMIT_USER_PER_MINUTE', 10)),
+            rate_limit_user_burst=float(values.get('RATE_LIMIT_USER_BURST', 5)),
+            rate_limit_secrets_ip_per_minute=float(values.get('RATE_LIMIT_SECRETS_IP_PER_MINUTE', 12_000)),
+            rate_limit_secrets_ip_burst=float(values.get('RATE_LIMIT_SECRETS_IP_BURST', 1000)),
+            rate_limit_secrets_user_per_minute=float(values.get('RATE_LIMIT_SECRETS_USER_PER_MINUTE', 6000)),
+            rate_limit_secrets_user_burst=float(values.get('RATE_LIMIT_SECRETS_USER_BURST', 500)),
+            lockout_threshold=int(values.get('LOCKOUT_THRESHOLD', 5)),
+            lockout_base_seconds=float(values.get('LOCKOUT_BASE_SECONDS', 1)),
+            lockout_max_seconds=float(values.get('LOCKOUT_MAX_SECONDS', 900)),
+            json_provider=values.get('JSON_PROVIDER', 'auto'),
+            compress_min_size=int(values.get('COMPRESS_MIN_SIZE', 1024)),
+            compress_level=int(values.get('COMPRESS_LEVEL', 5)),
+            secret_version_retention=int(values.get('SECRET_VERSION_RETENTION', 10)),
+            secret_cache_max_entries=int(values.get('SECRET_CACHE_MAX_ENTRIES', 1024)),
+            secret_cache_max_bytes=int(values.get('SECRET_CACHE_MAX_BYTES', 8 * 1024 * 1024)),
+            secret_cache_ttl=float(values.get('SECRET_CACHE_TTL', 60)),
+            secret_purge_delay=float(values.get('SECRET_PURGE_DELAY', 7 * 24 * 60 * 60)),
+            job_workers=int(values.get('JOB_WORKERS', 2)),
+            job_poll_interval=float(values.get('JOB_POLL_INTERVAL', 1)),
+            job_timeout=float(values.get('JOB_TIMEOUT', 300)),
+            job_retention_days=int(values.get('JOB_RETENTION_DAYS', 7)),
+            async_provisioning=values.get('ASYNC_PROVISIONING', 'false').lower() in ('1', 'true', 'yes'),
+            idempotency_ttl=float(values.get('IDEMPOTENCY_TTL', 24 * 60 * 60)),
+            audit_batch_size=int(values.get('AUDIT_BATCH_SIZE', 500)),
+            audit_flush_interval=float(values.get('AUDIT_FLUSH_INTERVAL', 1)),
+            audit_max_buffer=int(values.get('AUDIT_MAX_BUFFER', 100_000)),
+            audit_retention_days=int(values.get('AUDIT_RETENTION_DAYS', 365)),
+        )
+
+    except ValueError as e:
+        raise ValueError(f"Invalid setting: {e}") from e
+
+
+
+def get_settings():
+    """
+    Return the settings, loading them on first use.
+    """
+    global _settings
+
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = load_settings()
+
+    return _settings
+
+
+
+def reload_settings():
+    """
+    Load the settings again and notify everything that cached values derived from them.
+
+    The old settings stay active if the new ones are invalid.
+    """
+    global _settings
+
+    try:
+        settings = load_settings()
+    except ValueError as e:
+        logger.error(f"Error occured while reloading settings, keeping the current ones. {e}")
+        return get_settings()
+
+    with _settings_lock:
+        _settings = settings
+
+    for callback in _reload_callbacks:
+        callback(settings)
+
+    logger.info("Reloaded settings.")
+    return settings
+
+
+
+def on_reload(callback):
+    """
+    Register a callback that is called with the new settings after a reload.
+    """
+    _reload_callbacks.append(callback)
+    return callback
+
+
+
+def install_reload_handler():
+    """
+    Reload the settings on SIGHUP.
+
+    Signal handlers can only be installed from the main thread, so this is a
+    no-op anywhere else and on platforms without SIGHUP.
+    """
+    if not hasattr(signal, 'SIGHUP') or threading.current_thread() is not threading.main_thread():
+        return False
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_settings())
+    return True
+
+
+_settings = None
+_settings_lock = threading.RLock()
+_reload_callbacks = []
@@ -0,0 +1,184 @@
+# tenant_schema.py
+
+import threading
+
+from .authentication import get_admin_dbconfig
+from .execute_query import execute_query
+from .jobs import enqueue_job, job_handler
+from .logger import vadafi_logger
+
+logger = vadafi_logger()
+
+# Migrations of a user's database, in order
+# Every migration is applied once and recorded in vadafi_schema
+MIGRATIONS = [
+    (1, """
+    CREATE TABLE IF NOT EXISTS secrets (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        secret TEXT NOT NULL,
+        salt VARCHAR(255) NOT NULL,
+        iv VARCHAR(255) NOT NULL
+    );
+    """),
+    (2, """
+    -- Versioned secrets, the secrets row always holds the current version
+    ALTER TABLE secrets ADD COLUMN IF NOT EXISTS current_version INTEGER NOT NULL DEFAULT 1;
+
+    -- Older releases checked the name before inserting, so a race could store a name twice
+    -- The oldest secret keeps the name, the others get their id appended
+    UPDATE secrets s SET name = LEFT(s.name, 230) || '_duplicate_' || s.id
+    WHERE EXISTS (SELECT 1 FROM secrets o WHERE o.name = s.name AND o.id < s.id);
+    CREATE UNIQUE INDEX IF NOT EXISTS secrets_name_idx ON secrets (name);
+
+    CREATE TABLE IF NOT EXISTS secret_versions (
+        secret_id INTEGER NOT NULL REFERENCES secrets (id) ON DELETE CASCADE,
+        version INTEGER NOT NULL,
+        secret TEXT NOT NULL,
+        salt VARCHAR(255) NOT NULL,
+        iv VARCHAR(255) NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (secret_id, version)
+    );
+
+    INSERT INTO secret_versions (secret_id, version, secret, salt, iv)
+    SELECT id, current_version, secret, salt, iv FROM secrets
+    ON CONFLICT DO NOTHING;
+    """),
+    (3, """
+    -- Opt-in for the in-memory cache of hot secrets
+    ALTER TABLE secrets ADD COLUMN IF NOT EXISTS cached BOOLEAN NOT NULL DEFAULT FALSE;
+    """),
+    (4, """
+    -- Soft delete, names are only unique among live secrets
+    ALTER TABLE secrets ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+    DROP INDEX IF EXISTS secrets_name_idx;
+    CREATE UNIQUE INDEX IF NOT EXISTS secrets_live_name_idx ON secrets (name) WHERE deleted_at IS NULL;
+    CREATE INDEX IF NOT EXISTS secrets_live_name_prefix_idx ON secrets (name text_pattern_ops) WHERE deleted_at IS NULL;
+    CREATE INDEX IF NOT EXISTS secrets_deleted_at_idx ON secrets (deleted_at) WHERE deleted_at IS NOT NULL;
+    """),
+]
+
+# Tables in a user's database, owned by the user
+TENANT_TABLES = ['vadafi_schema', 'secrets', 'secret_versions']
+
+# Databases that are known to be up to date in this process
+_migrated = set()
+
+# One lock per database being checked, so tenants never wait for each other
+_migrating = {}
+_migrating_lock = threading.Lock()
+
+
+def migrate_tenant_schema(dbconfig):
+    """
+    Apply the missing migrations to a user's database.
+
+    Args:
+        dbconfig (dict): The dbconfig of the user's database.
+
+    Returns:
+        int: The schema version of the database.
+    """
+
+    execute_query(
+        "CREATE TABLE IF NOT EXISTS vadafi_schema (version INTEGER NOT NULL)",
+        dbconfig=dbconfig
+        )
+    result = execute_query(
+        "SELECT COALESCE(MAX(version), 0) FROM vadafi_schema",
+        return_data=True,
+        dbconfig=dbconfig,
+        read_only=False
+        )
+    current_version = result[0][0]
+
+    for version, query in MIGRATIONS:
+        if version <= current_version:
+            continue
+
+        # The advisory lock keeps concurrent migrations of the same database apart
+        # Migrations are idempotent, so one that was applied meanwhile does no harm
+        applied = execute_query(
+            "SELECT pg_advisory_xact_lock(hashtext('vadafi_schema'));"
+            + query
+            + f"INSERT INTO vadafi_schema (version) VALUES ({version});",
+            dbconfig=dbconfig
+            )
+        if not applied:
+            raise RuntimeError(f"Migration {version} of {dbconfig['dbname']} failed.")
+
+        logger.info(f"Applied migration {version} to {dbconfig['dbname']}.")
+        current_version = version
+
+    return current_version
+
+
+
+def ensure_tenant_schema(dbconfig):
+    """
+    Make sure a user's database is up to date, at most once per process.
+
+    Args:
+        dbconfig (dict): The dbconfig of the user's database.
+    """
+    dbname = dbconfig['dbname']
+    if dbname in _migrated:
+        return
+
+    with _migrating_lock:
+        lock = _migrating.setdefault(dbname, threading.Lock())
+
+    try:
+        with lock:
+            if dbname in _migrated:
+                return
+
+            migrate_tenant_schema(dbconfig)
+            _migrated.add(dbname)
+
+    finally:
+        # A request that arrives after this gets a new lock, the advisory lock
+        # in migrate_tenant_schema still keeps the migrations apart
+        with _migrating_lock:
+            if _migrating.get(dbname) is lock:
+                del _migrating[dbname]
+
+
+
+def set_tenant_owner(dbconfig, db_user_name):
+    """
+    Hand the tables of a user's database over to the user's database user.
+
+    Needed after the admin created or migrated them.
+    """
+    for table in TENANT_TABLES:
+        execute_query(f"ALTER TABLE IF EXISTS public.{table} OWNER TO {db_user_name};", dbconfig=dbconfig)
+
+
+
+@job_handler("migrate_tenant", concurrency=2)
+def migrate_tenant_job(payload):
+    """
+    Migrate the database of a user in the background, as the admin.
+    """
+    user_id = payload["user_id"]
+    dbconfig = get_admin_dbconfig(f"db_{user_id}")
+
+    migrate_tenant_schema(dbconfig)
+    set_tenant_owner(dbconfig, f"user_{user_id}")
+
+
+
+@job_handler("migrate_tenants", concurrency=1, every=24 * 60 * 60)
+def migrate_tenants_job(payload):
+    """
+    Queue a migration for every user, so no request has to wait for one.
+    """
+    result = execute_query(
+        "SELECT user_id FROM vadafi_users ORDER BY user_id",
+        return_data=True,
+        dbconfig=get_admin_dbconfig()
+        )
+    for (user_id,) in result:
+        enqueue_job("migrate_tenant", {"user_id": user_id})
@@ -3,11 +3,15 @@
 import re
 from flask import jsonify
 
+from .tools.audit import audit_event
 from .tools.encryption import hash_secret
 from .tools.execute_query import execute_query
 from .tools.logger import vadafi_logger
 from .tools.authentication import get_admin_dbconfig
-from .tools.authentication import get_user_id
+from .tools.authentication import forget_user_id
+from .tools.jobs import enqueue_job, job_handler
+from .tools.settings import get_settings
+from .tools.tenant_schema import migrate_tenant_schema, set_tenant_owner
 logger = vadafi_logger()
 
 def check_username_validity(username):
@@ -15,32 +19,91 @@ def check_username_validity(username):
 
 
 
-def check_username_availability(username):
+def provision_user_database(user_id):
     """
-    Check if username is available in the vadafi_users table.
+    Create the database of a user and hand it over to the user's database user.
+
+    Args:
+        user_id (INT): The user's unique identifier.
     """
-    try:
-        # Get the dbconfig
-        dbconfig = get_admin_dbconfig()
 
-        # Create the query
-        query = """
-        SELECT COUNT(*) FROM vadafi_users WHERE username = %s
-        """
-        result = execute_query(
-            query,
-            params=(username,),
-            return_data=True,
-            dbconfig=dbconfig
-            )
-        if result[0][0] == 0:
-            return True
-        else:
-            return False
-    
-    except Exception as e:
-        logger.error(f"Error occured while checking username availability.")
-        return False
+    # Name database & database_user based on user's unique identifier
+    db_name = f"db_{user_id}"
+    db_user_name = f"user_{user_id}"
+
+    # Get the dbconfig for the user database
+    # This will also be as the admin
+    vadafi_dbconfig = get_admin_dbconfig()
+    user_dbconfig = get_admin_dbconfig(db_name)
+
+    # Create database
+    # Safe to run again, retried jobs find the database already there
+    exists = execute_query(
+        "SELECT 1 FROM pg_database WHERE datname = %s",
+        params=(db_name,),
+        return_data=True,
+        dbconfig=vadafi_dbconfig,
+        read_only=False
+        )
+    if not exists:
+        if not execute_query(f"CREATE DATABASE {db_name}", autocommit=True, dbconfig=vadafi_dbconfig):
+            raise RuntimeError(f"Could not create {db_name}.")
+        logger.info(f"Created {db_name}.")
+
+    # Create the secret tables
+    migrate_tenant_schema(user_dbconfig)
+    logger.info(f"Created tables on {db_name}.")
+
+    # Configure the user's privileges
+    # Every statement can run again
+    for query in [
+        f"ALTER DATABASE {db_name} OWNER TO {db_user_name};",
+        f"ALTER SCHEMA public OWNER TO {db_user_name};",
+        f"GRANT ALL PRIVILEGES ON SCHEMA public TO {db_user_name};",
+        f"GRANT USAGE, CREATE ON SCHEMA public TO {db_user_name};",
+        ]:
+        if not execute_query(query, dbconfig=user_dbconfig):
+            raise RuntimeError(f"Could not configure privileges of {db_user_name} in {db_name}.")
+
+    set_tenant_owner(user_dbconfig, db_user_name)
+
+    for query in [
+        f"ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT ALL ON TABLES TO {db_user_name};",
+        f"ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT ALL ON SEQUENCES TO {db_user_name};",
+        f"ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT ALL ON FUNCTIONS TO {db_user_name};",
+        ]:
+        if not execute_query(query, dbconfig=user_dbconfig):
+            raise RuntimeError(f"Could not configure privileges of {db_user_name} in {db_name}.")
+
+    logger.info(f"Configured privileges for {db_user_name} in database {db_name}.")
+
+
+
+def remove_user(user_id, username):
+    """
+    Undo a user creation that failed halfway, so the username can be used again.
+
+    Args:
+        user_id (INT): The user's unique identifier.
+        username (STR): The user's username.
+    """
+    vadafi_dbconfig = get_admin_dbconfig()
+
+    execute_query(f"DROP DATABASE IF EXISTS db_{user_id} WITH (FORCE)", autocommit=True, dbconfig=vadafi_dbconfig)
+    execute_query(f"DROP ROLE IF EXISTS user_{user_id}", dbconfig=vadafi_dbconfig)
+    execute_query("DELETE FROM vadafi_users WHERE user_id = %s", params=(user_id,), dbconfig=vadafi_dbconfig)
+    forget_user_id(username)
+
+    logger.info(f"Removed the half created user {username}.")
+
+
+
+@job_handler("provision_user", concurrency=2)
+def provision_user_job(payload):
+    """
+    Provision the database of a user in the background.
+    """
+    provision_user_database(payload["user_id"])
 
 
 
@@ -67,16 +130,6 @@ def create_user(username, password):
             "message": "Sorry, this username is not valid."
         }), 200
 
-    # Check if username is available
-    if check_username_availability(username):
-        pass
-    else:
-        # Return username not available
-        return jsonify({
-            "error": "Username unavailable",
-            "message": "Sorry, this username is not available."
-        }), 200
-
     try:
         # Get the dbconfig for the vadafi database
         vadafi_dbconfig = get_admin_dbconfig()
@@ -85,71 +138,85 @@ def create_user(username, password):
         hashed_data = hash_secret(password)
 
         # Add user to vadafi_users
+        # The unique username decides between parallel requests, the loser stops here before any DDL
+        # Not sticky, the login reads a user missing on a replica again on the primary, see read_user
         query="""
         INSERT INTO vadafi_users (username, master_secret_hash, salt)
         VALUES (%s, %s, %s)
+        ON CONFLICT (username) DO NOTHING
+        RETURNING user_id
         """
-        execute_query(
+        result = execute_query(
             query,
             params=(username, hashed_data["secret_hash"], hashed_data["salt"]),
-            dbconfig=vadafi_dbconfig
+            return_data=True,
+            dbconfig=vadafi_dbconfig,
+            sticky=False
             )
-        logger.info(f"Created user {username} in vadafi_users table.")
-    
-        # Name database & database_user based on user's unique identifier
-        user_id = get_user_id(username) 
-        db_name = f"db_{user_id}"
-        db_user_name = f"user_{user_id}"
+        if result is False:
+            raise RuntimeError("Database error while adding the user.")
 
-        # Get the dbconfig for the user database
-        # This will also be as the admin
-        user_dbconfig = get_admin_dbconfig(db_name)
-        
-        # Create database
-        execute_query(
-            f"CREATE DATABASE {db_name}",
-            autocommit=True,
-            dbconfig=vadafi_dbconfig
-            )
-        logger.info(f"Created {db_name}.")
+    except Exception as e:
+        logger.error(f"Error occured while trying to create user {username} in vadafi database {e}")
+        audit_event("create_user", username, "failure")
+
+        # Return error
+        return jsonify({
+            "error": "Error occured creating user",
+            "message": "Sorry, we could not create your user at this moment."
+        }), 400
+
+    if not result:
+        audit_event("create_user", username, "unavailable")
+
+        # Return username not available
+        return jsonify({
+            "error": "Username unavailable",
+            "message": "Sorry, this username is not available."
+        }), 200
+
+    user_id = result[0][0]
+    logger.info(f"Created user {username} in vadafi_users table.")
+
+    # 503 when only the job queue failed, the client may simply retry
+    status_code = 400
+
+    try:
+        # Name database_user based on user's unique identifier
+        db_user_name = f"user_{user_id}"
 
         # Create database user
-        execute_query(
+        # The password is only known now, so this never runs in the background
+        created = execute_query(
             f"CREATE USER {db_user_name} WITH PASSWORD %s",
             params=(password,),
             dbconfig=vadafi_dbconfig
             )
+        if not created:
+            raise RuntimeError(f"Could not create {db_user_name}.")
         logger.info(f"Created {db_user_name}.")
 
-        # Create secret table
-        query = """
-        CREATE TABLE secrets (
-            id SERIAL PRIMARY KEY,
-            name VARCHAR(255) NOT NULL,
-            secret TEXT NOT NULL,
-            salt VARCHAR(255) NOT NULL,
-            iv VARCHAR(255) NOT NULL
-        );
-        """
-        execute_query(
-                query, 
-                dbconfig=user_dbconfig
-                )
-        logger.info(f"Created table 'secrets' on {db_name}.")
-
-        # Configure the user's privileges
-        execute_query(f"ALTER DATABASE {db_name} OWNER TO {db_user_name};", dbconfig=user_dbconfig)
-        execute_query(f"ALTER SCHEMA public OWNER TO {db_user_name};", dbconfig=user_dbconfig)
-        execute_query(f"GRANT ALL PRIVILEGES ON SCHEMA public TO {db_user_name};", dbconfig=user_dbconfig)
-        execute_query(f"GRANT USAGE, CREATE ON SCHEMA public TO {db_user_name};", dbconfig=user_dbconfig)
-        execute_query(f"ALTER TABLE public.secrets OWNER TO {db_user_name};", dbconfig=user_dbconfig)
-        execute_query(f"ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT ALL ON TABLES TO {db_user_name};", dbconfig=user_dbconfig)
-        execute_query(f"ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT ALL ON SEQUENCES TO {db_user_name};", dbconfig=user_dbconfig)
-        execute_query(f"ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT ALL ON FUNCTIONS TO {db_user_name};", dbconfig=user_dbconfig)
-        logger.info(f"Configured privileges for {db_user_name} in database {db_name}.")
+        # Create the user's database, now or in the background
+        if get_settings().async_provisioning:
+            job_id = enqueue_job("provision_user", {"user_id": user_id})
+
+            # Without the job the database would never be provisioned, release the username
+            if job_id is None:
+                status_code = 503
+                raise RuntimeError("Could not queue the provisioning of the user.")
+
+            audit_event("create_user", username, "provisioning")
+
+            return jsonify({
+                "message": "User created succesfully, the vault is being provisioned.",
+                "job_id": job_id
+            }), 202
+
+        provision_user_database(user_id)
 
         # Log the success
         logger.info(f"Succesfully created user {username}!")
+        audit_event("create_user", username, "success")
 
         return jsonify({
             "message": "User created succesfully."
@@ -157,9 +224,19 @@ def create_user(username, password):
 
     except Exception as e:
         logger.error(f"Error occured while trying to create user {username} in vadafi database {e}")
-        
+        audit_event("create_user", username, "failure")
+
+        # Leave nothing half provisioned behind, so a retry starts clean
+        try:
+            remove_user(user_id, username)
+        except Exception as e:
+            logger.error(f"Error occured while removing the half created user {username}. {e}")
+
         # Return error
-        return jsonify({
+        response = jsonify({
             "error": "Error occured creating user",
             "message": "Sorry, we could not create your user at this moment."
-        }), 400
+        })
+        if status_code == 503:
+            response.headers['Retry-After'] = "1"
+        return response, status_code
@@ -1,43 +1,126 @@
 # vadafi.py
 
-import os
-from flask import Flask, render_template, request, jsonify
+import datetime
+import weakref
+
+from flask import Blueprint, Flask, render_template, request, jsonify
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from flask_cors import CORS
-from pathlib import Path
-from dotenv import load_dotenv
- 
-from modules.tools.authentication import authenticate_user
+
+from modules.tools.audit import audit_event, fetch_audit_events, utc_now
+from modules.tools.authentication import authenticate_user, get_user_id
+from modules.tools.compression import init_compression
+from modules.tools.idempotency import idempotent
+from modules.tools.jobs import count_jobs, get_job, get_scheduler
+from modules.tools.json_provider import init_json_provider
 from modules.tools.logger import vadafi_logger
+from modules.tools.rate_limit import get_rate_limiter, rate_limited
+from modules.tools.settings import get_settings, install_reload_handler, on_reload
+from modules.backup import export_secrets, import_secrets
+from modules.status import check_readiness, get_status
 from modules.users import create_user
-from modules.secrets import add_secret, fetch_secrets, reveal_secret
+from modules.secrets import add_secret, update_secret, fetch_secrets, fetch_secret_versions, reveal_secret
+from modules.secrets import delete_secret, bulk_delete_secrets, reveal_secrets
 
 logger = vadafi_logger()
 
-# Load the env variables
-env_path = Path('.env')
-load_dotenv(env_path)
+# The routes of the API, registered on the app by create_app
+api = Blueprint('vadafi', __name__)
+
+# Apps made by create_app, held weakly so discarded apps are not kept alive by the reload callback
+_apps = weakref.WeakSet()
+
+
+def create_app(config='config.Config', start_jobs=None):
+    """
+    Create the vadafi app.
+
+    Args:
+        config (str): The config object or its import path.
+        start_jobs (bool): Run the background jobs in this process, if JOB_WORKERS is set when None.
+
+    Returns:
+        app (Flask): The app.
+    """
+    from flask_cors import CORS
+
+    # Initialize flask
+    app = Flask(__name__)
+    CORS(app)
+    app.config.from_object(config)
+    app.config.setdefault('JWT_SECRET_KEY', get_settings().api_secret)
+    JWTManager(app)
+    init_json_provider(app)
+    init_compression(app)
+
+    # Use the client address set by our load balancers for rate limiting
+    if get_settings().trusted_proxies:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=get_settings().trusted_proxies)
+
+    app.register_blueprint(api)
+
+    # Reload the settings on SIGHUP
+    install_reload_handler()
+    _apps.add(app)
+
+    # Run the background jobs next to the API, also under a WSGI server
+    if start_jobs is None:
+        start_jobs = get_settings().job_workers > 0
+    if start_jobs:
+        get_scheduler().start()
+
+    return app
+
 
-# Initialize flask
-app = Flask(__name__)
-CORS(app)
-app.config.from_object('config.Config')
 
-# Set jwt secret
-app.config['JWT_SECRET_KEY'] = os.getenv('API_SECRET')
-jwt = JWTManager(app)
+@on_reload
+def reload_jwt_secret(settings):
+    """
+    Give every live app the reloaded JWT secret.
+    """
+    for app in list(_apps):
+        app.config['JWT_SECRET_KEY'] = settings.api_secret
 
 
-@app.route('/')
+
+def __getattr__(name):
+    # Keep `vadafi:app` working for WSGI servers, the app is created on first access
+    global app
+
+    if name == 'app':
+        app = create_app()
+        return app
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@api.route('/')
 def home():
     return render_template('index.html')
 
-@app.route('/about')
+@api.route('/about')
 def about():
     return "This is the about page!"
 
+# Routes for load balancers and monitoring, never the database of a user
+# /status needs the status token, see get_status
+@api.route('/healthz')
+def healthz():
+    # The process is alive, no I/O
+    return jsonify({"status": "ok"}), 200
+
+@api.route('/readyz')
+def readyz():
+    return check_readiness()
+
+@api.route('/status')
+def status():
+    return get_status()
+
 # Route for creating user
-@app.route('/create_user', methods=['POST'])
+@api.route('/create_user', methods=['POST'])
+@rate_limited
+@idempotent
 def create_user_api():
 
     # Get data from request
@@ -64,7 +147,8 @@ def create_user_api():
 
 
 # Route for requesting JWT token
-@app.route('/get_jwt_token', methods=['POST'])
+@api.route('/get_jwt_token', methods=['POST'])
+@rate_limited
 def get_jwt_token_api():
     
     # Get data from request
@@ -77,10 +161,17 @@ def get_jwt_token_api():
     if not isinstance(auth_result, tuple):
         return jsonify({"error": "Internal Server Error", "message": "Unexpected response from authentication"}), 500
     if auth_result[0] is not True:
+        # Count failed logins towards the lockout
+        if auth_result[1] == 401:
+            get_rate_limiter().record_failure(data['username'])
+            audit_event("authenticate", data['username'], "failure")
+
         return auth_result
 
     # Create access token
     username = auth_result[1]
+    get_rate_limiter().record_success(username)
+    audit_event("authenticate", username, "success")
     access_token = create_access_token(identity=username)
 
     # Return the jwt token
@@ -92,7 +183,7 @@ def get_jwt_token_api():
 
 
 
-@app.route('/protected', methods=['GET'])
+@api.route('/protected', methods=['GET'])
 @jwt_required()
 def protected_route():
     # Get the username
@@ -106,8 +197,10 @@ def protected_route():
 
 
 
-@app.route('/add_secret', methods=['POST'])
+@api.route('/add_secret', methods=['POST'])
 @jwt_required()
+@rate_limited(scope="secrets")
+@idempotent
 def add_secret_api():
     # Get the data
     data = request.get_json()
@@ -131,14 +224,50 @@ def add_secret_api():
             username,
             password,
             secret_name,
-            plain_text_secret
+            plain_text_secret,
+            cached=data.get('cached', False)
+        )
+
+    return result
+
+
+@api.route('/update_secret', methods=['POST'])
+@jwt_required()
+@rate_limited(scope="secrets")
+@idempotent
+def update_secret_api():
+    # Get the data
+    data = request.get_json()
+
+    # Check if al data is provided
+    if not data or 'username' not in data or 'password' not in data or 'secret_name' not in data or 'plain_text_secret' not in data:
+        # Return bad request if not
+        return jsonify({
+            "error": "Bad request",
+            "message": "Username, password, secret_name, plain_text_secret are required."
+        }), 400
+
+    # Get the data from dict
+    username = data['username']
+    password = data['password']
+    secret_name = data['secret_name']
+    plain_text_secret = data['plain_text_secret']
+
+    # Store the new version
+    result = update_secret(
+            username,
+            password,
+            secret_name,
+            plain_text_secret,
+            cached=data.get('cached')
         )
 
     return result
 
 
-@app.route('/fetch_secrets', methods=['GET'])
+@api.route('/fetch_secrets', methods=['GET'])
 @jwt_required()
+@rate_limited(scope="secrets")
 def fetch_secrets_api():
     # Get the data
     data = request.get_json()
@@ -155,14 +284,15 @@ def fetch_secrets_api():
     username = data['username']
     password = data['password']
 
-    result = fetch_secrets(username, password) 
+    result = fetch_secrets(username, password, request.if_none_match) 
     
     return result
 
 
 
-@app.route('/reveal_secret', methods=['GET'])
+@api.route('/reveal_secret', methods=['GET'])
 @jwt_required()
+@rate_limited(scope="secrets")
 def reveal_secret_api():
     # Get the data
     data = request.get_json()
@@ -179,13 +309,293 @@ def reveal_secret_api():
     username = data['username']
     password = data['password']
     secret_name = data['secret_name']
+    version = data.get('version')
 
     # Reveal the secret
-    result = reveal_secret(username, password, secret_name) 
+    result = reveal_secret(username, password, secret_name, version) 
     
     return result
 
 
+
+@api.route('/reveal_secrets', methods=['GET'])
+@jwt_required()
+@rate_limited(scope="secrets")
+def reveal_secrets_api():
+    # Get the data
+    data = request.get_json()
+
+    # Check if al data is provided
+    if not data or 'username' not in data or 'password' not in data or not isinstance(data.get('secret_names'), list):
+        # Return bad request if not
+        return jsonify({
+            "error": "Bad request",
+            "message": "Username, password and a list of secret_names are required."
+        }), 400
+
+    # Every secret costs a key derivation, so keep batches bounded
+    if len(data['secret_names']) > 100:
+        return jsonify({
+            "error": "Bad request",
+            "message": "At most 100 secret_names can be revealed at once."
+        }), 400
+
+    # Get the data from the dict
+    username = data['username']
+    password = data['password']
+    secret_names = data['secret_names']
+
+    # Reveal the secrets
+    result = reveal_secrets(username, password, secret_names)
+
+    return result
+
+
+
+@api.route('/fetch_secret_versions', methods=['GET'])
+@jwt_required()
+@rate_limited(scope="secrets")
+def fetch_secret_versions_api():
+    # Get the data
+    data = request.get_json()
+
+    # Check if al data is provided
+    if not data or 'username' not in data or 'password' not in data or 'secret_name' not in data:
+        # Return bad request if not
+        return jsonify({
+            "error": "Bad request",
+            "message": "Username, password and secret_name are required."
+        }), 400
+
+    # Get the data from the dict
+    username = data['username']
+    password = data['password']
+    secret_name = data['secret_name']
+
+    result = fetch_secret_versions(username, password, secret_name)
+
+    return result
+
+
+@api.route('/delete_secret', methods=['DELETE'])
+@jwt_required()
+@rate_limited(scope="secrets")
+def delete_secret_api():
+    # Get the data
+    data = request.get_json()
+
+    # Check if al data is provided
+    if not data or 'username' not in data or 'password' not in data or 'secret_name' not in data:
+        # Return bad request if not
+        return jsonify({
+            "error": "Bad request",
+            "message": "Username, password and secret_name are required."
+        }), 400
+
+    # Get the data from the dict
+    username = data['username']
+    password = data['password']
+    secret_name = data['secret_name']
+
+    # Delete the secret
+    result = delete_secret(username, password, secret_name)
+
+    return result
+
+
+
+@api.route('/delete_secrets', methods=['DELETE'])
+@jwt_required()
+@rate_limited(scope="secrets")
+def delete_secrets_api():
+    # Get the data
+    data = request.get_json()
+
+    # Check if al data is provided
+    # Either a list of names or a non-empty prefix
+    if (not data or 'username' not in data or 'password' not in data
+            or not (isinstance(data.get('secret_names'), list) or data.get('prefix'))):
+        # Return bad request if not
+        return jsonify({
+            "error": "Bad request",
+            "message": "Username, password and secret_names or prefix are required."
+        }), 400
+
+    # Get the data from the dict
+    username = data['username']
+    password = data['password']
+
+    # Delete the secrets
+    result = bulk_delete_secrets(
+            username,
+            password,
+            secret_names=data.get('secret_names'),
+            prefix=data.get('prefix') if not isinstance(data.get('secret_names'), list) else None
+        )
+
+    return result
+
+
+
+@api.route('/export_secrets', methods=['GET'])
+@jwt_required()
+@rate_limited(scope="secrets")
+def export_secrets_api():
+    # Get the data
+    data = request.get_json()
+
+    # Check if al data is provided
+    if not data or 'username' not in data or 'password' not in data:
+        # Return bad request if not
+        return jsonify({
+            "error": "Bad request",
+            "message": "Username and password are required."
+        }), 400
+
+    # Get the data from the dict
+    username = data['username']
+    password = data['password']
+
+    # Stream the archive
+    result = export_secrets(username, password, data.get('archive_password'))
+
+    return result
+
+
+
+@api.route('/import_secrets', methods=['POST'])
+@jwt_required()
+@rate_limited(scope="secrets")
+def import_secrets_api():
+    # The body is the archive, so the user comes from the token and the password from a header
+    username = get_jwt_identity()
+    password = request.headers.get('X-Vadafi-Password')
+
+    if not password:
+        # Return bad request if not
+        return jsonify({
+            "error": "Bad request",
+            "message": "The X-Vadafi-Password header is required."
+        }), 400
+
+    # Read the archive as it comes in
+    result = import_secrets(
+            username,
+            password,
+            request.stream,
+            request.headers.get('X-Vadafi-Archive-Password')
+        )
+
+    return result
+
+
+
+@api.route('/audit_log', methods=['GET'])
+@jwt_required()
+def audit_log_api():
+    # Users only see their own events
+    current_user = get_jwt_identity()
+
+    try:
+        # Default to the last day
+        end = datetime.datetime.fromisoformat(request.args['to']) if 'to' in request.args else utc_now()
+        start = datetime.datetime.fromisoformat(request.args['from']) if 'from' in request.args else end - datetime.timedelta(days=1)
+        limit = min(int(request.args.get('limit', 1000)), 1000)
+
+    except ValueError:
+        return jsonify({
+            "error": "Bad request",
+            "message": "from and to must be ISO 8601 timestamps, limit a number."
+        }), 400
+
+    try:
+        events = fetch_audit_events(current_user, start, end, limit)
+
+    except Exception as e:
+        logger.error(f"Error occured while fetching audit events of user {current_user}. {e}")
+
+        return jsonify({
+            "error": "Error occured while fetching audit events",
+            "message": "Sorry, we could not fetch your audit events at this moment."
+        }), 400
+
+    return jsonify({
+        "message": "Fetched audit events succesfully.",
+        "data": events
+    }), 200
+
+
+
+@api.route('/jobs', methods=['GET'])
+@jwt_required()
+def jobs_api():
+    # Only counts, the payloads stay private
+    return jsonify({
+        "message": "Fetched jobs succesfully.",
+        "data": count_jobs()
+    }), 200
+
+
+
+@api.route('/jobs/<int:job_id>', methods=['GET'])
+@jwt_required()
+def job_api(job_id):
+    # Users only see the jobs of their own vault
+    user_id = get_user_id(get_jwt_identity())
+    job = get_job(job_id, user_id=user_id) if user_id is not None else None
+
+    if job is None:
+        return jsonify({
+            "error": "Job not found",
+            "message": "Sorry, this job could not be found."
+        }), 404
+
+    return jsonify({
+        "message": "Fetched job succesfully.",
+        "data": job
+    }), 200
+
+
 if __name__ == '__main__':
-    app.run(app.run(host='0.0.0.0', port=5000))
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="vadafi")
+    parser.add_argument('command', nargs='?', choices=['serve', 'init', 'worker'], default='serve',
+                        help="serve runs the API, init creates or upgrades the vadafi database, "
+                             "worker runs only the background jobs.")
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        from modules.initiate_vadafi_database import initiate_vadafi_database
+
+        # Safe to run on every deploy
+        raise SystemExit(0 if initiate_vadafi_database() else 1)
+
+    if args.command == 'worker':
+        import signal
+        import threading
+
+        if not get_settings().job_workers:
+            raise SystemExit("JOB_WORKERS is 0, the worker would do nothing.")
+
+        # Reload the settings on SIGHUP, like the API does
+        install_reload_handler()
+
+        # Stop on SIGTERM after the current jobs
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+        scheduler = get_scheduler()
+        scheduler.start()
+
+        try:
+            while not stopping.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+
+        scheduler.stop(timeout=get_settings().job_timeout)
+        raise SystemExit(0)
 
+    app = create_app()
+    app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,429 @@
+# bench_scaling.py
+#
+# Measure how the API scales with the number of users. Starts a throwaway
+# Postgres (a docker container or a temporary initdb cluster), provisions the
+# users through users.create_user, fills their vaults and measures the latency
+# of /get_jwt_token, /fetch_secrets and /reveal_secret and the memory of the
+# server at every tenant count.
+#
+#   python benchmarks/bench_scaling.py --tenants 10,100,1000 --postgres initdb
+#
+# Every user gets its own database, provisioning 10,000 users takes a while.
+# Users are added to the same cluster level by level, so each level only
+# provisions the difference. With --postgres external the DB_* variables
+# point at an existing server, run it against a disposable one only.
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent / 'app'
+
+# Runs the API in its own process, so its memory can be measured
+SERVER = """
+import sys
+import vadafi
+vadafi.create_app().run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)
+"""
+
+# The benchmark would hit the limits within seconds
+# Users are provisioned inline, with JOB_WORKERS at 0 a queued provisioning job would never run
+BENCHMARK_ENV = {
+    "API_SECRET": "benchmark",
+    "JOB_WORKERS": "0",
+    "ASYNC_PROVISIONING": "false",
+    "RATE_LIMIT_IP_PER_MINUTE": "1000000",
+    "RATE_LIMIT_IP_BURST": "1000000",
+    "RATE_LIMIT_USER_PER_MINUTE": "1000000",
+    "RATE_LIMIT_USER_BURST": "1000000",
+    "RATE_LIMIT_SECRETS_IP_PER_MINUTE": "1000000",
+    "RATE_LIMIT_SECRETS_IP_BURST": "1000000",
+    "RATE_LIMIT_SECRETS_USER_PER_MINUTE": "1000000",
+    "RATE_LIMIT_SECRETS_USER_BURST": "1000000",
+}
+
+DB_USER = "vadafi"
+DB_PASSWORD = "vadafi"
+MAX_CONNECTIONS = 300
+
+ENDPOINTS = ("get_jwt_token", "fetch_secrets", "reveal_secret")
+
+
+def username_of(index):
+    return f"bench_{index:05d}"
+
+
+
+def password_of(index):
+    return f"bench-password-{index}"
+
+
+
+def wait_for_postgres(port, timeout=60):
+    """
+    Wait until the server accepts connections.
+    """
+    import psycopg2
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            psycopg2.connect(dbname="postgres", user=DB_USER, password=DB_PASSWORD,
+                             host="127.0.0.1", port=port).close()
+            return
+        except psycopg2.OperationalError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+
+@contextlib.contextmanager
+def docker_postgres(port, image):
+    """
+    Run Postgres in a container that is removed afterwards.
+    """
+    name = f"vadafi-bench-{os.getpid()}"
+    subprocess.run(
+        ["docker", "run", "-d", "--rm", "--name", name,
+         "-e", f"POSTGRES_USER={DB_USER}", "-e", f"POSTGRES_PASSWORD={DB_PASSWORD}", "-e", "POSTGRES_DB=vadafi",
+         "-p", f"127.0.0.1:{port}:5432", image, "-c", f"max_connections={MAX_CONNECTIONS}"],
+        check=True,
+        capture_output=True,
+        )
+    try:
+        wait_for_postgres(port)
+        yield
+    finally:
+        subprocess.run(["docker", "stop", name], capture_output=True)
+
+
+
+@contextlib.contextmanager
+def initdb_postgres(port):
+    """
+    Run Postgres from a temporary cluster that is removed afterwards.
+    """
+    import psycopg2
+
+    directory = Path(tempfile.mkdtemp(prefix="vadafi-bench-"))
+    data = directory / "data"
+    pwfile = directory / "pwfile"
+    pwfile.write_text(DB_PASSWORD)
+
+    subprocess.run(
+        ["initdb", "-D", str(data), "-U", DB_USER, f"--pwfile={pwfile}", "--auth=scram-sha-256", "-E", "UTF8"],
+        check=True,
+        capture_output=True,
+        )
+    subprocess.run(
+        ["pg_ctl", "-D", str(data), "-l", str(directory / "postgres.log"), "-w", "start",
+         "-o", f"-p {port} -k {directory} -c listen_addresses=127.0.0.1 -c max_connections={MAX_CONNECTIONS}"],
+        check=True,
+        capture_output=True,
+        )
+    try:
+        wait_for_postgres(port)
+
+        # The docker image creates it from POSTGRES_DB, initdb does not
+        connection = psycopg2.connect(dbname="postgres", user=DB_USER, password=DB_PASSWORD,
+                                      host="127.0.0.1", port=port)
+        connection.autocommit = True
+        connection.cursor().execute("CREATE DATABASE vadafi")
+        connection.close()
+
+        yield
+    finally:
+        subprocess.run(["pg_ctl", "-D", str(data), "-m", "fast", "-w", "stop"], capture_output=True)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+
+def local_postgres(mode, port, image):
+    """
+    Return the context manager of the Postgres stand-in and the DB_* settings pointing at it.
+    """
+    if mode == "auto":
+        if shutil.which("docker"):
+            mode = "docker"
+        elif shutil.which("initdb") and shutil.which("pg_ctl"):
+            mode = "initdb"
+        else:
+            raise SystemExit("Neither docker nor initdb is available, use --postgres external.")
+
+    if mode == "external":
+        return contextlib.nullcontext(), {}
+
+    env = {"DB_USER": DB_USER, "DB_PASSWORD": DB_PASSWORD, "DB_HOST": "127.0.0.1", "DB_PORT": str(port)}
+    if mode == "docker":
+        return docker_postgres(port, image), env
+
+    return initdb_postgres(port), env
+
+
+
+def provision(start, stop, secrets, workers):
+    """
+    Create users start..stop-1 through users.create_user and fill their vaults.
+
+    Runs in this process, the settings come from os.environ.
+
+    Returns:
+        seconds (float): Time spent provisioning.
+    """
+    import vadafi
+    from modules.secrets import add_secret
+    from modules.users import create_user
+
+    app = vadafi.create_app()
+
+    def provision_user(index):
+        username = username_of(index)
+        password = password_of(index)
+
+        with app.app_context():
+            response, code = create_user(username, password)
+            body = response.get_json()
+
+            # Left over from an earlier run against the same server
+            if body.get("error") == "Username unavailable":
+                return
+            if code != 200:
+                raise RuntimeError(f"Could not create {username}: {body}")
+
+            for number in range(secrets):
+                response, code = add_secret(username, password, f"secret_{number:03d}", f"value-{index}-{number}")
+                if code != 200:
+                    raise RuntimeError(f"Could not add a secret for {username}: {response.get_json()}")
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() raises the first error
+        list(executor.map(provision_user, range(start, stop)))
+
+    return time.perf_counter() - start_time
+
+
+
+def database_size(env):
+    """
+    Return the size of every database of the cluster together, in bytes.
+    """
+    import psycopg2
+
+    connection = psycopg2.connect(dbname="vadafi", user=env["DB_USER"], password=env["DB_PASSWORD"],
+                                  host=env["DB_HOST"], port=env["DB_PORT"])
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT SUM(pg_database_size(datname)) FROM pg_database")
+        return int(cursor.fetchone()[0])
+    finally:
+        connection.close()
+
+
+
+def rss_of(pid):
+    """
+    Return the resident memory of a process in bytes.
+    """
+    status = Path(f"/proc/{pid}/status")
+    if status.exists():
+        for line in status.read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+
+    # No /proc, on macOS
+    output = subprocess.run(["ps", "-o", "rss=", "-p", str(pid)], capture_output=True, text=True).stdout
+    return int(output.strip()) * 1024
+
+
+
+def call(base_url, path, body, token=None):
+    """
+    Send a request, the routes take their arguments as a JSON body.
+
+    Returns:
+        tuple: The latency in milliseconds, the status code and the JSON response.
+    """
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+
+    method = "POST" if path == "/get_jwt_token" else "GET"
+    request = urllib.request.Request(base_url + path, data=json.dumps(body).encode(), headers=headers, method=method)
+
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            status, data = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, data = e.code, e.read()
+    elapsed = (time.perf_counter() - start) * 1000
+
+    try:
+        return elapsed, status, json.loads(data)
+    except ValueError:
+        return elapsed, status, None
+
+
+
+@contextlib.contextmanager
+def api_server(env, port):
+    """
+    Run the API in a fresh process, so every level starts from the same memory.
+    """
+    server = subprocess.Popen(
+        [sys.executable, "-c", SERVER, str(port)],
+        cwd=APP_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                urllib.request.urlopen(base_url + "/healthz").close()
+                break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("The API did not start.")
+                time.sleep(0.2)
+
+        yield server, base_url
+    finally:
+        server.terminate()
+        server.wait()
+
+
+
+def measure(env, port, tenants, secrets, requests, concurrency, seed):
+    """
+    Log in, list and reveal for random users, spread over all tenants.
+
+    Returns:
+        results (dict): Latencies per endpoint, errors and the memory of the server.
+    """
+    rng = random.Random(seed)
+    rounds = [(rng.randrange(tenants), rng.randrange(max(secrets, 1))) for _ in range(requests)]
+
+    latencies = {endpoint: [] for endpoint in ENDPOINTS}
+    errors = {endpoint: 0 for endpoint in ENDPOINTS}
+    lock = threading.Lock()
+
+    def record(endpoint, elapsed, ok):
+        with lock:
+            latencies[endpoint].append(elapsed)
+            errors[endpoint] += not ok
+
+    with api_server(env, port) as (server, base_url):
+        idle_rss = rss_of(server.pid)
+
+        def session(round_):
+            index, number = round_
+            credentials = {"username": username_of(index), "password": password_of(index)}
+            secret_name = f"secret_{number:03d}"
+
+            elapsed, status, data = call(base_url, "/get_jwt_token", credentials)
+            record("get_jwt_token", elapsed, status == 200)
+            if status != 200:
+                return
+            token = data["jwt"]
+
+            elapsed, status, _ = call(base_url, "/fetch_secrets", credentials, token)
+            record("fetch_secrets", elapsed, status == 200)
+
+            elapsed, status, data = call(base_url, "/reveal_secret", dict(credentials, secret_name=secret_name), token)
+            record("reveal_secret", elapsed, status == 200 and bool(data) and "error" not in data)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(session, rounds))
+
+        loaded_rss = rss_of(server.pid)
+
+    results = {"idle_rss_mb": round(idle_rss / 2**20, 1), "loaded_rss_mb": round(loaded_rss / 2**20, 1)}
+    for endpoint in ENDPOINTS:
+        samples = sorted(latencies[endpoint])
+        results[endpoint] = {
+            "p50_ms": round(statistics.median(samples), 1) if samples else None,
+            "p95_ms": round(samples[int(len(samples) * 0.95) - 1], 1) if samples else None,
+            "max_ms": round(samples[-1], 1) if samples else None,
+            "errors": errors[endpoint],
+        }
+
+    return results
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how the vadafi API scales with the number of users.")
+    parser.add_argument('--tenants', default="10,100,1000,10000", help="Comma separated user counts.")
+    parser.add_argument('--secrets', type=int, default=10, help="Secrets per user.")
+    parser.add_argument('--requests', type=int, default=200, help="Login, list and reveal rounds per level.")
+    parser.add_argument('--concurrency', type=int, default=4, help="Parallel clients.")
+    parser.add_argument('--provision-workers', type=int, default=4, help="Users provisioned in parallel.")
+    parser.add_argument('--postgres', choices=['auto', 'docker', 'initdb', 'external'], default='auto')
+    parser.add_argument('--postgres-image', default="postgres:16")
+    parser.add_argument('--db-port', type=int, default=55432, help="Port of the Postgres stand-in.")
+    parser.add_argument('--api-port', type=int, default=5055)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    levels = sorted(int(level) for level in args.tenants.split(","))
+
+    postgres, db_env = local_postgres(args.postgres, args.db_port, args.postgres_image)
+
+    # The provisioning runs in this process, the settings are read on first use
+    os.environ.update(BENCHMARK_ENV)
+    os.environ.update(db_env)
+    sys.path.insert(0, str(APP_DIR))
+    env = dict(os.environ)
+
+    results = []
+    with postgres:
+        from modules.initiate_vadafi_database import initiate_vadafi_database
+        if not initiate_vadafi_database():
+            raise SystemExit("Could not initiate the vadafi database, see app/vadafi.log.")
+
+        provisioned = 0
+        for level in levels:
+            seconds = provision(provisioned, level, args.secrets, args.provision_workers)
+            provisioned = level
+
+            result = measure(env, args.api_port, level, args.secrets, args.requests, args.concurrency, args.seed)
+            result["tenants"] = level
+            result["provision_s"] = round(seconds, 1)
+            result["database_mb"] = round(database_size(env) / 2**20, 1)
+            results.append(result)
+
+            if not args.json:
+                print(f"{level} users, provisioned in {result['provision_s']} s, "
+                      f"{result['database_mb']} MB on disk, server RSS {result['idle_rss_mb']} MB idle "
+                      f"{result['loaded_rss_mb']} MB loaded")
+                for endpoint in ENDPOINTS:
+                    stats = result[endpoint]
+                    print(f"  {endpoint:<14} p50 {stats['p50_ms']:>7} ms   p95 {stats['p95_ms']:>7} ms   "
+                          f"max {stats['max_ms']:>7} ms   errors {stats['errors']}")
+
+    if args.json:
+        print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# bench_startup.py
+#
+# Measure the cold start of the API: importing vadafi, creating the app and
+# answering the first request, each in a fresh interpreter.
+#
+#   python benchmarks/bench_startup.py --runs 20
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent / 'app'
+
+# Runs in a fresh interpreter, prints the timings in milliseconds as JSON
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import vadafi
+imported = time.perf_counter()
+app = vadafi.create_app()
+created = time.perf_counter()
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+Client(app, Response).get('/about')
+served = time.perf_counter()
+print(json.dumps({
+    "import": (imported - start) * 1000,
+    "create_app": (created - imported) * 1000,
+    "first_request": (served - created) * 1000,
+    "total": (served - start) * 1000,
+    "modules": len(sys.modules),
+}))
+"""
+
+# The probe never connects to the database, placeholders are enough
+PLACEHOLDER_ENV = {
+    "DB_USER": "vadafi",
+    "DB_PASSWORD": "vadafi",
+    "DB_HOST": "localhost",
+    "DB_PORT": "5432",
+    "API_SECRET": "benchmark",
+}
+
+
+def run_probe():
+    env = dict(PLACEHOLDER_ENV, **os.environ)
+    env["JOB_WORKERS"] = "0"
+
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=APP_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+        ).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold start of the vadafi API.")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    samples = [run_probe() for _ in range(args.runs)]
+
+    results = {
+        phase: {
+            "median_ms": round(statistics.median(sample[phase] for sample in samples), 1),
+            "min_ms": round(min(sample[phase] for sample in samples), 1),
+        }
+        for phase in ("import", "create_app", "first_request", "total")
+    }
+    results["modules"] = samples[-1]["modules"]
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    print(f"startup over {args.runs} runs, {results['modules']} modules loaded")
+    for phase in ("import", "create_app", "first_request", "total"):
+        print(f"  {phase:<14} median {results[phase]['median_ms']:>7.1f} ms   min {results[phase]['min_ms']:>7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2 @@
+from .cache import LocalCache
+from .client import VadafiClient, VadafiError
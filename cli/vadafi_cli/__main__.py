@@ -0,0 +1,155 @@
+# __main__.py
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from .cache import LocalCache
+from .client import VadafiClient, VadafiError
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="vadafi",
+        description="Command-line client of vadafi. The credentials are read from "
+                    "VADAFI_URL, VADAFI_USERNAME and VADAFI_PASSWORD."
+    )
+    parser.add_argument('--no-cache', action='store_true', help="Do not use the local cache.")
+    parser.add_argument('--cache-ttl', type=int, default=int(os.getenv('VADAFI_CACHE_TTL', 300)),
+                        help="Seconds a revealed secret stays in the local cache.")
+    parser.add_argument('--cache-dir', default=os.getenv('VADAFI_CACHE_DIR'), help="Directory of the local cache.")
+
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('list', help="List the names of the secrets.")
+
+    get = commands.add_parser('get', help="Reveal one or more secrets.")
+    get.add_argument('names', nargs='+')
+    get.add_argument('--format', choices=['plain', 'env', 'json'], default='plain')
+
+    add = commands.add_parser('add', help="Add a secret, read from stdin.")
+    add.add_argument('name')
+    add.add_argument('--cached', action='store_true', help="Keep the secret in the server's hot cache.")
+
+    update = commands.add_parser('update', help="Store a new version of a secret, read from stdin.")
+    update.add_argument('name')
+
+    delete = commands.add_parser('delete', help="Delete one or more secrets.")
+    delete.add_argument('names', nargs='+')
+
+    export = commands.add_parser('export', help="Download an encrypted archive of every secret.")
+    export.add_argument('--output', '-o', help="File to write the archive to, stdout if omitted.")
+
+    import_ = commands.add_parser('import', help="Upload an archive made by export.")
+    import_.add_argument('--input', '-i', help="File to read the archive from, stdin if omitted.")
+
+    commands.add_parser('clear-cache', help="Remove expired entries from the local cache.")
+
+    return parser.parse_args(argv)
+
+
+
+def export_to_file(client, path, archive_password=None):
+    """
+    Export the archive into a file, replacing it only once the download completed.
+
+    A download that fails halfway would otherwise leave a truncated archive
+    behind that looks like a good one.
+    """
+    # The temporary file is in the same directory, so it can be renamed over the target
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.vadafi-export-')
+
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            client.export_secrets(output, archive_password)
+        os.replace(temp_path, path)
+
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Never take the password as an argument, it would end up in the process list
+    try:
+        url = os.environ['VADAFI_URL']
+        username = os.environ['VADAFI_USERNAME']
+        password = os.environ['VADAFI_PASSWORD']
+    except KeyError as e:
+        print(f"{e.args[0]} is not set.", file=sys.stderr)
+        return 2
+
+    cache = None
+    if not args.no_cache:
+        cache = LocalCache(url, username, password, ttl=args.cache_ttl, cache_dir=args.cache_dir)
+
+    if args.command == 'clear-cache':
+        if cache is not None:
+            cache.prune()
+        return 0
+
+    with VadafiClient(url, username, password, cache=cache) as client:
+        try:
+            if args.command == 'list':
+                for secret in client.fetch_secrets():
+                    print(secret['name'])
+
+            elif args.command == 'get':
+                revealed = client.reveal_many(args.names)
+
+                if args.format == 'json':
+                    print(json.dumps(revealed))
+                elif args.format == 'env':
+                    for name, value in revealed.items():
+                        print(f"{name}={json.dumps(value)}")
+                else:
+                    for name in args.names:
+                        if name in revealed:
+                            print(revealed[name])
+
+                missing = [name for name in args.names if name not in revealed]
+                if missing:
+                    print(f"Secrets not found: {', '.join(missing)}", file=sys.stderr)
+                    return 1
+
+            elif args.command == 'add':
+                client.add(args.name, sys.stdin.read().rstrip('\n'), cached=args.cached)
+
+            elif args.command == 'update':
+                client.update(args.name, sys.stdin.read().rstrip('\n'))
+
+            elif args.command == 'delete':
+                client.delete(args.names)
+
+            # VADAFI_ARCHIVE_PASSWORD encrypts the archive with another password than the vault
+            elif args.command == 'export':
+                archive_password = os.getenv('VADAFI_ARCHIVE_PASSWORD')
+                if args.output:
+                    export_to_file(client, args.output, archive_password)
+                else:
+                    client.export_secrets(sys.stdout.buffer, archive_password)
+
+            elif args.command == 'import':
+                archive_password = os.getenv('VADAFI_ARCHIVE_PASSWORD')
+                if args.input:
+                    with open(args.input, 'rb') as archive:
+                        result = client.import_secrets(archive, archive_password)
+                else:
+                    result = client.import_secrets(sys.stdin.buffer, archive_password)
+
+                print(f"Imported {result['imported']} secrets, skipped {result['skipped']} existing.", file=sys.stderr)
+
+        except VadafiError as e:
+            print(e, file=sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
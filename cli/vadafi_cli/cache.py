@@ -0,0 +1,150 @@
+# cache.py
+
+import hashlib
+import json
+import os
+import time
+
+from pathlib import Path
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+# Cost of the scrypt derivation of the cache key, at least as slow to guess as the server's PBKDF2
+SCRYPT_N = 2 ** 15
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+def default_cache_dir():
+    """
+    Return the directory of the local cache, $XDG_CACHE_HOME/vadafi or ~/.cache/vadafi.
+    """
+    base = os.getenv('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'vadafi'
+
+
+
+def load_machine_key(cache_dir):
+    """
+    Return the machine key, generating it on first use.
+
+    The random key file is combined with /etc/machine-id where available, so
+    a copied cache directory is useless on another machine.
+
+    Args:
+        cache_dir (Path): The directory of the local cache.
+
+    Returns:
+        machine_key (bytes)
+    """
+    key_path = cache_dir / 'machine.key'
+
+    if not key_path.exists():
+        cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+        # Only the owner may read the key
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as key_file:
+            key_file.write(os.urandom(32))
+
+    machine_key = key_path.read_bytes()
+
+    machine_id_path = Path('/etc/machine-id')
+    if machine_id_path.exists():
+        machine_key += machine_id_path.read_bytes().strip()
+
+    return machine_key
+
+
+
+class LocalCache:
+    """
+    On-disk cache of revealed secrets, encrypted with the machine key.
+
+    Every entry is encrypted with a key derived from the password with
+    scrypt, salted with the machine key and the server and username, so it
+    can only be read on this machine by someone who knows the password. A
+    copied cache directory is no cheaper to guess passwords against than the
+    server. The derived key only lives in memory. Entries expire after ttl
+    seconds.
+    """
+
+    def __init__(self, server, username, password, ttl=300, cache_dir=None):
+        self.ttl = ttl
+        self.cache_dir = Path(cache_dir) if cache_dir else default_cache_dir()
+        self.scope = f"{server}|{username}"
+
+        # Derive the key of this server and user, a slow KDF because the machine key is on disk
+        salt = hashlib.sha256(load_machine_key(self.cache_dir) + f"vadafi-cache|{self.scope}".encode()).digest()
+        self._aesgcm = AESGCM(Scrypt(
+            salt=salt,
+            length=32,
+            n=SCRYPT_N,
+            r=SCRYPT_R,
+            p=SCRYPT_P,
+        ).derive(password.encode()))
+
+    def _entry_id(self, secret_name):
+        return hashlib.sha256(f"{self.scope}|{secret_name}".encode()).hexdigest()
+
+    def get(self, secret_name):
+        """
+        Return a cached secret, or None if it is missing or expired.
+        """
+        entry_id = self._entry_id(secret_name)
+        path = self.cache_dir / f"{entry_id}.entry"
+
+        try:
+            data = path.read_bytes()
+            entry = json.loads(self._aesgcm.decrypt(data[:12], data[12:], entry_id.encode()))
+
+        except FileNotFoundError:
+            return None
+
+        except Exception:
+            # Corrupt or written with another key
+            path.unlink(missing_ok=True)
+            return None
+
+        if entry['expires_at'] <= time.time():
+            path.unlink(missing_ok=True)
+            return None
+
+        return entry['value']
+
+    def put(self, secret_name, value):
+        """
+        Store a revealed secret.
+        """
+        entry_id = self._entry_id(secret_name)
+        path = self.cache_dir / f"{entry_id}.entry"
+
+        nonce = os.urandom(12)
+        entry = json.dumps({"expires_at": time.time() + self.ttl, "value": value}).encode()
+        data = nonce + self._aesgcm.encrypt(nonce, entry, entry_id.encode())
+
+        # Write to a temporary file first so readers never see half an entry
+        self.cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        temporary_path = path.with_suffix(f".{os.getpid()}.tmp")
+        fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as entry_file:
+            entry_file.write(data)
+        os.replace(temporary_path, path)
+
+    def invalidate(self, secret_name):
+        """
+        Drop a cached secret.
+        """
+        (self.cache_dir / f"{self._entry_id(secret_name)}.entry").unlink(missing_ok=True)
+
+    def prune(self):
+        """
+        Remove every expired or unreadable entry in the cache directory.
+
+        Entries of other users can not be read and are only removed when they
+        are older than the ttl.
+        """
+        now = time.time()
+        for path in self.cache_dir.glob('*.entry'):
+            if now - path.stat().st_mtime > self.ttl:
+                path.unlink(missing_ok=True)
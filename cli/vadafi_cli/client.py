@@ -0,0 +1,320 @@
+# client.py
+
+import time
+
+import requests
+
+# The server reveals at most this many secrets per request
+BATCH_SIZE = 100
+
+
+class VadafiError(Exception):
+    """
+    An error returned by the vadafi API.
+    """
+
+    def __init__(self, status_code, error, message):
+        super().__init__(f"{error}: {message} ({status_code})")
+        self.status_code = status_code
+        self.error = error
+        self.message = message
+
+
+
+class VadafiClient:
+    """
+    Client of the vadafi API.
+
+    All requests share one HTTP session, so the connection to the server is
+    reused. Revealed secrets are served from the optional local cache first.
+
+    Args:
+        url (str): The url of the vadafi server.
+        username (str): The user's username.
+        password (str): The user's password.
+        cache (LocalCache): Optional local cache of revealed secrets.
+        timeout (float): Seconds to wait for the server.
+        max_retries (int): Retries of rate limited requests.
+    """
+
+    def __init__(self, url, username, password, cache=None, timeout=30, max_retries=3):
+        self.url = url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.cache = cache
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+        self.session = requests.Session()
+        self._token = None
+        self._batch_supported = True
+        self._secrets_etag = None
+        self._secrets = None
+
+    def login(self):
+        """
+        Get a JWT token for the next requests.
+        """
+        data = self._send('POST', '/get_jwt_token', {"username": self.username, "password": self.password})
+        self._token = data['jwt']
+
+    def _send(self, method, path, json=None, headers=None, with_response=False, **kwargs):
+        # Retry rate limited requests after the time the server asks for
+        # With with_response the response is returned next to the data, for its headers
+        for attempt in range(self.max_retries + 1):
+            response = self.session.request(
+                method,
+                f"{self.url}{path}",
+                json=json,
+                headers=headers,
+                timeout=self.timeout,
+                **kwargs
+                )
+
+            if response.status_code != 429 or attempt == self.max_retries:
+                break
+
+            time.sleep(float(response.headers.get('Retry-After', 1)))
+
+        if response.status_code == 304:
+            return (None, response) if with_response else None
+
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+
+        if response.status_code >= 400 or 'error' in data:
+            raise VadafiError(
+                response.status_code,
+                data.get('error', response.reason),
+                data.get('message', response.text)
+                )
+
+        return (data, response) if with_response else data
+
+    def _request(self, method, path, json=None, headers=None, with_response=False, **kwargs):
+        # Send an authenticated request, logging in again once the token expired
+        if self._token is None:
+            self.login()
+
+        for attempt in range(2):
+            try:
+                return self._send(
+                    method,
+                    path,
+                    json=json,
+                    headers=dict(headers or {}, Authorization=f"Bearer {self._token}"),
+                    with_response=with_response,
+                    **kwargs
+                    )
+            except VadafiError as e:
+                if e.status_code != 401 or attempt:
+                    raise
+                self.login()
+
+    def _credentials(self, **data):
+        return dict(data, username=self.username, password=self.password)
+
+    def fetch_secrets(self):
+        """
+        Return the ids and names of the user's secrets.
+
+        The list is only transferred again when it changed.
+        """
+        # Only send the ETag when the list it belongs to is still here
+        headers = None
+        if self._secrets_etag and self._secrets is not None:
+            headers = {"If-None-Match": self._secrets_etag}
+
+        # Logs in again once on 401 and retries on 429, like every other request
+        data, response = self._request('GET', '/fetch_secrets', self._credentials(), headers=headers,
+                                       with_response=True)
+
+        if data is None:
+            return self._secrets
+
+        self._secrets_etag = response.headers.get('ETag')
+        self._secrets = data['data']
+        return self._secrets
+
+    def reveal(self, secret_name, version=None):
+        """
+        Reveal a secret, from the local cache if possible.
+        """
+        if version is None and self.cache is not None:
+            value = self.cache.get(secret_name)
+            if value is not None:
+                return value
+
+        data = self._request('GET', '/reveal_secret', self._credentials(secret_name=secret_name, version=version))
+
+        if version is None and self.cache is not None:
+            self.cache.put(secret_name, data['data'])
+
+        return data['data']
+
+    def reveal_many(self, secret_names):
+        """
+        Reveal many secrets, from the local cache where possible and with as
+        few requests as possible for the rest.
+
+        Returns:
+            revealed (dict): The secrets by name, missing secrets are left out.
+        """
+        revealed = {}
+        remaining = []
+
+        for secret_name in dict.fromkeys(secret_names):
+            value = self.cache.get(secret_name) if self.cache is not None else None
+            if value is not None:
+                revealed[secret_name] = value
+            else:
+                remaining.append(secret_name)
+
+        for start in range(0, len(remaining), BATCH_SIZE):
+            batch = remaining[start:start + BATCH_SIZE]
+
+            if self._batch_supported:
+                try:
+                    data = self._request('GET', '/reveal_secrets', self._credentials(secret_names=batch))
+                    fetched = data['data']
+
+                except VadafiError as e:
+                    # Older servers have no batch endpoint
+                    if e.status_code not in (404, 405):
+                        raise
+                    self._batch_supported = False
+
+            if not self._batch_supported:
+                fetched = {}
+                for secret_name in batch:
+                    try:
+                        fetched[secret_name] = self._request(
+                            'GET',
+                            '/reveal_secret',
+                            self._credentials(secret_name=secret_name)
+                            )['data']
+                    except VadafiError as e:
+                        if e.error != "Secret not found":
+                            raise
+
+            for secret_name, value in fetched.items():
+                revealed[secret_name] = value
+                if self.cache is not None:
+                    self.cache.put(secret_name, value)
+
+        return revealed
+
+    def add(self, secret_name, plain_text_secret, cached=False):
+        """
+        Add a secret.
+        """
+        data = self._request('POST', '/add_secret', self._credentials(
+            secret_name=secret_name,
+            plain_text_secret=plain_text_secret,
+            cached=cached
+            ))
+        if self.cache is not None:
+            self.cache.invalidate(secret_name)
+        return data
+
+    def update(self, secret_name, plain_text_secret, cached=None):
+        """
+        Store a new version of a secret.
+        """
+        data = self._request('POST', '/update_secret', self._credentials(
+            secret_name=secret_name,
+            plain_text_secret=plain_text_secret,
+            cached=cached
+            ))
+        if self.cache is not None:
+            self.cache.invalidate(secret_name)
+        return data
+
+    def delete(self, secret_names):
+        """
+        Delete one or more secrets.
+        """
+        data = self._request('DELETE', '/delete_secrets', self._credentials(secret_names=list(secret_names)))
+        if self.cache is not None:
+            for secret_name in secret_names:
+                self.cache.invalidate(secret_name)
+        return data
+
+    def export_secrets(self, output, archive_password=None, chunk_size=64 * 1024):
+        """
+        Download an encrypted archive of every secret, streamed into output.
+
+        Args:
+            output: A binary file to write the archive to.
+            archive_password (str): Encrypt the archive with another password.
+
+        Returns:
+            size (int): The size of the archive in bytes.
+        """
+        # Log in again first, a token expiring halfway can not be retried
+        self.login()
+
+        response = self.session.get(
+            f"{self.url}/export_secrets",
+            json=self._credentials(archive_password=archive_password),
+            headers={"Authorization": f"Bearer {self._token}"},
+            timeout=self.timeout,
+            stream=True
+            )
+
+        with response:
+            if response.status_code != 200:
+                data = response.json()
+                raise VadafiError(response.status_code, data.get('error'), data.get('message'))
+
+            size = 0
+            for chunk in response.iter_content(chunk_size):
+                output.write(chunk)
+                size += len(chunk)
+
+        return size
+
+    def import_secrets(self, archive, archive_password=None):
+        """
+        Upload an archive from export_secrets, streamed from a binary file.
+
+        Returns:
+            result (dict): The number of imported and skipped secrets.
+        """
+        self.login()
+
+        headers = {
+            "Authorization": f"Bearer {self._token}",
+            "Content-Type": "application/octet-stream",
+            "X-Vadafi-Password": self.password,
+        }
+        if archive_password:
+            headers["X-Vadafi-Archive-Password"] = archive_password
+
+        # A file object is sent in chunks, not read into memory
+        response = self.session.post(
+            f"{self.url}/import_secrets",
+            data=iter(lambda: archive.read(64 * 1024), b""),
+            headers=headers,
+            timeout=self.timeout
+            )
+
+        data = response.json()
+        if response.status_code >= 400 or 'error' in data:
+            raise VadafiError(response.status_code, data.get('error'), data.get('message'))
+
+        return data
+
+    def close(self):
+        """
+        Close the HTTP session.
+        """
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()